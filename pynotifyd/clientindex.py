@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module maintains a small index of the settings pynotifyd_client
+needs. The daemon writes it into the queuedir, so the client can skip
+parsing and validating the full configuration. The index is tied to the
+modification time and size of the configuration file and ignored once
+either changes.
+
+This module must stay cheap to import, so json is only imported when
+the index is read or written.
+"""
+
+from __future__ import with_statement
+import os
+
+import errors
+
+INDEX_NAME = ".clientindex"
+
+
+def scan_queuedir(configfile):
+	"""Find the queuedir option of the general section without parsing
+	the whole configuration file.
+
+	@type configfile: str
+	@rtype: str or None
+	@returns: None if the value cannot be determined cheaply
+	"""
+	section = None
+	try:
+		with open(configfile) as lines:
+			for line in lines:
+				line = line.strip()
+				if not line or line.startswith("#"):
+					continue
+				if line.startswith("["):
+					section = line.strip("[]").strip() if not line.startswith("[[") else None
+					continue
+				key, sep, value = line.partition("=")
+				if section != "general" or not sep or key.strip() != "queuedir":
+					continue
+				value = value.strip()
+				if value[:1] in ("'", '"'):
+					value, sep, _ = value[1:].partition(value[0])
+					if not sep:
+						return None
+				else:
+					value = value.split("#", 1)[0].strip()
+				if "$" in value or not value:  # interpolation
+					return None
+				return value
+	except IOError:
+		pass
+	return None
+
+
+def config_stamp(configfile):
+	"""
+	@type configfile: str
+	@rtype: [float, int] or None
+	"""
+	try:
+		info = os.stat(configfile)
+	except OSError:
+		return None
+	return [info.st_mtime, info.st_size]
+
+
+def make_index(config, signal):
+	"""
+	@type config: configobj.ConfigObj
+	@type signal: bool
+	@param signal: whether the daemon needs SIGUSR1 to notice new entries
+	@rtype: {str: object}
+	"""
+	general = config["general"]
+	contacts = [name for name, contact in config["contacts"].items() if "members" not in contact]
+	groups = dict((name, list(contact["members"])) for name, contact in config["contacts"].items() if "members" in contact)
+	priorities = dict((int(priority), list(retry)) for priority, retry in config["priorities"].items())
+	return dict(queuedir=general["queuedir"], retry=list(general["retry"]), priorities=priorities, ttl=general["ttl"], durability=general["durability"], contacts=sorted(contacts), groups=groups, socket=general["socket"], signal=signal)
+
+
+def expand_recipients(settings, names):
+	"""Resolve contact groups to their members.
+
+	@type settings: {str: object}
+	@param settings: as returned by make_index or read_index
+	@type names: [str]
+	@param names: names of contacts or groups
+	@rtype: [str]
+	@returns: contact names without duplicates in order of appearance
+	@raises PyNotifyDPermanentError: for unknown names
+	"""
+	recipients = []
+	for name in names:
+		if name in settings["groups"]:
+			members = settings["groups"][name]
+		elif name in settings["contacts"]:
+			members = [name]
+		else:
+			raise errors.PyNotifyDPermanentError("unknown recipient %s" % name)
+		recipients.extend(member for member in members if member not in recipients)
+	return recipients
+
+
+def write_index(configfile, config, signal):
+	"""Write the index for the given configuration into its queuedir.
+
+	@type configfile: str
+	@type config: configobj.ConfigObj
+	@type signal: bool
+	@param signal: whether the daemon needs SIGUSR1 to notice new entries
+	@raises OSError:
+	@raises IOError:
+	"""
+	import json
+	index = make_index(config, signal)
+	index["config"] = os.path.abspath(configfile)
+	index["stamp"] = config_stamp(configfile)
+	path = os.path.join(config["general"]["queuedir"], INDEX_NAME)
+	with open(path + ".tmp", "w") as indexfile:
+		json.dump(index, indexfile)
+	os.rename(path + ".tmp", path)
+
+
+def read_index(configfile):
+	"""Read the index for the given configuration file.
+
+	@type configfile: str
+	@rtype: {str: object} or None
+	@returns: None if there is no index or it is stale
+	"""
+	queuedir = scan_queuedir(configfile)
+	if queuedir is None:
+		return None
+	import json
+	try:
+		with open(os.path.join(queuedir, INDEX_NAME)) as indexfile:
+			index = json.load(indexfile)
+	except (IOError, ValueError):
+		return None
+	if not isinstance(index, dict) or index.get("config") != os.path.abspath(configfile) or "durability" not in index:
+		return None
+	stamp = config_stamp(configfile)
+	if stamp is None or index.get("stamp") != stamp or index.get("queuedir") != queuedir:
+		return None
+	# json yields unicode, but the rest of pynotifyd works with str
+	index["queuedir"] = queuedir
+	index["retry"] = [str(item) for item in index["retry"]]
+	index["durability"] = str(index["durability"])
+	index["priorities"] = dict((int(priority), [str(item) for item in retry]) for priority, retry in index["priorities"].items())
+	index["contacts"] = set(contact.encode("utf-8") for contact in index["contacts"])
+	index["groups"] = dict((name.encode("utf-8"), [member.encode("utf-8") for member in members]) for name, members in index["groups"].items())
+	if index["socket"] is not None:
+		index["socket"] = index["socket"].encode("utf-8")
+	return index
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides clocks for scheduling queue entries."""
+
+import ctypes
+import ctypes.util
+import os
+import time
+
+CLOCK_MONOTONIC = 1
+
+
+class timespec(ctypes.Structure):  # pylint:disable=C0103
+	_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def load_clock_gettime():
+	"""
+	@rtype: function or None
+	"""
+	# Recent C libraries provide clock_gettime themselves, older ones
+	# in librt.
+	for name in (None, "librt.so.1", "rt"):
+		if name == "rt":
+			name = ctypes.util.find_library(name)
+			if name is None:
+				return None
+		try:
+			clock_gettime = ctypes.CDLL(name, use_errno=True).clock_gettime
+			break
+		except (OSError, AttributeError):
+			pass
+	else:
+		return None
+	clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+	return clock_gettime
+
+_clock_gettime = load_clock_gettime()
+
+
+def monotonic():
+	"""
+	@rtype: float or None
+	@returns: seconds of CLOCK_MONOTONIC or None if it is not available
+	"""
+	if _clock_gettime is None:
+		return None
+	value = timespec()
+	if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(value)) != 0:
+		errno = ctypes.get_errno()
+		raise OSError(errno, os.strerror(errno))
+	return value.tv_sec + value.tv_nsec * 1e-9
+
+
+class AnchoredClock(object):
+	"""A clock that tells wall clock time as of its creation, but
+	advances monotonically afterwards. Steps of the system clock, e.g. by
+	NTP, do not affect it. Falls back to the wall clock where no
+	monotonic clock is available. After a step, times of this clock
+	stored for a later process deviate from the wall clock by the step.
+	"""
+	def __init__(self):
+		self.anchor = time.time()
+		self.monotonic_anchor = monotonic()
+
+	def __call__(self):
+		"""
+		@rtype: float
+		"""
+		if self.monotonic_anchor is None:
+			return time.time()
+		return self.anchor + monotonic() - self.monotonic_anchor
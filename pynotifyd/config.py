@@ -3,6 +3,7 @@
 
 import configobj
 import email.utils
+import grp
 import socket
 import validate
 
@@ -14,11 +15,30 @@ except ImportError:
 	pass
 
 import errors
+import queue
 
 config_spec = configobj.ConfigObj("""
 [general]
 queuedir = string(min=1)
 retry = list(min=1)
+rescan_interval = integer(min=0, default=3600)
+workers = integer(min=1, default=1)
+batchsize = integer(min=1, default=1)
+socket = string(min=1, default=None)
+socket_mode = string(min=1, default="0660")
+socket_group = string(min=1, default=None)
+dedup_window = integer(min=0, default=0)
+priority_aging = integer(min=1, default=60)
+ttl = integer(min=0, default=0)
+backlog_threshold = integer(min=0, default=0)
+lease_timeout = integer(min=0, default=0)
+durability = option("none", "fsync", "group", default="none")
+group_commit_window = float(min=0, default=0.005)
+backend = option("files", "log", "sqlite", default="files")
+segment_size = integer(min=1, default=16777216)
+
+[priorities]
+__many__ = list(min=1)
 
 [contacts]
 [[__many__]]
@@ -26,6 +46,8 @@ retry = list(min=1)
 [providers]
 [[__many__]]
 driver = string(min=1)
+concurrency = integer(min=1, default=None)
+aggregate = boolean(default=False)
 
 """.splitlines(), interpolation=False, list_values=False)
 
@@ -91,16 +113,58 @@ def read_config(filename):
 	for contactname, contact in config["contacts"].items():
 		if not isinstance(contact, dict):
 			raise errors.PyNotifyDConfigurationError("non-section found in section contacts")
+		if "members" in contact:
+			if isinstance(contact["members"], basestring):
+				contact["members"] = [contact["members"]]
+			continue
 		try:
 			validate_contact(contact)
 		except errors.PyNotifyDConfigurationError, err:
 			raise errors.PyNotifyDConfigurationError("%s in contact %s" % (err.message, contactname))
 
+	# check groups
+	for contactname, contact in config["contacts"].items():
+		for member in contact.get("members", ()):
+			if member not in config["contacts"]:
+				raise errors.PyNotifyDConfigurationError("member %s of group %s not found" % (member, contactname))
+			if "members" in config["contacts"][member]:
+				raise errors.PyNotifyDConfigurationError("group %s must not contain group %s" % (contactname, member))
+
+	if config["general"]["lease_timeout"] and config["general"]["backend"] != "files":
+		raise errors.PyNotifyDConfigurationError("lease_timeout requires backend files")
+
+	# check socket permissions
+	try:
+		config["general"]["socket_mode"] = int(config["general"]["socket_mode"], 8)
+	except ValueError:
+		raise errors.PyNotifyDConfigurationError("socket_mode must be an octal number")
+	if not 0 <= config["general"]["socket_mode"] <= 0777:
+		raise errors.PyNotifyDConfigurationError("socket_mode must be a permission mode such as 0660")
+	group = config["general"]["socket_group"]
+	if group is not None:
+		try:
+			config["general"]["socket_group"] = int(group) if group.isdigit() else grp.getgrnam(group).gr_gid
+		except KeyError:
+			raise errors.PyNotifyDConfigurationError("socket_group %s not found" % group)
+
 	# check retry logic
-	for provider in config["general"]["retry"]:
-		if provider.isdigit() or provider == "GIVEUP":
-			continue
-		if provider in config["providers"]:
-			continue
-		raise errors.PyNotifyDConfigurationError("provider %s not found" % provider)
+	for priority in config["priorities"]:
+		if not priority.lstrip("-").isdigit():
+			raise errors.PyNotifyDConfigurationError("priority %s is not an integer" % priority)
+	for retry in [config["general"]["retry"]] + config["priorities"].values():
+		for provider in retry:
+			if queue.parse_wait(provider) is not None or provider == "GIVEUP":
+				continue
+			if provider in config["providers"]:
+				continue
+			raise errors.PyNotifyDConfigurationError("provider %s not found" % provider)
 	return config
+
+
+def get_priority_retry(config):
+	"""
+	@type config: configobj.ConfigObj
+	@rtype: {int: [str]}
+	@returns: maps priorities to their retry logic
+	"""
+	return dict((int(priority), list(retry)) for priority, retry in config["priorities"].items())
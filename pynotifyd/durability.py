@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module makes queue files durable. Files are written to a
+temporary name, synced, published by renaming and finally the containing
+directories are synced.
+
+With the "group" mode concurrent writers share the waiting: the first
+writer of a batch collects further writers for a short window and then
+syncs the files of all of them and each directory only once.
+"""
+
+from __future__ import with_statement
+import os
+import threading
+import time
+
+NONE = "none"
+FSYNC = "fsync"
+GROUP = "group"
+MODES = (NONE, FSYNC, GROUP)
+
+
+def fsync_path(path):
+	"""
+	@type path: str
+	@param path: a file or directory
+	@raises OSError:
+	"""
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def commit(paths, publish, directories):
+	"""Make files durable on their own.
+
+	@type paths: [str]
+	@param paths: files to sync before publishing them
+	@type publish: () -> [str] or None
+	@param publish: makes the files visible, e.g. by renaming them, and
+		optionally returns further files to sync afterwards
+	@type directories: [str]
+	@param directories: directories to sync after publishing
+	@raises OSError:
+	@raises IOError:
+	"""
+	for path in paths:
+		fsync_path(path)
+	directories = set(directories).union(publish() or ())
+	for directory in directories:
+		fsync_path(directory)
+
+
+class GroupCommitter(object):
+	"""Makes files of concurrent writers durable using shared syncs. There
+	is no thread of its own: the first writer of a batch leads it, while
+	the others wait for it to finish.
+
+	@type batches: int
+	@ivar batches: number of batches committed
+	@type requests: int
+	@ivar requests: number of commit calls served
+	"""
+	def __init__(self, window=0.005):
+		"""
+		@type window: float
+		@param window: number of seconds the leader of a batch waits for
+			further writers
+		"""
+		self.window = window
+		self.cond = threading.Condition()
+		self.pending = []
+		self.leading = False
+		self.batches = 0
+		self.requests = 0
+
+	def commit(self, paths, publish, directories):
+		"""Like the commit function, but shares the syncs with concurrent
+		callers. Returns once the files are durable.
+
+		@type paths: [str]
+		@type publish: () -> [str] or None
+		@type directories: [str]
+		@raises OSError:
+		@raises IOError:
+		"""
+		request = dict(paths=paths, publish=publish, directories=directories, done=False, error=None)
+		with self.cond:
+			self.pending.append(request)
+			while self.leading and not request["done"]:
+				self.cond.wait()
+			if not request["done"]:
+				self.leading = True
+		if not request["done"]:
+			try:
+				if self.window:
+					time.sleep(self.window)
+				with self.cond:
+					batch, self.pending = self.pending, []
+				self.flush(batch)
+			finally:
+				with self.cond:
+					self.leading = False
+					self.cond.notify_all()
+		if request["error"] is not None:
+			raise request["error"]
+
+	def flush(self, batch):
+		"""
+		@type batch: [{str: object}]
+		@param batch: the requests to commit
+		"""
+		for request in batch:
+			try:
+				for path in request["paths"]:
+					fsync_path(path)
+				request["directories"] = set(request["directories"]).union(request["publish"]() or ())
+			except (IOError, OSError), err:
+				request["error"] = err
+		directories = set()
+		for request in batch:
+			if request["error"] is None:
+				directories.update(request["directories"])
+		for directory in directories:
+			try:
+				fsync_path(directory)
+			except OSError, err:
+				for request in batch:
+					if request["error"] is None and directory in request["directories"]:
+						request["error"] = err
+		with self.cond:
+			self.batches += 1
+			self.requests += len(batch)
+			for request in batch:
+				request["done"] = True
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides a CircuitBreaker tracking the health of a
+provider.
+"""
+
+from __future__ import with_statement
+import collections
+import logging
+import threading
+import time
+
+import errors
+
+logger = logging.getLogger("pynotifyd.health")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+	"""Tracks failure rate and latency of deliveries within a sliding
+	window. When the failure rate reaches the threshold the circuit
+	opens and deliveries are refused for cooldown seconds. Afterwards
+	the circuit is half-open: a single delivery of a single message is
+	permitted as a probe. It closes the circuit on success and opens it
+	again on failure.
+
+	Permanent errors are specific to a recipient and do not count as
+	failures of the provider.
+
+	@type window: collections.deque([(float, bool, float)])
+	@ivar window: (timestamp, failed, latency) of recent deliveries
+	"""
+	def __init__(self, name, threshold=None, window=300, min_calls=5, cooldown=60):
+		"""
+		@type name: str
+		@param name: used for logging
+		@type threshold: float or None
+		@param threshold: failure rate opening the circuit. None means
+			the circuit never opens, but health is still tracked.
+		@type window: float
+		@param window: number of seconds deliveries are remembered
+		@type min_calls: int
+		@param min_calls: minimum number of deliveries within the window
+			for opening the circuit
+		@type cooldown: float
+		@param cooldown: number of seconds the circuit stays open
+		"""
+		self.name = name
+		self.threshold = threshold
+		self.windowlength = window
+		self.min_calls = min_calls
+		self.cooldown = cooldown
+		self.window = collections.deque()
+		self.state = CLOSED
+		self.opened = 0
+		self.times_opened = 0
+		self.probing = False
+		self.lock = threading.Lock()
+
+	def expire(self, now):
+		while self.window and self.window[0][0] < now - self.windowlength:
+			self.window.popleft()
+
+	def allow(self):
+		"""Ask for permission to deliver. A permitted delivery must be
+		followed by a call to record.
+
+		@rtype: int or None
+		@returns: the maximum number of messages the delivery may
+			comprise: None if unlimited, 0 if refused and 1 for a probe
+		"""
+		with self.lock:
+			if self.state == CLOSED:
+				return None
+			if self.state == OPEN:
+				if time.time() < self.opened + self.cooldown:
+					return 0
+				logger.info("circuit of %s half-open, probing provider", self.name)
+				self.state = HALF_OPEN
+			if self.probing:
+				return 0
+			self.probing = True
+			return 1
+
+	def record(self, results, latency):
+		"""Record the outcome of a delivery.
+
+		@type results: [None or Exception]
+		@param results: as returned by ProviderBase.send_messages
+		@type latency: float
+		@param latency: number of seconds the delivery took
+		"""
+		now = time.time()
+		failures = [not (result is None or isinstance(result, errors.PyNotifyDPermanentError)) for result in results]
+		with self.lock:
+			self.expire(now)
+			for failed in failures:
+				self.window.append((now, failed, latency))
+			if self.state == HALF_OPEN and self.probing:
+				self.probing = False
+				if any(failures):
+					self.open(now)
+				else:
+					logger.info("probe of %s succeeded, closing circuit", self.name)
+					self.state = CLOSED
+					self.window.clear()
+			elif self.state == CLOSED and self.threshold is not None and len(self.window) >= self.min_calls:
+				if self.failure_rate() >= self.threshold:
+					self.open(now)
+
+	def open(self, now):
+		logger.warn("opening circuit of %s for %s seconds", self.name, self.cooldown)
+		self.state = OPEN
+		self.opened = now
+		self.times_opened += 1
+
+	def failure_rate(self):
+		"""
+		@rtype: float
+		"""
+		if not self.window:
+			return 0.
+		return sum(1 for _, failed, _ in self.window if failed) / float(len(self.window))
+
+	def stats(self):
+		"""
+		@rtype: {str: str or int or float}
+		"""
+		with self.lock:
+			self.expire(time.time())
+			latencies = [latency for _, _, latency in self.window]
+			return dict(state=self.state, calls=len(self.window), failure_rate=self.failure_rate(), latency_avg=sum(latencies) / len(latencies) if latencies else 0., latency_max=max(latencies) if latencies else 0., opened=self.times_opened)
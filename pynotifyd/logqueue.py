@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides SegmentLogQueue, a queue storing its entries as
+records in append-only segment files in the log subdirectory of the
+queuedir instead of one file per entry.
+
+Each record consists of a header line "<kind> <name> <length> <crc32>"
+followed by length bytes of payload. The name is the filename the entry
+would have in the file based queue. Kinds are:
+ - E: an entry was enqueued. The payload is "<recipient>\\n<message>".
+ - R: an entry was renamed, i.e. its deadline, state or expiry changed.
+ - D: an entry was delivered or given up.
+"""
+
+from __future__ import with_statement
+import errno
+import logging
+import os
+import threading
+import time
+import zlib
+
+import durability
+import queue
+
+logger = logging.getLogger("pynotifyd.logqueue")
+
+LOG_DIR = "log"
+SEGMENT_SUFFIX = ".seg"
+MAX_HEADER = 512
+ENQUEUE = "E"
+RENAME = "R"
+DONE = "D"
+
+
+def format_record(kind, name, payload=""):
+	"""
+	@type kind: str
+	@type name: str
+	@type payload: str
+	@rtype: str
+	"""
+	checksum = zlib.crc32(payload, zlib.crc32("%s %s" % (kind, name))) & 0xffffffff
+	return "%s %s %d %08x\n%s" % (kind, name, len(payload), checksum, payload)
+
+
+def read_records(segmentfile):
+	"""Parse the records of a segment up to the first one that is
+	truncated or corrupt.
+
+	@type segmentfile: file
+	@rtype: ([(str, str, int, int, int)], int)
+	@returns: (kind, name, offset of payload, length of payload, size of
+		record) of the valid records and the offset where they end
+	"""
+	records = []
+	offset = 0
+	while True:
+		header = segmentfile.readline(MAX_HEADER)
+		if not header.endswith("\n"):
+			return records, offset
+		try:
+			kind, name, length, checksum = header.split()
+			length = int(length)
+			checksum = int(checksum, 16)
+		except ValueError:
+			return records, offset
+		payload = segmentfile.read(length)
+		if len(payload) != length or zlib.crc32(payload, zlib.crc32("%s %s" % (kind, name))) & 0xffffffff != checksum:
+			return records, offset
+		records.append((kind, name, offset + len(header), length, len(header) + length))
+		offset += len(header) + length
+
+
+class SegmentLogQueue(queue.IngestingQueue):
+	"""A queue storing entries and their state transitions as records in
+	append-only segment files. Only the location of each message is kept
+	in memory. The state is recovered by replaying the segments, so
+	changing the state of an entry does not touch the directory.
+
+	Once the active segment exceeds segment_size, a new one is started.
+	A background thread compacts sealed segments by copying their
+	remaining entries to the active segment and removing them. As their
+	records may complete entries of older segments, segments are always
+	compacted oldest first.
+
+	Enqueue records are made durable as required by the durability mode.
+	Rename and done records are only synced along with them, when a
+	segment is sealed or compacted. Like the renames of the file based
+	queue, losing them in a power loss merely repeats a delivery or an
+	attempt. In the "none" mode nothing is synced.
+
+	@type records: {str: [str, int, int, int, int]} or None
+	@ivar records: maps ids of pending entries to their current filename,
+		the number of the segment containing their message, offset and
+		length of the message and the size of its record. None until the
+		log has been replayed.
+	@type segments: {int: [int, int]} or None
+	@ivar segments: maps segment numbers to the bytes of records of
+		pending entries and the bytes of all records within the segment
+	@type compactions: int
+	@ivar compactions: number of segments compacted
+	"""
+	def __init__(self, queuedir, retrylogic, rescan_interval=3600, dedup_window=0, priority_retry=None, priority_aging=60, backlog_threshold=0, clock=time.time, durability_mode=durability.NONE, group_commit_window=0.005, segment_size=16 << 20):
+		"""See QueueBase.__init__.
+
+		@type segment_size: int
+		@param segment_size: start a new segment after this many bytes
+		"""
+		queue.IngestingQueue.__init__(self, queuedir, retrylogic, rescan_interval, dedup_window, priority_retry, priority_aging, backlog_threshold, clock, durability_mode, group_commit_window)
+		self.segment_size = segment_size
+		self.logdir = os.path.join(queuedir, LOG_DIR)
+		self.loglock = threading.RLock()
+		self.records = None
+		self.segments = None
+		self.active = None
+		self.activefd = None
+		self.activesize = 0
+		self.compactor = None
+		self.compactions = 0
+
+	def get_segment_path(self, number):
+		"""
+		@type number: int
+		@rtype: str
+		"""
+		return os.path.join(self.logdir, "%08x%s" % (number, SEGMENT_SUFFIX))
+
+	def load(self):
+		"""Replay the log unless done already. This is deferred to the
+		first use, because the queuedir must be locked before.
+
+		@raises OSError:
+		@raises IOError:
+		"""
+		with self.loglock:
+			if self.records is not None:
+				return
+			try:
+				os.mkdir(self.logdir)
+			except OSError, err:
+				if err.errno != errno.EEXIST:
+					raise
+			numbers = sorted(int(name[:-len(SEGMENT_SUFFIX)], 16) for name in os.listdir(self.logdir) if name.endswith(SEGMENT_SUFFIX))
+			self.records = {}
+			self.segments = {}
+			for number in numbers:
+				self.segments[number] = [0, 0]
+				with open(self.get_segment_path(number), "rb") as segmentfile:
+					records, validsize = read_records(segmentfile)
+					segmentfile.seek(0, os.SEEK_END)
+					size = segmentfile.tell()
+				for record in records:
+					self.apply(number, *record)
+				if validsize == size:
+					continue
+				if number == numbers[-1]:
+					logger.warn("truncating incomplete record at offset %d of segment %s", validsize, self.get_segment_path(number))
+					with open(self.get_segment_path(number), "r+b") as segmentfile:
+						segmentfile.truncate(validsize)
+				else:
+					logger.error("ignoring corrupt records from offset %d of segment %s", validsize, self.get_segment_path(number))
+			self.open_segment(numbers[-1] if numbers else 1)
+			logger.debug("replayed %d segments with %d pending entries", len(numbers), len(self.records))
+
+	def open_segment(self, number):
+		"""
+		@type number: int
+		@raises OSError:
+		"""
+		self.activefd = os.open(self.get_segment_path(number), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+		self.active = number
+		self.activesize = os.fstat(self.activefd).st_size
+		self.segments.setdefault(number, [0, 0])
+
+	def rotate(self):
+		"""Seal the active segment and start a new one."""
+		if self.durability_mode != durability.NONE:
+			os.fsync(self.activefd)
+		os.close(self.activefd)
+		self.activefd = None
+		self.open_segment(self.active + 1)
+		if self.durability_mode != durability.NONE:
+			durability.fsync_path(self.logdir)
+		logger.debug("started segment %s", self.get_segment_path(self.active))
+		self.maybe_compact()
+
+	def apply(self, number, kind, name, offset, length, size):
+		"""Update records and segments with a record.
+
+		@type number: int
+		@param number: the segment containing the record
+		@type kind: str
+		@type name: str
+		@type offset: int
+		@param offset: position of the payload in the segment
+		@type length: int
+		@param length: size of the payload
+		@type size: int
+		@param size: size of the whole record
+		"""
+		entryid = queue.QueueEntry(name).entryid
+		record = self.records.get(entryid)
+		self.segments[number][1] += size
+		if kind == ENQUEUE:
+			if record is not None:
+				self.segments[record[1]][0] -= record[4]
+			self.records[entryid] = [name, number, offset, length, size]
+			self.segments[number][0] += size
+		elif record is None:
+			pass  # completed or compacted away
+		elif kind == RENAME:
+			record[0] = name
+		elif kind == DONE:
+			del self.records[entryid]
+			self.segments[record[1]][0] -= record[4]
+
+	def append(self, records):
+		"""Append records to the active segment.
+
+		@type records: [(str, str, str)]
+		@param records: (kind, name, payload) tuples
+		@rtype: str
+		@returns: the path of the segment written to
+		@raises OSError:
+		"""
+		with self.loglock:
+			self.load()
+			data = []
+			applied = []
+			offset = self.activesize
+			for kind, name, payload in records:
+				record = format_record(kind, name, payload)
+				applied.append((kind, name, offset + len(record) - len(payload), len(payload), len(record)))
+				data.append(record)
+				offset += len(record)
+			data = "".join(data)
+			try:
+				written = 0
+				while written < len(data):
+					written += os.write(self.activefd, data[written:])
+			except OSError:
+				# Replay stops at a partial record, so remove it.
+				os.ftruncate(self.activefd, self.activesize)
+				raise
+			self.activesize += len(data)
+			for record in applied:
+				self.apply(self.active, *record)
+			path = self.get_segment_path(self.active)
+			if self.activesize >= self.segment_size:
+				self.rotate()
+			return path
+
+	def commit_records(self, records):
+		"""Append records and make them durable as required by the
+		durability mode.
+
+		@type records: [(str, str, str)]
+		@raises OSError:
+		"""
+		publish = lambda: [self.append(records)]
+		if self.durability_mode == durability.NONE:
+			publish()
+		elif self.committer is None:
+			durability.commit([], publish, [])
+		else:
+			self.committer.commit([], publish, [])
+
+	def get_record(self, entry):
+		"""
+		@type entry: QueueEntry
+		@rtype: [str, int, int, int, int]
+		@raises IOError: if the entry does not exist
+		"""
+		self.load()
+		with self.loglock:
+			record = self.records.get(entry.entryid)
+			if record is None or record[0] != entry.filename:
+				raise IOError(errno.ENOENT, "no such entry", entry.filename)
+			return record
+
+	def iter_entries(self):
+		self.load()
+		with self.loglock:
+			names = [record[0] for record in self.records.values()]
+		return (queue.QueueEntry(name) for name in names)
+
+	def write_batch(self, batch):
+		self.commit_records([(ENQUEUE, created.filename, "%s\n%s" % (recipient, message)) for recipients, pending, message in batch for recipient, created in zip(recipients, pending)])
+		with self.indexlock:
+			for _, entries, _ in batch:
+				for entry in entries:
+					self.index_add(entry)
+
+	def get_contents(self, entry):
+		with self.loglock:
+			_, number, offset, length, _ = self.get_record(entry)
+			# Compaction may remove the segment once unlocked.
+			segmentfile = open(self.get_segment_path(number), "rb")
+		with segmentfile:
+			segmentfile.seek(offset)
+			recipient, _, message = segmentfile.read(length).partition("\n")
+		return recipient, message
+
+	def has_entry(self, entry):
+		try:
+			self.get_record(entry)
+		except IOError:
+			return False
+		return True
+
+	def remove_entry(self, entry):
+		with self.loglock:
+			try:
+				self.get_record(entry)
+			except IOError, err:
+				raise OSError(err.errno, err.strerror, err.filename)
+			self.append([(DONE, entry.filename, "")])
+		return True
+
+	def rename_entry(self, entry, newentry):
+		with self.loglock:
+			try:
+				self.get_record(entry)
+			except IOError, err:
+				raise OSError(err.errno, err.strerror, err.filename)
+			self.append([(RENAME, newentry.filename, "")])
+		return True
+
+	def store_ingested(self, entry, recipient, message):
+		self.load()
+		if entry.entryid not in self.records:
+			self.commit_records([(ENQUEUE, entry.filename, "%s\n%s" % (recipient, message))])
+
+	def maintain_claims(self):
+		self.maybe_compact()
+
+	def maybe_compact(self):
+		"""Start compacting in the background if the oldest sealed segment
+		is worth it."""
+		with self.loglock:
+			if self.segments is None or (self.compactor is not None and self.compactor.is_alive()):
+				return
+			if not self.should_compact():
+				return
+			self.compactor = threading.Thread(target=self.compact, name="compaction")
+			self.compactor.daemon = True
+			self.compactor.start()
+
+	def should_compact(self):
+		"""
+		@rtype: bool
+		@returns: whether the oldest segment is sealed and at most half of
+			it needs to be copied
+		"""
+		oldest = min(self.segments)
+		live, total = self.segments[oldest]
+		return oldest != self.active and live * 2 <= total
+
+	def compact(self):
+		"""Main function of the compacting thread."""
+		try:
+			while True:
+				with self.loglock:
+					if not self.should_compact():
+						return
+					oldest = min(self.segments)
+					entryids = [candidate for candidate, located in self.records.items() if located[1] == oldest]
+				with open(self.get_segment_path(oldest), "rb") as segmentfile:
+					for entryid in entryids:
+						with self.loglock:
+							record = self.records.get(entryid)
+							if record is None or record[1] != oldest:
+								continue
+							segmentfile.seek(record[2])
+							self.append([(ENQUEUE, record[0], segmentfile.read(record[3]))])
+				with self.loglock:
+					# The copies must be durable before the originals
+					# vanish.
+					if self.durability_mode != durability.NONE:
+						os.fsync(self.activefd)
+					os.unlink(self.get_segment_path(oldest))
+					del self.segments[oldest]
+					if self.durability_mode != durability.NONE:
+						durability.fsync_path(self.logdir)
+					self.compactions += 1
+				logger.debug("compacted segment %s moving %d entries", self.get_segment_path(oldest), len(entryids))
+		except (IOError, OSError), err:
+			logger.error("compacting the log failed: %s", str(err))
+
+	def stats(self):
+		stats = queue.IngestingQueue.stats(self)
+		with self.loglock:
+			if self.segments is not None:
+				stats.update(segments=len(self.segments), live_entries=len(self.records), compactions=self.compactions)
+		return stats
@@ -1,72 +1,219 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import ctypes
 import errno
+import fcntl
+import os
 import signal
 import select
-import time
+import struct
+
+import errors
+
+
+def ignore_notice(_=None):
+	pass
+
+
+class WakeupPipe(object):
+	"""A pipe that allows other threads to interrupt a select call of the
+	main thread."""
+	def __init__(self):
+		self.readfd, self.writefd = os.pipe()
+		for fd in (self.readfd, self.writefd):
+			flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+			fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+	def wakeup(self):
+		try:
+			os.write(self.writefd, "\0")
+		except OSError, err:
+			if err.errno != errno.EAGAIN:  # pipe full, wakeup pending anyway
+				raise
+
+	def drain(self):
+		try:
+			while os.read(self.readfd, 4096):
+				pass
+		except OSError, err:
+			if err.errno != errno.EAGAIN:
+				raise
+
+
+def select_read(fds, maxwait):
+	"""Wait for any of the given fds to become readable.
+
+	@type fds: [int]
+	@type maxwait: float or None
+	@rtype: [int]
+	@returns: the readable fds. Empty on timeout or when interrupted by a
+		signal.
+	"""
+	try:
+		rlist, _, _ = select.select(fds, [], [], maxwait)
+		return rlist
+	except select.error, err:
+		if err[0] == errno.EINTR:
+			return []
+		raise
 
 
 class SignalDirectoryWatcher(object):
-	def __init__(self, _, maxwaittime=3600):
+	def __init__(self, _, maxwaittime=3600, notice=ignore_notice):
+		"""
+		@type notice: str or None -> None
+		@param notice: called with None after a signal indicated that the
+			directory has changed
+		"""
 		self.maxwaittime = maxwaittime
+		self.notice = notice
+		self.signalled = False
+		self.wakeuppipe = WakeupPipe()
 		signal.signal(signal.SIGUSR1, self.process_signal)
 
 	def process_signal(self, signum, stackframe):
-		pass  # handling signal to interrupt the sleep
+		# The signal interrupts the sleep. Processing happens outside of
+		# the signal handler.
+		self.signalled = True
+
+	def wakeup(self):
+		"""Interrupt a concurrent call of this watcher. Can be called
+		from any thread."""
+		self.wakeuppipe.wakeup()
 
 	def __call__(self, maxwait=None):
 		if maxwait is None:
 			maxwait = self.maxwaittime
 		else:
 			maxwait = min(maxwait, self.maxwaittime)
-		time.sleep(maxwait)  # interrupted by signal
+		if not self.signalled:
+			if select_read([self.wakeuppipe.readfd], maxwait):  # interrupted by signal
+				self.wakeuppipe.drain()
+		if self.signalled:
+			self.signalled = False
+			self.notice(None)
 
-try:
-	import pyinotify
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 02000000
+IN_NONBLOCK = 04000
+# struct inotify_event without the trailing name
+EVENT_HEADER = struct.Struct("iIII")
 
-	def dummy_signal(signum, stackframe):
-		pass
 
-	class InotifyDirectoryWatcher(object):
-		class IgnoreEvent(pyinotify.ProcessEvent):  # pylint:disable=R0903
-			def __init__(self):
-				pyinotify.ProcessEvent.__init__(self)
+def load_inotify():
+	"""
+	@rtype: (function, function) or None
+	@returns: inotify_init1 and inotify_add_watch of the C library
+	"""
+	try:
+		libc = ctypes.CDLL(None, use_errno=True)
+		inotify_init1, inotify_add_watch = libc.inotify_init1, libc.inotify_add_watch
+	except (OSError, AttributeError):
+		return None
+	inotify_init1.argtypes = [ctypes.c_int]
+	inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+	return inotify_init1, inotify_add_watch
 
-			def process_default(self, event):
-				pass
+_inotify = load_inotify()
+HAS_INOTIFY = _inotify is not None and hasattr(select, "epoll")
 
-		def __init__(self, directory):
-			self.watchmanager = pyinotify.WatchManager()
-			try:
-				self.watchmanager.add_watch(directory, pyinotify.EventsCodes.IN_MOVED_TO)
-			except AttributeError:
-				self.watchmanager.add_watch(directory, pyinotify.IN_MOVED_TO)
-			signal.signal(signal.SIGUSR1, dummy_signal)
-			self.notifier = pyinotify.Notifier(self.watchmanager, InotifyDirectoryWatcher.IgnoreEvent())
-
-		def notifier_check_events_hack(self, maxwait=None):
-			"""Hack around limitations of Notifier.check_events.
-
-			I'd like check_events to terminate when a signal is
-			received. This is not possible with the current interface,
-			so this method monkey patches Notifier."""
-			fd = self.notifier._fd  # pylint:disable=W0212
-			if maxwait is not None:
-				maxwait /= 1000.  # convert milliseconds back to seconds
-			try:
-				rlist, _, _ = select.select([fd], [], [], maxwait)
-				return fd in rlist
-			except select.error, err:
-				if err[0] == errno.EINTR:
-					return False
-				raise
 
-		def __call__(self, maxwait=None):
-			if maxwait is not None:
-				maxwait *= 1000  # milliseconds
-			if self.notifier_check_events_hack(maxwait):  # select/poll
-				self.notifier.read_events()  # nonblocking read
-				self.notifier.process_events()  # clean queue
-except:
+def parse_events(data):
+	"""
+	@type data: str
+	@param data: inotify events as read from an inotify descriptor
+	@rtype: gen([(int, str)])
+	@returns: (mask, name) of each event
+	"""
+	offset = 0
+	while offset + EVENT_HEADER.size <= len(data):
+		_, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+		offset += EVENT_HEADER.size
+		yield mask, data[offset:offset + length].rstrip("\0")
+		offset += length
+
+
+def dummy_signal(signum, stackframe):
 	pass
+
+
+class InotifyDirectoryWatcher(object):
+	"""Watch a directory for files moved into it using inotify and
+	epoll. All events available when the watcher wakes up are processed
+	together: each filename is passed to notice once and an overflow of
+	the kernel event queue results in a single notice(None).
+	"""
+	def __init__(self, directory, notice=ignore_notice):
+		"""
+		@type notice: str or None -> None
+		@param notice: called with the name of each file moved into
+			the directory or None if events were lost
+		@raises PyNotifyDError:
+		"""
+		if not HAS_INOTIFY:
+			raise errors.PyNotifyDError("inotify is not available")
+		self.notice = notice
+		inotify_init1, inotify_add_watch = _inotify
+		self.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			raise errors.PyNotifyDError("inotify_init1 failed: %s" % os.strerror(ctypes.get_errno()))
+		if inotify_add_watch(self.fd, directory, IN_MOVED_TO) < 0:
+			error = ctypes.get_errno()
+			os.close(self.fd)
+			raise errors.PyNotifyDError("failed to watch %s: %s" % (directory, os.strerror(error)))
+		signal.signal(signal.SIGUSR1, dummy_signal)
+		self.wakeuppipe = WakeupPipe()
+		self.epoll = select.epoll()
+		self.epoll.register(self.fd, select.EPOLLIN)
+		self.epoll.register(self.wakeuppipe.readfd, select.EPOLLIN)
+
+	def wakeup(self):
+		"""Interrupt a concurrent call of this watcher. Can be called
+		from any thread."""
+		self.wakeuppipe.wakeup()
+
+	def read_events(self):
+		"""Read all pending events without blocking.
+
+		@rtype: [(int, str)]
+		@returns: (mask, name) of each event
+		"""
+		events = []
+		while True:
+			try:
+				data = os.read(self.fd, 65536)
+			except OSError, err:
+				if err.errno == errno.EINTR:
+					continue
+				if err.errno != errno.EAGAIN:
+					raise
+				return events
+			events.extend(parse_events(data))
+
+	def process_events(self):
+		names = []
+		seen = set()
+		for mask, name in self.read_events():
+			if mask & IN_Q_OVERFLOW:
+				# The rescan finds all files anyway.
+				self.notice(None)
+				return
+			if mask & IN_MOVED_TO and name not in seen:
+				seen.add(name)
+				names.append(name)
+		for name in names:
+			self.notice(name)
+
+	def __call__(self, maxwait=None):
+		try:
+			ready = [fd for fd, _ in self.epoll.poll(-1 if maxwait is None else maxwait)]
+		except IOError, err:
+			if err.errno == errno.EINTR:  # interrupted by signal
+				return
+			raise
+		if self.wakeuppipe.readfd in ready:
+			self.wakeuppipe.drain()
+		if self.fd in ready:
+			self.process_events()
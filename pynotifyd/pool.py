@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides a DeliveryPool delivering queue entries using
+multiple threads concurrently.
+"""
+
+from __future__ import with_statement
+import heapq
+import logging
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+import queue
+
+logger = logging.getLogger("pynotifyd.pool")
+
+
+class Bulkhead(object):
+	"""Limits the number of concurrent deliveries using one provider and
+	keeps the entries waiting for a free slot. A stalled provider thereby
+	only blocks its own slots and never occupies workers needed by other
+	providers.
+
+	@type limit: int or None
+	@ivar limit: maximum number of concurrent deliveries. None means
+		unlimited.
+	@type pending: [(int, int, QueueEntry, float)]
+	@ivar pending: heap of claimed entries waiting for a free slot as
+		(negated priority, sequence number, entry, time they started
+		waiting), so higher priorities leave first and equal priorities
+		in order of arrival
+	@type inflight: int
+	@ivar inflight: number of deliveries currently running
+	@type peak: int
+	@ivar peak: maximum value of inflight observed
+	@type started: int
+	@ivar started: number of deliveries started. A delivery may comprise
+		multiple entries.
+	@type waittime: float
+	@ivar waittime: accumulated seconds entries spent in pending
+	@type maxwaittime: float
+	@ivar maxwaittime: maximum seconds an entry spent in pending
+	"""
+	def __init__(self, name, limit=None):
+		"""
+		@type name: str
+		@type limit: int or None
+		"""
+		self.name = name
+		self.limit = limit
+		self.pending = []
+		self.sequence = 0
+		self.inflight = 0
+		self.peak = 0
+		self.started = 0
+		self.waittime = 0.
+		self.maxwaittime = 0.
+
+	def has_capacity(self):
+		"""
+		@rtype: bool
+		"""
+		return self.limit is None or self.inflight < self.limit
+
+	def room(self, idle, batchsize):
+		"""
+		@type idle: int
+		@param idle: number of idle workers
+		@type batchsize: int
+		@rtype: int
+		@returns: number of entries that can be added to pending without
+			waiting for a running delivery to finish
+		"""
+		slots = idle if self.limit is None else min(idle, self.limit - self.inflight)
+		return max(0, slots * batchsize - len(self.pending))
+
+	def put(self, entry):
+		"""Add a claimed entry to the pending entries.
+		@type entry: QueueEntry
+		"""
+		heapq.heappush(self.pending, (-entry.priority, self.sequence, entry, time.time()))
+		self.sequence += 1
+
+	def start(self, count=1):
+		"""Take up to count pending entries and occupy a slot for
+		delivering them.
+
+		@type count: int
+		@rtype: [QueueEntry]
+		"""
+		entries = []
+		now = time.time()
+		while self.pending and len(entries) < count:
+			_, _, entry, since = heapq.heappop(self.pending)
+			waited = now - since
+			self.waittime += waited
+			self.maxwaittime = max(self.maxwaittime, waited)
+			entries.append(entry)
+		self.started += 1
+		self.inflight += 1
+		self.peak = max(self.peak, self.inflight)
+		return entries
+
+	def finish(self):
+		"""Free the slot occupied by a finished delivery."""
+		self.inflight -= 1
+
+	def stats(self):
+		"""
+		@rtype: {str: int or float or None}
+		"""
+		return dict(limit=self.limit, inflight=self.inflight, peak=self.peak, pending=len(self.pending), started=self.started, waittime=self.waittime, maxwaittime=self.maxwaittime)
+
+
+class DeliveryPool(object):
+	"""Deliver entries of a PersistentQueue using a number of worker
+	threads. The main thread claims ready entries from the queue using
+	L{dispatch}, sorts them into one L{Bulkhead} per provider and hands
+	them to idle workers as far as the provider limits permit. Only as
+	many entries are claimed as the bulkheads can start right away. Each
+	worker delivers up to batchsize entries of one provider at once. Claimed
+	entries cannot be claimed again until their delivery is finished, so
+	no entry is delivered twice.
+
+	@type idle: int
+	@ivar idle: number of workers not delivering an entry. Protected by
+		idlelock.
+	@type bulkheads: {str: Bulkhead}
+	@ivar bulkheads: maps provider names to their bulkheads. Protected by
+		idlelock.
+	"""
+	def __init__(self, config, persistentqueue, providers, workers, wakeup, batchsize=1):
+		"""
+		@type config: configobj.ConfigObj
+		@type persistentqueue: queue.PersistentQueue
+		@type providers: {str: ProviderBase}
+		@type workers: int
+		@param workers: number of worker threads
+		@type wakeup: () -> None
+		@param wakeup: called from a worker thread after finishing a
+			delivery to interrupt the sleep of the main thread
+		@type batchsize: int
+		@param batchsize: maximum number of entries passed to a worker
+		"""
+		self.config = config
+		self.queue = persistentqueue
+		self.providers = providers
+		self.wakeup = wakeup
+		self.batchsize = batchsize
+		self.tasks = Queue.Queue()
+		self.idle = workers
+		self.idlelock = threading.Lock()
+		self.bulkheads = dict((name, Bulkhead(name, section["concurrency"])) for name, section in config["providers"].items())
+		self.threads = []
+		for number in range(workers):
+			thread = threading.Thread(target=self.work, name="delivery-%d" % number)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def work(self):
+		"""Main function of the worker threads."""
+		while True:
+			task = self.tasks.get()
+			if task is None:
+				return
+			bulkhead, entries = task
+			try:
+				queue.deliver_group(self.config, self.queue, self.providers, bulkhead.name, entries)
+			except Exception, exc:
+				for line in traceback.format_exc(sys.exc_info()[2]).splitlines():
+					logger.warn(line)
+				logger.error("processing of %d entries using %s failed with %s: %s", len(entries), bulkhead.name, exc.__class__.__name__, str(exc))
+				self.postpone(entries)
+			finally:
+				for entry in entries:
+					self.queue.release(entry)
+				with self.idlelock:
+					bulkhead.finish()
+					self.idle += 1
+				self.wakeup()
+
+	def postpone(self, entries):
+		"""Advance the entries still claimed after processing them failed
+		unexpectedly, as if their delivery failed temporarily. Releasing
+		them right away would make the main thread retry them over and
+		over.
+
+		@type entries: [QueueEntry]
+		"""
+		with self.queue.indexlock:
+			unfinished = [candidate for candidate in entries if candidate.filename in self.queue.claimed]
+		for entry in unfinished:
+			try:
+				self.queue.entry_next(entry)
+			except Exception, exc:
+				logger.error("failed to postpone entry %s: %s", str(entry), str(exc))
+
+	def dispatch(self):
+		"""Hand ready entries to idle workers.
+
+		@rtype: float or None
+		@returns: None if there is nothing to do until a worker finishes
+			or the queue changes, number of seconds to sleep before
+			calling this function again otherwise
+		"""
+		with self.idlelock:
+			room = dict((name, bulkhead.room(self.idle, self.batchsize)) for name, bulkhead in self.bulkheads.items())
+		giveup = []
+		overflow = []
+		try:
+			# Entries for full bulkheads are skipped, but only as many as
+			# could be dispatched, which bounds the work of each call.
+			while any(room.values()) and len(overflow) < sum(room.values()):
+				entry = self.queue.claim_next()
+				if entry is None:
+					break
+				providername = self.queue.get_state(entry)
+				if providername not in self.bulkheads:  # GIVEUP
+					giveup.append(entry)
+				elif room[providername]:
+					room[providername] -= 1
+					with self.idlelock:
+						self.bulkheads[providername].put(entry)
+				else:
+					overflow.append(entry)
+		finally:
+			for entry in overflow:
+				self.queue.release(entry)
+		if giveup:
+			queue.deliver_group(self.config, self.queue, self.providers, "GIVEUP", giveup)
+		with self.idlelock:
+			for bulkhead in self.bulkheads.values():
+				while self.idle and bulkhead.pending and bulkhead.has_capacity():
+					entries = bulkhead.start(self.batchsize)
+					self.idle -= 1
+					logger.debug("dispatching %d entries to %s", len(entries), bulkhead.name)
+					self.tasks.put((bulkhead, entries))
+		entry = self.queue.find_next()
+		if entry is None:
+			return None
+		# Ready entries left in the queue wait for a worker to finish.
+		return self.queue.sleep_duration(entry) or None
+
+	def stats(self):
+		"""
+		@rtype: {str: {str: int or float or None}}
+		@returns: maps provider names to the statistics of their bulkheads
+		"""
+		with self.idlelock:
+			return dict((name, bulkhead.stats()) for name, bulkhead in self.bulkheads.items())
+
+	def shutdown(self):
+		"""Wait for running deliveries to finish and stop all workers.
+		Entries still waiting for a provider slot are returned to the
+		queue."""
+		for _ in self.threads:
+			self.tasks.put(None)
+		for thread in self.threads:
+			thread.join()
+		for bulkhead in self.bulkheads.values():
+			while bulkhead.pending:
+				self.queue.release(heapq.heappop(bulkhead.pending)[2])
@@ -5,16 +5,20 @@ and fault tolerant lock files.
 """
 
 import errno
+import fcntl
 import os
 import time
 
+FLOCK_SUFFIX = ".flock"
+
 
 class ProcessLock(object):
-	"""This is a locking mechanism for processes. It uses the fact that
-	creation of symbolic links is atomic. To acquire a lock the current
-	process id is symlinked to a fixed filename. This is probably a
-	dead link. Using the pid from the link stale locks (where
-	corresponding process died) can be automatically cleaned. By
+	"""This is a locking mechanism for processes. The lock is an flock on
+	a regular file next to filename. The kernel releases it when the
+	owning process dies, so stale locks need no detection and waiting
+	processes take over immediately. While holding the lock the owner
+	points a symbolic link at filename to its process id, so other tools
+	can find it using readlink. The link is replaced by each new owner. By
 	default this class will also clean up the lock automatically on
 	destruction (__del__).
 	"""
@@ -28,6 +32,7 @@ class ProcessLock(object):
 		self.filename = filename
 		self.mypid = os.getpid()
 		self.autorelease = autorelease
+		self.flockfd = None
 
 	def getowner(self):
 		"""Return the pid of the process owning the lock.
@@ -43,54 +48,81 @@ class ProcessLock(object):
 		except ValueError:
 			return None
 
-	def tryacquire(self, handlestale=True):  # pylint: disable=R0911
+	def lockfile(self, blocking):
 		"""
-		@type handlestale: bool
-		@param handlestale: Whether to clean locks that correspond to
-				non-existant pids.
+		@type blocking: bool
+		@param blocking: whether to wait for the current owner to release
+				the lock
 		@rtype: bool
 		"""
 		try:
-			os.symlink("%d" % self.mypid, self.filename)
-			return True
-		except OSError, err:  # ENOENT, EEXIST, ...
-			if err.errno != errno.EEXIST or not handlestale:
-				return False
-		# self.filename exists
-		otherpid = self.getowner()
-		if otherpid is None:
-			return False
-		# otherpid is a number
-		try:
-			os.kill(otherpid, 0)
+			fd = os.open(self.filename + FLOCK_SUFFIX, os.O_RDWR | os.O_CREAT, 0644)
+		except OSError:
 			return False
-		except OSError, err:  # ESRCH, EPERM, ...
-			if err.errno != errno.ESRCH:
+		# Children must not keep the lock alive after we died.
+		fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+		while True:
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+				break
+			except IOError, err:
+				if err.errno == errno.EINTR:
+					continue
+				os.close(fd)
 				return False
-		# otherpid is a non-existant pid => stale lock
+		self.flockfd = fd
+		return True
+
+	def takeover(self):
+		"""Point the symbolic link to the current pid. Must only be called
+		while holding the flock.
+		@rtype: bool
+		"""
+		tmpname = "%s.%d" % (self.filename, self.mypid)
 		try:
-			os.unlink(self.filename)
+			try:
+				os.unlink(tmpname)
+			except OSError, err:
+				if err.errno != errno.ENOENT:
+					raise
+			os.symlink("%d" % self.mypid, tmpname)
+			os.rename(tmpname, self.filename)
 		except OSError:
+			self.unlockfile()
 			return False
-		return self.tryacquire()
+		return True
 
-	def acquire(self, maxwait=None, interval=5, handlestale=True):
+	def unlockfile(self):
+		if self.flockfd is not None:
+			os.close(self.flockfd)
+			self.flockfd = None
+
+	def tryacquire(self):
+		"""
+		@rtype: bool
+		"""
+		if self.flockfd is not None:
+			return True
+		return self.lockfile(False) and self.takeover()
+
+	def acquire(self, maxwait=None, interval=0.1):
 		"""
-		@type maxwait: int or None
+		@type maxwait: float or None
 		@param maxwait: maximum number of seconds to wait for the lock
 				and None means infinity
-		@type interval: int
-		@param interval: try locking every interval seconds
-		@type handlestale: bool
-		@param handlestale: Whether to clean locks that correspond to
-				non-existant pids.
+		@type interval: float
+		@param interval: try locking every interval seconds if maxwait
+				is given. Otherwise the kernel wakes us up as soon as
+				the lock is released.
 		@rtype: bool
 		"""
-		if maxwait is not None:
-			maxwait += time.time()
-		while maxwait is None or time.time() < maxwait:
-			result = self.tryacquire(handlestale)
-			if result:
+		if self.flockfd is not None:
+			return True
+		if maxwait is None:
+			return self.lockfile(True) and self.takeover()
+		maxwait += time.time()
+		while time.time() < maxwait:
+			if self.tryacquire():
 				return True
 			time.sleep(interval)
 		return False
@@ -98,17 +130,22 @@ class ProcessLock(object):
 	def release(self, force=False):
 		"""
 		@type force: bool
-		@param force: whether to force cleaning the lock even if it got
-				tampered with (pid changed, etc.)
+		@param force: whether to force cleaning the symbolic link even if
+				it got tampered with (pid changed, etc.)
 		@rtype: bool
 		"""
-		if (not force) and self.mypid != self.getowner():
+		if self.flockfd is None and not force:
 			return False
-		try:
-			os.unlink(self.filename)
-		except OSError:
-			return False
-		return True
+		# Remove the link before unlocking, so that it never removes
+		# the link of the next owner.
+		result = True
+		if force or self.mypid == self.getowner():
+			try:
+				os.unlink(self.filename)
+			except OSError:
+				result = False
+		self.unlockfile()
+		return result
 
 	def __del__(self):
 		if self.autorelease:
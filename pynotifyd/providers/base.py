@@ -1,10 +1,206 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from __future__ import with_statement
+import logging
+import socket
+import sys
+import threading
+import time
+import traceback
+
 from .. import errors
+from .. import health
+
+logger = logging.getLogger("pynotifyd.providers.base")
+
+# Seconds granted on top of the provider timeouts before a delivery is
+# abandoned, so providers enforcing their timeouts report them first.
+DEADLINE_GRACE = 5
+
+
+class DeadlineExceeded(errors.PyNotifyDTemporaryError):
+	"""A call did not return in time and was abandoned."""
+	pass
+
+
+def capture_failure(function, *args):
+	"""Call the given function and return the exception it raised.
+	Socket timeouts are converted to PyNotifyDTemporaryError. Tracebacks
+	of other exceptions than PyNotifyDError are logged.
+
+	@rtype: None or Exception
+	@returns: None if the function returned normally
+	"""
+	try:
+		function(*args)
+	except errors.PyNotifyDError, err:
+		return err
+	except socket.timeout, exc:
+		return errors.PyNotifyDTemporaryError("delivery timed out: %s" % str(exc))
+	except Exception, exc:
+		for line in traceback.format_exc(sys.exc_info()[2]).splitlines():
+			logger.warn(line)
+		return exc
+	return None
+
+
+def parse_number(config, key, default, convert=float, minimum=None):
+	"""Read an optional number from a provider configuration.
+
+	@type config: dict-like
+	@type key: str
+	@type default: object
+	@param default: returned if the option is not given
+	@type convert: type
+	@type minimum: int or float or None
+	@param minimum: smallest permitted value. None requires a positive
+		number.
+	@raises PyNotifyDConfigurationError:
+	"""
+	value = config.get(key)
+	if value is None:
+		return default
+	try:
+		value = convert(value)
+	except (TypeError, ValueError):
+		raise errors.PyNotifyDConfigurationError("%s config option requires a number" % key)
+	if minimum is None and value <= 0:
+		raise errors.PyNotifyDConfigurationError("%s config option must be positive" % key)
+	if minimum is not None and value < minimum:
+		raise errors.PyNotifyDConfigurationError("%s config option must be at least %s" % (key, minimum))
+	return value
+
+
+def call_with_deadline(timeout, function, *args):
+	"""Call function in a helper thread and wait at most timeout seconds
+	for it to return. This bounds the time spent in libraries that do not
+	support timeouts themselves. After an overrun the helper thread is
+	abandoned and finishes in the background.
+
+	@type timeout: float
+	@returns: the value returned by function
+	@raises DeadlineExceeded: if the timeout expired
+	"""
+	outcome = []
+
+	def run():
+		try:
+			outcome.append((True, function(*args)))
+		except Exception:
+			outcome.append((False, sys.exc_info()))
+
+	thread = threading.Thread(target=run, name="deadline-%s" % getattr(function, "__name__", "call"))
+	thread.daemon = True
+	thread.start()
+	thread.join(timeout)
+	if not outcome:
+		raise DeadlineExceeded("delivery did not finish within %s seconds" % timeout)
+	success, value = outcome[0]
+	if success:
+		return value
+	raise value[0], value[1], value[2]
+
+
+class ConnectionPool(object):
+	"""Keeps idle connections for reuse by multiple threads.
+
+	Connections idle for longer than idle_timeout are closed instead of
+	being reused. Connections idle for longer than check_after are passed
+	to the check function before being reused.
+	"""
+	def __init__(self, connect, close, check=None, idle_timeout=60, check_after=5):
+		"""
+		@type connect: () -> connection
+		@param connect: creates a new connection
+		@type close: connection -> None
+		@param close: closes a connection. Must not raise exceptions.
+		@type check: None or connection -> bool
+		@param check: returns whether a connection is still usable
+		@type idle_timeout: float
+		@type check_after: float
+		"""
+		self.connect = connect
+		self.close = close
+		self.check = check
+		self.idle_timeout = idle_timeout
+		self.check_after = check_after
+		self.idle = []
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		"""Return an idle connection or create a new one.
+
+		@rtype: (connection, bool)
+		@returns: (connection, reused)
+		"""
+		while True:
+			with self.lock:
+				if not self.idle:
+					break
+				connection, since = self.idle.pop()
+			idletime = time.time() - since
+			if idletime > self.idle_timeout:
+				self.close(connection)
+			elif self.check is not None and idletime > self.check_after and not self.check(connection):
+				self.close(connection)
+			else:
+				return connection, True
+		return self.connect(), False
+
+	def release(self, connection):
+		"""Return a usable connection to the pool.
+		@type connection: connection
+		"""
+		with self.lock:
+			self.idle.append((connection, time.time()))
+
+	def discard(self, connection):
+		"""Close a connection that is no longer usable.
+		@type connection: connection
+		"""
+		self.close(connection)
+
+	def clear(self):
+		"""Close all idle connections."""
+		with self.lock:
+			idle, self.idle = self.idle, []
+		for connection, _ in idle:
+			self.close(connection)
 
 
 class ProviderBase(object):
+	"""Base class for all providers.
+
+	Optional configuration options for all providers:
+		- timeout: Maximum number of seconds a single delivery may take.
+			Deliveries exceeding it fail with a temporary error. The
+			default depends on the provider.
+		- breaker_threshold: Failure rate between 0 and 1 opening the
+			circuit breaker. While the circuit is open, deliveries skip
+			this provider. (Default: never open)
+		- breaker_window: Number of seconds deliveries are considered for
+			the failure rate. (Default: 300)
+		- breaker_min_calls: Minimum number of deliveries within the
+			window before the circuit may open. (Default: 5)
+		- breaker_cooldown: Number of seconds the circuit stays open
+			before a probe delivery is attempted. (Default: 60)
+
+	@type health: health.CircuitBreaker
+	"""
+	timeout = 60
+
+	def __init__(self, config):
+		"""
+		@type config: dict-like
+		@raises PyNotifyDConfigurationError:
+		"""
+		self.timeout = parse_number(config, "timeout", self.timeout)
+		threshold = parse_number(config, "breaker_threshold", None, minimum=0)
+		if threshold is not None and threshold > 1:
+			raise errors.PyNotifyDConfigurationError("breaker_threshold must be a rate between 0 and 1")
+		self.health = health.CircuitBreaker(getattr(config, "name", self.__class__.__name__), threshold, parse_number(config, "breaker_window", 300), parse_number(config, "breaker_min_calls", 5, int, minimum=0), parse_number(config, "breaker_cooldown", 60, minimum=0))
+
 	def send_message(self, recipient, message):
 		"""This virtual function is to be overridden by provider
 		implementations.
@@ -15,6 +211,40 @@ class ProviderBase(object):
 		"""
 		raise NotImplementedError
 
+	def get_length_limit(self):
+		"""
+		@rtype: int or None
+		@returns: the maximum length of a message or None if unlimited.
+			Aggregated messages are packed to fit this limit.
+		"""
+		return None
+
+	def call_bounded(self, function, *args):
+		"""Call function with the deadline of a single delivery, which is
+		the timeout plus DEADLINE_GRACE. Providers must not share state
+		with an abandoned call, which keeps running in the background.
+
+		@returns: the value returned by function
+		@raises DeadlineExceeded: if the deadline passed
+		"""
+		return call_with_deadline(self.timeout + DEADLINE_GRACE, function, *args)
+
+	def send_messages(self, batch):
+		"""Send multiple messages. Providers can override this method to
+		share connections or sessions among the messages. Each delivery
+		must be bounded, using call_bounded if the provider cannot
+		enforce its timeout itself. The default implementation calls
+		send_message for each item using call_bounded.
+
+		@type batch: [({str: str}, str)]
+		@param batch: list of (recipient, message)
+		@rtype: [None or Exception]
+		@returns: for each item None on success or the exception that
+			caused the delivery to fail. PyNotifyDPermanentError and
+			PyNotifyDTemporaryError have their usual meaning.
+		"""
+		return [capture_failure(self.call_bounded, self.send_message, recipient, message) for recipient, message in batch]
+
 	def terminate(self):
 		"""This virtual function is called during shutdown and can be
 		overridden by provider instances to free up resources."""
@@ -35,6 +265,7 @@ class SMSProviderBase(ProviderBase):
 	maxsmslength = 160
 
 	def __init__(self, config):
+		ProviderBase.__init__(self, config)
 		try:
 			maxsmslength = config["maxsmslength"]
 			self.maxsmslength = int(maxsmslength)
@@ -43,6 +274,9 @@ class SMSProviderBase(ProviderBase):
 		except ValueError:
 			raise errors.PyNotifyDConfigurationError("maxsmslength config option  requires an integer parameter")
 
+	def get_length_limit(self):
+		return self.maxsmslength
+
 	def send_sms(self, phone, message):
 		"""This virtual function is to be overridden by sms proivder
 		implementations.
@@ -53,10 +287,22 @@ class SMSProviderBase(ProviderBase):
 		"""
 		raise NotImplementedError
 
-	def send_message(self, recipient, message):
+	def prepare_sms(self, recipient, message):
+		"""Extract the phone number of the recipient and truncate the
+		message.
+
+		@type recipient: {str: str}
+		@type message: str
+		@rtype: (str, str)
+		@returns: (phone, message)
+		@raises PyNotifyDConfigurationError:
+		"""
 		try:
 			phone = recipient["phone"]
 		except KeyError:
 			raise errors.PyNotifyDConfigurationError("missing phone on contact")
-		message = message[:self.maxsmslength]
+		return phone, message[:self.maxsmslength]
+
+	def send_message(self, recipient, message):
+		phone, message = self.prepare_sms(recipient, message)
 		self.send_sms(phone, message)
@@ -2,9 +2,13 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import with_statement
-import contextlib
+import base64
 import httplib
 import json
+import socket
+import ssl
+import threading
+import time
 import urllib
 
 from .. import errors
@@ -12,6 +16,11 @@ from .. import errors
 import base
 
 
+class TokenRejected(errors.PyNotifyDTemporaryError):
+	"""The server did not accept the token used for the request."""
+	pass
+
+
 class ProviderDevelopergarden(base.SMSProviderBase):
 	"""Send sms via http://www.developergarden.com using the rest
 	interface.
@@ -24,6 +33,20 @@ class ProviderDevelopergarden(base.SMSProviderBase):
 		- suite: one out of production, mock or sandbox.
 		- sender: a phone number used for sending. It must be validated
 			by the Developergarden service.
+		- timeout: Number of seconds to wait for the servers.
+			Default: 30
+		- token_lifetime: Number of seconds a token is reused. It is
+			refreshed after 90% of this time. Default: 3600
+		- idle_timeout: Close connections not used for this number of
+			seconds. Default: 60
+		- tokenserver, smsserver: Override the servers (host or
+			host:port) contacted. Useful for testing.
+		- cafile: Verify the servers using the certificates in this
+			file instead of the system defaults. Requires Python 2.7.9
+			or later.
+
+	Tokens are cached and HTTPS connections are kept open, so sending
+	messages usually does not require any new TLS handshakes.
 
 	See also L{SMSProviderBase}.
 	"""
@@ -39,6 +62,7 @@ class ProviderDevelopergarden(base.SMSProviderBase):
 	getbalancetemplate = "/p3gw-mod-odg-admin/rest/%s/account/balance"  # page 109
 	maxsmslength = 765  # page 81
 	maxreplysize = 65536
+	timeout = 30
 
 	def __init__(self, config):
 		"""
@@ -57,6 +81,57 @@ class ProviderDevelopergarden(base.SMSProviderBase):
 			raise errors.PyNotifyDConfigurationError("invalid suite")
 		self.suite = suite
 		self.sender = config.get("sender")
+		self.tokenserver = config.get("tokenserver", self.tokenserver)
+		self.smsserver = config.get("smsserver", self.smsserver)
+		self.token_lifetime = base.parse_number(config, "token_lifetime", 3600)
+		idle_timeout = base.parse_number(config, "idle_timeout", 60)
+		self.sslcontext = None
+		if "cafile" in config:
+			if not hasattr(ssl, "create_default_context"):
+				raise errors.PyNotifyDConfigurationError("cafile requires Python 2.7.9 or later")
+			self.sslcontext = ssl.create_default_context(cafile=config["cafile"])
+		self.pools = dict((server, base.ConnectionPool(self.make_connection_factory(server), httplib.HTTPSConnection.close, idle_timeout=idle_timeout)) for server in (self.tokenserver, self.smsserver))
+		self.token = None
+		self.token_refresh = 0
+		self.token_lock = threading.Lock()
+
+	def make_connection_factory(self, server):
+		"""
+		@type server: str
+		@rtype: () -> httplib.HTTPSConnection
+		"""
+		def connect():
+			if self.sslcontext is None:
+				return httplib.HTTPSConnection(server, timeout=self.timeout)
+			return httplib.HTTPSConnection(server, timeout=self.timeout, context=self.sslcontext)
+		return connect
+
+	def perform_request(self, server, method, path, headers, body):  # pylint:disable=R0913
+		"""Perform a request using a pooled connection. A reused
+		connection that turns out to be broken is replaced once.
+
+		@rtype: (httplib.HTTPResponse, str)
+		@returns: (response, data)
+		@raises httplib.HTTPException:
+		@raises socket.error:
+		"""
+		pool = self.pools[server]
+		while True:
+			connection, reused = pool.acquire()
+			try:
+				connection.request(method, path, body, headers)
+				response = connection.getresponse()
+				data = response.read(self.maxreplysize+1)
+			except (httplib.HTTPException, socket.error):
+				pool.discard(connection)
+				if reused:
+					continue
+				raise
+			if response.will_close or not response.isclosed():
+				pool.discard(connection)
+			else:
+				pool.release(connection)
+			return response, data
 
 	def make_rest_request(self, server, method, path, headers, body):  # pylint:disable=R0913,R0914
 		"""
@@ -72,10 +147,10 @@ class ProviderDevelopergarden(base.SMSProviderBase):
 		realheaders = {"Accept": "text/plain", "Accept-Charset": "UTF-8"}
 		realheaders.update(headers)
 		try:
-			with contextlib.closing(httplib.HTTPSConnection(server)) as connection:
-				connection.request(method, path, body, realheaders)
-				response = connection.getresponse()
-				data = response.read(self.maxreplysize+1)
+			response, data = self.perform_request(server, method, path, realheaders, body)
+			if response.status == 401:
+				# The body of a rejection may be of any type.
+				return response.status, {}
 			if len(data) > self.maxreplysize:
 				raise errors.PyNotifyDTemporaryError("Response from Developergarden server %s is too long" % server)
 			ctype = response.msg.getheader("Content-Type")
@@ -104,6 +179,8 @@ class ProviderDevelopergarden(base.SMSProviderBase):
 			return response.status, answer
 		except httplib.HTTPException, exc:
 			raise errors.PyNotifyDTemporaryError("Received HTTPException during request to Developergarden server %s: %s" % (server, str(exc)))
+		except socket.error, exc:
+			raise errors.PyNotifyDTemporaryError("Connection to Developergarden server %s failed: %s" % (server, str(exc)))
 
 	def get_token(self):
 		"""
@@ -111,7 +188,7 @@ class ProviderDevelopergarden(base.SMSProviderBase):
 		@raises PyNotifyDTemporaryError:
 		"""
 		creds = "%s:%s" % (self.username, self.password)
-		creds = creds.encode("base64")
+		creds = base64.b64encode(creds)
 		headers = dict(Authorization="Basic %s" % creds)
 		status, answer = self.make_rest_request(self.tokenserver, "GET", self.tokenpath, headers, None)
 		if status != 200:
@@ -124,6 +201,41 @@ class ProviderDevelopergarden(base.SMSProviderBase):
 			raise errors.PyNotifyDTemporaryError("Received no token from Developergarden")
 		return answer["token"]
 
+	def get_cached_token(self):
+		"""Return a cached token or fetch a new one if the cached token
+		is about to expire.
+
+		@rtype: str
+		@raises PyNotifyDTemporaryError:
+		"""
+		with self.token_lock:
+			if self.token is None or time.time() >= self.token_refresh:
+				self.token = self.get_token()
+				self.token_refresh = time.time() + 0.9 * self.token_lifetime
+			return self.token
+
+	def invalidate_token(self, token):
+		"""Drop the given token from the cache.
+		@type token: str
+		"""
+		with self.token_lock:
+			if self.token == token:
+				self.token = None
+
+	def with_token(self, function, *args):
+		"""Call function with a cached token as first argument. If the
+		token is rejected, it is invalidated and the call is repeated
+		once with a new token.
+
+		@raises PyNotifyDError:
+		"""
+		token = self.get_cached_token()
+		try:
+			return function(token, *args)
+		except TokenRejected:
+			self.invalidate_token(token)
+		return function(self.get_cached_token(), *args)
+
 	def make_authorized_rest_request(self, path, token, params):
 		"""
 		@type path: str
@@ -135,6 +247,8 @@ class ProviderDevelopergarden(base.SMSProviderBase):
 		"""
 		headers = {"Authorization": 'TAuth realm="https://odg.t-online.de",tauth_token="%s"' % token, "Content-Type": "application/x-www-form-urlencoded"}
 		status, answer = self.make_rest_request(self.smsserver, "POST", path, headers, urllib.urlencode(params))
+		if status == 401:
+			raise TokenRejected("Developergarden sms server rejected token")
 		if "status.statusMessage" not in answer or not answer.get("status.statusCode", "nondigit").isdigit():
 			if status != 200:
 				raise errors.PyNotifyDTemporaryError("HTTP status from Developergarden sms server is %d" % status)
@@ -197,8 +311,29 @@ class ProviderDevelopergarden(base.SMSProviderBase):
 			if not value.isdigit():
 				raise errors.PyNotifyDTemporaryError("received non-number for credits or account id")
 			result[field] = int(value)
-		return [result for result in results.values() if len(result.keys()) == 2]
+		return [account for account in results.values() if len(account.keys()) == 2]
 
 	def send_sms(self, phone, message):
-		token = self.get_token()
+		self.with_token(self.initiate_send, phone, message)
+
+	def send_prepared_sms(self, token, recipient, message):
+		"""
+		@type token: str
+		@type recipient: {str: str}
+		@type message: str
+		@raises PyNotifyDError:
+		"""
+		phone, message = self.prepare_sms(recipient, message)
 		self.initiate_send(token, phone, message)
+
+	def send_messages(self, batch):
+		"""Send all messages using the cached token."""
+		try:
+			self.call_bounded(self.get_cached_token)
+		except errors.PyNotifyDError, err:
+			return [err] * len(batch)
+		return [base.capture_failure(self.call_bounded, self.with_token, self.send_prepared_sms, recipient, message) for recipient, message in batch]
+
+	def terminate(self):
+		for pool in self.pools.values():
+			pool.clear()
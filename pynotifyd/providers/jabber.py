@@ -14,49 +14,78 @@ import base_jabber
 from .. import errors
 
 
-class SendJabberClient(base_jabber.BaseJabberClient, object):  # pylint:disable=R0904
-	def __init__(self, jid, password, target, message, exclude_resources, include_states, tls_require=True, tls_verify_peer=False, cacert_file=None):  # pylint:disable=R0913
+class JabberDelivery(object):
+	"""A message to be sent by a SendJabberClient.
+
+	@type failure: None or PyNotifyDError
+	@ivar failure: None once the message was sent
+	"""
+	def __init__(self, target, message, exclude_resources, include_states):
 		"""
-		@type jid: pyxmpp.jid.JID
-		@type password: str
 		@type target: pyxmpp.jid.JID
 		@type message: str
 		@type exclude_resources: str -> bool
 		@type include_states: str -> bool
 		"""
-		base_jabber.BaseJabberClient.__init__(self, jid, password, tls_require=tls_require, tls_verify_peer=tls_verify_peer, cacert_file=cacert_file)
 		self.target = target
-		self.message = pyxmpp.message.Message(to_jid=self.target, body=message)
+		self.message = message
 		self.exclude_resources = exclude_resources
 		self.include_states = include_states
 		self.failure = errors.PyNotifyDTemporaryError("contact not available")
+
+	@property
+	def finished(self):
+		"""Whether waiting for further presence updates is useless.
+		@rtype: bool
+		"""
+		return self.failure is None or isinstance(self.failure, errors.PyNotifyDPermanentError)
+
+
+class SendJabberClient(base_jabber.BaseJabberClient, object):  # pylint:disable=R0904
+	def __init__(self, jid, password, deliveries, tls_require=True, tls_verify_peer=False, cacert_file=None):  # pylint:disable=R0913
+		"""
+		@type jid: pyxmpp.jid.JID
+		@type password: str
+		@type deliveries: [JabberDelivery]
+		"""
+		base_jabber.BaseJabberClient.__init__(self, jid, password, tls_require=tls_require, tls_verify_peer=tls_verify_peer, cacert_file=cacert_file)
+		self.deliveries = deliveries
 		self.isdisconnected = False
 
 	### Section: BaseJabberClient API methods
 	def handle_contact_available(self, jid, state):
-		if jid.bare() != self.target.bare():
-			return
-		if self.exclude_resources(jid.resource):
-			return
-		if not self.include_states(state):
-			return
-		self.stream.send(self.message)
-		self.failure = None
-		self.disconnect_once()
+		for delivery in self.deliveries:
+			if delivery.finished:
+				continue
+			if jid.bare() != delivery.target.bare():
+				continue
+			if delivery.exclude_resources(jid.resource):
+				continue
+			if not delivery.include_states(state):
+				continue
+			self.stream.send(pyxmpp.message.Message(to_jid=delivery.target, body=delivery.message))
+			delivery.failure = None
+		self.disconnect_when_finished()
 
 	### Section: pyxmpp JabberClient API methods
 	def roster_updated(self, item=None):
 		"""pyxmpp API method"""
 		if item is not None:
 			return
-		try:
-			self.roster.get_item_by_jid(self.target)
-		except KeyError:
-			self.failure = errors.PyNotifyDPermanentError("contact is not my roster")
-			# not on roster
-			self.disconnect_once()
+		for delivery in self.deliveries:
+			try:
+				self.roster.get_item_by_jid(delivery.target)
+			except KeyError:
+				# not on roster
+				delivery.failure = errors.PyNotifyDPermanentError("contact is not my roster")
+		self.disconnect_when_finished()
 
 	### Section: our own methods for controlling the JabberClient
+	def disconnect_when_finished(self):
+		"""Disconnect once no delivery awaits further presence updates."""
+		if all(delivery.finished for delivery in self.deliveries):
+			self.disconnect_once()
+
 	def disconnect_once(self):
 		"""Invoke disconnect on the first call of this method."""
 		if not self.isdisconnected:
@@ -65,7 +94,7 @@ class SendJabberClient(base_jabber.BaseJabberClient, object):  # pylint:disable=
 
 	def loop_timeout(self, timeout):
 		"""
-		@type timeout: int
+		@type timeout: float
 		"""
 		now = time.time()
 		deadline = now + timeout
@@ -82,7 +111,8 @@ class ProviderJabber(base.ProviderBase, object):
 	Required configuration options:
 		- jid: The jabber id used for sending the message.
 		- password: Password corresponding to the jid.
-		- timeout: Number of seconds to wait for presence updates.
+		- timeout: Number of seconds to connect and wait for presence
+			updates.
 
 	Required contact configuration options:
 		- jabber: The jabber id to send the message to.
@@ -98,15 +128,49 @@ class ProviderJabber(base.ProviderBase, object):
 		"""
 		@type config: dict-like
 		"""
+		if "timeout" not in config:
+			raise errors.PyNotifyDConfigurationError("timeout required")
+		base.ProviderBase.__init__(self, config)
 		self.jid = pyxmpp.jid.JID(config["jid"])
 		self.password = config["password"]
-		self.timeout = int(config["timeout"])
 
 	def send_message(self, recipient, message):
+		failure = self.send_messages([(recipient, message)])[0]
+		if failure is not None:
+			raise failure
+
+	def make_delivery(self, recipient, message):
+		"""
+		@type recipient: {str: str}
+		@type message: str
+		@rtype: JabberDelivery
+		@raises PyNotifyDConfigurationError:
+		"""
 		jid, exclude_resources, include_states = base_jabber.validate_recipient(recipient)
-		client = SendJabberClient(self.jid, self.password, jid, message, exclude_resources.__contains__, include_states.__contains__)
-		client.connect()
-		client.loop_timeout(self.timeout)
-		client.disconnect_once()
-		if client.failure:
-			raise client.failure
+		return JabberDelivery(jid, message, exclude_resources.__contains__, include_states.__contains__)
+
+	def send_messages(self, batch):
+		"""Send all messages using a single login."""
+		results = []
+		deliveries = []
+		for recipient, message in batch:
+			try:
+				delivery = self.make_delivery(recipient, message)
+			except errors.PyNotifyDError, err:
+				results.append(err)
+			else:
+				deliveries.append(delivery)
+				results.append(delivery)
+		if deliveries:
+			deadline = time.time() + self.timeout
+			client = SendJabberClient(self.jid, self.password, deliveries)
+			# Resolving and connecting block without a timeout. An
+			# abandoned client is used by nobody else.
+			failure = base.capture_failure(base.call_with_deadline, self.timeout, client.connect)
+			if failure is None:
+				failure = base.capture_failure(client.loop_timeout, max(0, deadline - time.time()))
+				client.disconnect_once()
+			if failure is not None:
+				for delivery in deliveries:
+					delivery.failure = failure
+		return [result.failure if isinstance(result, JabberDelivery) else result for result in results]
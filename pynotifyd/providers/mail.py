@@ -3,14 +3,53 @@
 
 import email.mime.text
 import smtplib
+import socket
 
 from .. import errors
 import base
 
 
+def close_smtp(server):
+	"""
+	@type server: smtplib.SMTP
+	"""
+	try:
+		server.quit()
+	except (smtplib.SMTPException, socket.error):
+		server.close()
+
+
+def check_smtp(server):
+	"""
+	@type server: smtplib.SMTP
+	@rtype: bool
+	"""
+	try:
+		return server.noop()[0] == 250
+	except (smtplib.SMTPException, socket.error):
+		return False
+
+
+def refusal_error(mailto, code, reply):
+	"""
+	@type mailto: str
+	@type code: int
+	@type reply: str
+	@rtype: PyNotifyDError
+	"""
+	if code >= 500:
+		return errors.PyNotifyDPermanentError("SMTP server refused recipient %s: %d %s" % (mailto, code, reply))
+	return errors.PyNotifyDTemporaryError("SMTP server refused recipient %s: %d %s" % (mailto, code, reply))
+
+
 class ProviderMail(base.ProviderBase):
 	"""Send message via email.
 
+	SMTP connections are kept open and reused for subsequent messages.
+	Messages with identical bodies are sent to all their recipients in a
+	single SMTP transaction. With forceto every message is sent on its
+	own, because the single recipient stands in for different contacts.
+
 	Required configuration options:
 		- from: The sender email address.
 
@@ -20,11 +59,20 @@ class ProviderMail(base.ProviderBase):
 			gets replace with the actual message.
 		- forceto: Instead of using the email option from the contact use
 			value as recipient for all messages.
+		- host: The SMTP server. Default: localhost
+		- port: The SMTP port. Default: 25
+		- timeout: Number of seconds to wait for the SMTP server.
+			Default: 30
+		- idle_timeout: Close connections not used for this number of
+			seconds. Default: 60
 
 	Required contact configuration options:
 		- email: recipient email address. (Optional if forceto is given.)
 	"""
+	timeout = 30
+
 	def __init__(self, config):
+		base.ProviderBase.__init__(self, config)
 		self.subject = config.get("subject", "PyNotifyD Message")
 		self.body = config.get("body", "MESSAGE")
 		try:
@@ -32,23 +80,110 @@ class ProviderMail(base.ProviderBase):
 		except KeyError:
 			raise errors.PyNotifyDConfigurationError("from address required")
 		self.forceto = config.get("forceto")
+		self.host = config.get("host", "localhost")
+		self.port = base.parse_number(config, "port", 25, int)
+		idle_timeout = base.parse_number(config, "idle_timeout", 60)
+		self.pool = base.ConnectionPool(self.connect, close_smtp, check_smtp, idle_timeout)
 
-	def send_message(self, recipient, message):
-		if self.forceto is None:
-			try:
-				mailto = recipient["email"]
-			except KeyError:
-				raise errors.PyNotifyDConfigurationError("email address required")
-		else:
-			mailto = self.forceto
+	def connect(self):
+		"""
+		@rtype: smtplib.SMTP
+		@raises PyNotifyDTemporaryError:
+		"""
+		try:
+			return smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+		except (smtplib.SMTPException, socket.error), exc:
+			raise errors.PyNotifyDTemporaryError("failed to connect to SMTP server: %s" % str(exc))
+
+	def get_mailto(self, recipient):
+		"""
+		@type recipient: {str: str}
+		@rtype: str
+		@raises PyNotifyDConfigurationError:
+		"""
+		if self.forceto is not None:
+			return self.forceto
+		try:
+			return recipient["email"]
+		except KeyError:
+			raise errors.PyNotifyDConfigurationError("email address required")
+
+	def make_mail(self, mailtos, message):
+		"""Recipients sharing a transaction do not see each other. Only
+		the envelope lists them all.
+
+		@type mailtos: [str]
+		@type message: str
+		@rtype: str
+		"""
 		mail = email.mime.text.MIMEText(self.body.replace("MESSAGE", message))
 		mail["From"] = self.from_
 		mail["Subject"] = self.subject
-		mail["To"] = mailto
-		try:
-			server = smtplib.SMTP()
-			server.connect()
-			server.sendmail(self.from_, [mailto], mail.as_string())
-			server.quit()
-		except smtplib.SMTPException, exc:
-			raise errors.PyNotifyDTemporaryError("SMTPException received: %s" % str(exc))
+		mail["To"] = mailtos[0] if len(mailtos) == 1 else "undisclosed-recipients:;"
+		return mail.as_string()
+
+	def send_transaction(self, mailtos, message):
+		"""Send a message to the given recipients in one transaction. A
+		connection taken from the pool that turns out to be broken is
+		replaced once.
+
+		@type mailtos: [str]
+		@type message: str
+		@rtype: {str: PyNotifyDError}
+		@returns: errors for recipients refused by the server
+		@raises PyNotifyDTemporaryError:
+		"""
+		mail = self.make_mail(mailtos, message)
+		while True:
+			server, reused = self.pool.acquire()
+			try:
+				refused = server.sendmail(self.from_, mailtos, mail)
+			except smtplib.SMTPRecipientsRefused, exc:
+				self.pool.release(server)
+				refused = exc.recipients
+			except (smtplib.SMTPServerDisconnected, socket.error), exc:
+				self.pool.discard(server)
+				if reused:
+					continue
+				raise errors.PyNotifyDTemporaryError("SMTP connection failed: %s" % str(exc))
+			except smtplib.SMTPException, exc:
+				self.pool.discard(server)
+				raise errors.PyNotifyDTemporaryError("SMTPException received: %s" % str(exc))
+			else:
+				self.pool.release(server)
+			return dict((mailto, refusal_error(mailto, code, reply)) for mailto, (code, reply) in refused.items())
+
+	def send_message(self, recipient, message):
+		failure = self.send_messages([(recipient, message)])[0]
+		if failure is not None:
+			raise failure
+
+	def send_messages(self, batch):
+		"""Send all messages using pooled SMTP connections. Recipients of
+		identical messages share one transaction unless forceto is set."""
+		results = [None] * len(batch)
+		bodies = []
+		recipients = {}
+		for index, (recipient, message) in enumerate(batch):
+			try:
+				mailto = self.get_mailto(recipient)
+			except errors.PyNotifyDError, err:
+				results[index] = err
+				continue
+			key = message if self.forceto is None else index
+			if key not in recipients:
+				bodies.append((key, message))
+				recipients[key] = []
+			recipients[key].append((index, mailto))
+		for key, message in bodies:
+			mailtos = sorted(set(mailto for _, mailto in recipients[key]))
+			try:
+				refused = self.call_bounded(self.send_transaction, mailtos, message)
+			except errors.PyNotifyDError, err:
+				refused = dict.fromkeys(mailtos, err)
+			for index, mailto in recipients[key]:
+				results[index] = refused.get(mailto)
+		return results
+
+	def terminate(self):
+		self.pool.clear()
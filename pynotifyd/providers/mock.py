@@ -20,8 +20,12 @@ class ProviderMock(base.ProviderBase):
 			temporary error. If set to random it fails with probability
 			1/2 with a temporary error. If set to success nothing
 			happens.
+
+	If the duration exceeds the timeout, the delivery is abandoned like
+	any other overrunning delivery.
 	"""
 	def __init__(self, config):
+		base.ProviderBase.__init__(self, config)
 		self.duration = int(config.get("duration", 3))
 		self.failtype = config.get("failtype")
 		if self.failtype not in (None, "permanent", "temporary", "random", "success"):
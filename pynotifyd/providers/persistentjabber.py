@@ -450,11 +450,12 @@ class ProviderPersistentJabber(base.ProviderBase):
 		"""
 		@type config: dict-like
 		"""
+		base.ProviderBase.__init__(self, config)
 		myjid = pyxmpp.jid.JID(config["jid"])
 		if myjid.node is None or myjid.resource is None:  # pylint: disable=E1101
 			raise errors.PyNotifyDConfigurationError("jid must be of the form node@domain/resource")
 
-		self.client_thread = PersistentJabberClient(myjid, config["password"])
+		self.client_thread = PersistentJabberClient(myjid, config["password"], ping_timeout=min(10, self.timeout))
 		self.client_thread.start()
 
 	def send_message(self, recipient, message):
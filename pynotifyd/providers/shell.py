@@ -1,11 +1,190 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 #
+from __future__ import with_statement
+import errno
+import logging
+import os
+import select
 import subprocess
+import threading
+import time
 
 from .. import errors
 import base
 
+logger = logging.getLogger("pynotifyd.providers.shell")
+
+
+class Coprocess(object):
+	"""A long-running command receiving requests on stdin and answering
+	each request with one status line on stdout. The status line starts
+	with OK, TEMP or PERM optionally followed by a description. The
+	command is started on first use and restarted after it died or did
+	not answer in time.
+
+	With line framing each request is written as a single line with
+	backslashes and newlines escaped as \\\\ and \\n. With length framing
+	each request is preceded by a line containing its length in bytes.
+
+	Requests are serialized. Each request has a deadline covering the
+	wait for its turn and its reply. A request whose deadline passed
+	before its turn is never written to the coprocess.
+
+	@type busy: bool
+	@ivar busy: whether a request or stop is in progress. Protected by
+		cond.
+	"""
+	def __init__(self, command, framing="line", timeout=60):
+		"""
+		@type command: [str]
+		@type framing: str
+		@param framing: one out of line or length
+		@type timeout: float
+		@param timeout: maximum number of seconds to wait for a reply
+		"""
+		assert framing in ("line", "length")
+		self.command = command
+		self.framing = framing
+		self.timeout = timeout
+		self.proc = None
+		self.buffer = ""
+		self.busy = False
+		self.cond = threading.Condition()
+
+	def acquire(self, deadline=None):
+		"""Wait for the coprocess to become idle and occupy it.
+
+		@type deadline: float or None
+		@param deadline: give up at this unix timestamp. None waits
+			forever.
+		@raises PyNotifyDTemporaryError: if the deadline passed
+		"""
+		with self.cond:
+			while self.busy:
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					raise errors.PyNotifyDTemporaryError("coprocess busy for more than %s seconds" % self.timeout)
+				self.cond.wait(remaining)
+			self.busy = True
+
+	def release(self):
+		"""Make the coprocess available to the next request."""
+		with self.cond:
+			self.busy = False
+			self.cond.notify()
+
+	def start(self):
+		"""
+		@raises PyNotifyDPermanentError:
+		"""
+		logger.debug("starting coprocess %r", self.command)
+		try:
+			self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+		except OSError, exc:
+			raise errors.PyNotifyDPermanentError("received OSError while starting coprocess: %s" % str(exc))
+
+	def stop(self):
+		"""Terminate the coprocess if it is running."""
+		if self.proc is None:
+			return
+		proc, self.proc = self.proc, None
+		self.buffer = ""
+		try:
+			proc.stdin.close()
+		except IOError:
+			pass
+		if proc.poll() is None:
+			try:
+				proc.kill()
+			except OSError:
+				pass
+		proc.wait()
+
+	def frame(self, payload):
+		"""
+		@type payload: str
+		@rtype: str
+		"""
+		if self.framing == "length":
+			return "%d\n%s" % (len(payload), payload)
+		return "%s\n" % payload.replace("\\", "\\\\").replace("\n", "\\n")
+
+	def read_reply(self, deadline):
+		"""Read a line from the coprocess.
+
+		@type deadline: float
+		@param deadline: give up at this unix timestamp
+		@rtype: str
+		@returns: the line or an empty string if the coprocess terminated
+		@raises PyNotifyDTemporaryError: if the deadline passed
+		"""
+		fd = self.proc.stdout.fileno()
+		while "\n" not in self.buffer:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				raise errors.PyNotifyDTemporaryError("coprocess did not reply within %s seconds" % self.timeout)
+			try:
+				readable, _, _ = select.select([fd], [], [], remaining)
+			except select.error, err:
+				if err[0] == errno.EINTR:
+					continue
+				raise
+			if not readable:
+				continue
+			data = os.read(fd, 4096)
+			if not data:
+				return ""
+			self.buffer += data
+		reply, self.buffer = self.buffer.split("\n", 1)
+		return reply + "\n"
+
+	def request(self, payload, deadline=None):
+		"""Send a request and wait for its status line.
+
+		@type payload: str
+		@type deadline: float or None
+		@param deadline: give up at this unix timestamp. Defaults to
+			timeout seconds from now.
+		@raises PyNotifyDError:
+		"""
+		if deadline is None:
+			deadline = time.time() + self.timeout
+		self.acquire(deadline)
+		try:
+			if time.time() >= deadline:
+				raise errors.PyNotifyDTemporaryError("coprocess busy for more than %s seconds" % self.timeout)
+			if self.proc is None or self.proc.poll() is not None:
+				if self.proc is not None:
+					logger.warn("coprocess %r died with exit code %d, restarting", self.command, self.proc.returncode)
+				self.stop()
+				self.start()
+			try:
+				self.proc.stdin.write(self.frame(payload))
+				self.proc.stdin.flush()
+				reply = self.read_reply(deadline)
+			except (IOError, OSError), exc:
+				self.stop()
+				raise errors.PyNotifyDTemporaryError("communication with coprocess failed: %s" % str(exc))
+			except errors.PyNotifyDTemporaryError:
+				# The reply may still arrive and would be mistaken
+				# for the reply to the next request.
+				self.stop()
+				raise
+			if not reply.endswith("\n"):
+				self.stop()
+				raise errors.PyNotifyDTemporaryError("coprocess terminated without reply")
+			status, _, description = reply.strip().partition(" ")
+			if status not in ("OK", "PERM", "TEMP"):
+				self.stop()
+				raise errors.PyNotifyDTemporaryError("received invalid reply from coprocess: %r" % reply)
+		finally:
+			self.release()
+		if status == "PERM":
+			raise errors.PyNotifyDPermanentError("coprocess reported permanent error: %s" % description)
+		if status == "TEMP":
+			raise errors.PyNotifyDTemporaryError("coprocess reported temporary error: %s" % description)
+
 
 class ProviderShell(base.ProviderBase):
 	"""Send a message using a shell command.
@@ -20,8 +199,22 @@ class ProviderShell(base.ProviderBase):
 	Optional configuration options:
 		- message_on_stdin: A boolean indicating whether the message
 			is to be passed to the command via stdin.
+		- coprocess: A boolean indicating whether the command is started
+			once and kept running. The command is not interpolated in
+			this mode. Instead the request option is interpolated for
+			each message and written to the stdin of the command. See
+			L{Coprocess} for the protocol.
+		- request: The request template used in coprocess mode.
+			Required if coprocess is enabled. Example:
+			%(contact:phone)s %(message)s
+		- framing: How requests are delimited in coprocess mode. One out
+			of line or length. Default: line
+		- timeout: Kill the command if it does not finish within this
+			number of seconds. In coprocess mode this is the maximum time
+			to wait for a reply. Default: 60
 	"""
 	def __init__(self, config):
+		base.ProviderBase.__init__(self, config)
 		try:
 			command = config["command"]
 		except KeyError:
@@ -31,6 +224,16 @@ class ProviderShell(base.ProviderBase):
 		self.command = command.split()
 		message_on_stdin = config.get("message_on_stdin", "no").strip().lower()
 		self.message_on_stdin = message_on_stdin not in ('no', 'false', '0')
+		self.coprocess = None
+		if config.get("coprocess", "no").strip().lower() not in ('no', 'false', '0'):
+			try:
+				self.request = config["request"]
+			except KeyError:
+				raise errors.PyNotifyDConfigurationError("coprocess mode requires a request template")
+			framing = config.get("framing", "line")
+			if framing not in ("line", "length"):
+				raise errors.PyNotifyDConfigurationError("framing must be one out of: line or length")
+			self.coprocess = Coprocess(self.command, framing, self.timeout)
 
 	def send_message(self, contact, message):
 		"""
@@ -38,17 +241,53 @@ class ProviderShell(base.ProviderBase):
 		@type message: str
 		@raises PyNotifyDError:
 		"""
+		deadline = time.time() + self.timeout
 		interpolate = dict(("contact:%s" % key, value) for key, value in contact.items())
 		interpolate["message"] = message
+		if self.coprocess is not None:
+			try:
+				request = self.request % interpolate
+			except KeyError, exc:
+				raise errors.PyNotifyDConfigurationError("request template references missing key %s" % str(exc))
+			self.coprocess.request(request, deadline)
+			return
 		command = [part % interpolate for part in self.command]
 		try:
 			if self.message_on_stdin:
 				proc = subprocess.Popen(command, stdin=subprocess.PIPE)
-				proc.communicate(message)
 			else:
 				proc = subprocess.Popen(command)
-			retcode = proc.wait()
-			if retcode != 0:
-				raise errors.PyNotifyDTemporaryError("received nonzero exit code from shell: %d" % retcode)
 		except OSError, exc:
 			raise errors.PyNotifyDPermanentError("received OSError while calling shell: %s" % str(exc))
+		killed = []
+
+		def kill():
+			killed.append(True)
+			try:
+				proc.kill()
+			except OSError:
+				pass
+
+		timer = threading.Timer(self.timeout, kill)
+		timer.start()
+		try:
+			if self.message_on_stdin:
+				try:
+					proc.communicate(message)
+				except (IOError, OSError):
+					pass  # killed while writing, wait below
+			retcode = proc.wait()
+		finally:
+			timer.cancel()
+		if killed:
+			raise errors.PyNotifyDTemporaryError("shell command did not finish within %s seconds" % self.timeout)
+		if retcode != 0:
+			raise errors.PyNotifyDTemporaryError("received nonzero exit code from shell: %d" % retcode)
+
+	def terminate(self):
+		if self.coprocess is not None:
+			self.coprocess.acquire()
+			try:
+				self.coprocess.stop()
+			finally:
+				self.coprocess.release()
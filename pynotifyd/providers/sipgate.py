@@ -34,12 +34,22 @@ class ProviderSipgate(base.SMSProviderBase):
 		if username is None:
 			raise errors.PyNotifyDConfigurationError("No password is given")
 
-		self.sms = gsmsapi.sipgate_api.SipgateAPI(username, password, api)
+		self.credentials = (username, password, api)
+
+	def make_api(self):
+		"""Create an API object. Every call uses its own, because a call
+		abandoned after its timeout may still use the previous one.
+
+		@rtype: gsmsapi.sipgate_api.SipgateAPI
+		"""
+		return gsmsapi.sipgate_api.SipgateAPI(*self.credentials)
 
 	def get_balance(self):
-		return self.sms.get_balance()
+		return self.make_api().get_balance()
 
 	def send_sms(self, phone, message):
 		assert phone.startswith('+')
 		# TODO: preprocess phone and message
-		self.sms.send_sms(phone, message)
+		# The gsmsapi library does not support timeouts. The call is
+		# bounded by send_messages.
+		self.make_api().send_sms(phone, message)
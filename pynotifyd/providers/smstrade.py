@@ -34,12 +34,22 @@ class ProviderSmstrade(base.SMSProviderBase):
 		if sender is None:
 			raise errors.PyNotifyDConfigurationError("No sender given")
 
-		self.sms = gsmsapi.smstrade_api.SMSTradeAPI(api_key, sender, route)
+		self.credentials = (api_key, sender, route)
+
+	def make_api(self):
+		"""Create an API object. Every call uses its own, because a call
+		abandoned after its timeout may still use the previous one.
+
+		@rtype: gsmsapi.smstrade_api.SMSTradeAPI
+		"""
+		return gsmsapi.smstrade_api.SMSTradeAPI(*self.credentials)
 
 	def get_balance(self):
-		return self.sms.get_balance()
+		return self.make_api().get_balance()
 
 	def send_sms(self, phone, message):
 		assert phone.startswith('+')
 		# TODO: preprocess phone and message
-		self.sms.send_sms(phone, message)
\ No newline at end of file
+		# The gsmsapi library does not support timeouts. The call is
+		# bounded by send_messages.
+		self.make_api().send_sms(phone, message)
\ No newline at end of file
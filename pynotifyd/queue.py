@@ -2,13 +2,19 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import with_statement
+import errno
+import collections
+import hashlib
+import heapq
 import logging
 import random
 import time
 import os
 import sys
+import threading
 import traceback
 
+import durability
 import errors
 import processlock
 
@@ -16,6 +22,15 @@ logger = logging.getLogger("pynotifyd.queue")
 
 
 QUEUE_PREFIX = "pynotifyd-"
+# Times are stored in milliseconds. Values below this are old names
+# storing seconds.
+MILLISECONDS_MIN = 10 ** 11
+# Entries created by other processes are translated to the clock of the
+# queue if the system clock deviates by at least this many seconds.
+MAX_SKEW = 1
+BODY_DIR = "bodies"
+CLAIM_DIR = "claimed"
+BODY_MARKER = "\0"
 
 def generate_unique_id():
 	"""Generate a unique identifier.
@@ -29,6 +44,42 @@ def generate_unique_id():
 generate_unique_id.counter = 0
 
 
+def format_time(timestamp):
+	"""
+	@type timestamp: float
+	@rtype: str
+	"""
+	return "%x" % int(round(timestamp * 1000))
+
+
+def parse_time(value):
+	"""
+	@type value: str
+	@param value: hexadecimal milliseconds or seconds
+	@rtype: float
+	"""
+	value = int(value, 16)
+	if value >= MILLISECONDS_MIN:
+		return value / 1000.
+	return float(value)
+
+
+def parse_wait(value):
+	"""
+	@type value: str
+	@param value: an element of a retry logic
+	@rtype: float or None
+	@returns: number of seconds to wait or None if value names a provider
+	"""
+	try:
+		wait = float(value)
+	except ValueError:
+		return None
+	if not 0 <= wait < float("inf"):
+		return None
+	return wait
+
+
 class QueueEntry(object):
 	def __init__(self, filename_or_parts):
 		"""
@@ -47,26 +98,60 @@ class QueueEntry(object):
 		assert len(self.parts) >= 3
 
 	@classmethod
-	def new(cls):
-		return cls(["%x" % time.time(), "0", generate_unique_id()])
+	def new(cls, priority=0, ttl=None, now=None):
+		"""
+		@type priority: int
+		@param priority: higher values are delivered first
+		@type ttl: int or None
+		@param ttl: drop the entry if it is not delivered within this many
+			seconds
+		@type now: float or None
+		@param now: current time, defaults to the system clock
+		@rtype: QueueEntry
+		"""
+		if now is None:
+			now = time.time()
+		parts = [format_time(now), "0", generate_unique_id()]
+		if priority:
+			parts.append("p%d" % priority)
+		if ttl:
+			parts.append("x" + format_time(now + ttl))
+		return cls(parts)
 
-	def modify(self, wait=0, state=None):
+	def modify(self, wait=0, state=None, now=None):
 		"""Create a modified QueueEntry instance.
 
 		@type wait: int or float
 		@param wait: add this number of seconds to the previous deadline
+			or the current time, whichever is later
 		@type state: int or None
 		@param state: copy state if None, otherwise set state
+		@type now: float or None
+		@param now: current time, defaults to the system clock
 		@rtype: QueueEntry
 		"""
-		assert isinstance(wait, int)
 		assert state is None or isinstance(state, int)
-		parts = ["%x" % (max(time.time(), self.deadline) + wait), self.parts[1] if state is None else "%x" % state] + self.parts[2:]
+		if now is None:
+			now = time.time()
+		parts = [format_time(max(now, self.deadline) + wait), self.parts[1] if state is None else "%x" % state] + self.parts[2:]
+		return self.__class__(parts)
+
+	def shifted(self, offset):
+		"""Create a QueueEntry instance with deadline and expiry moved by
+		offset seconds.
+
+		@type offset: float
+		@rtype: QueueEntry
+		"""
+		parts = [format_time(self.deadline + offset)] + self.parts[1:]
+		expiry = self.expiry
+		if expiry is not None:
+			parts = [part if not part.startswith("x") else "x" + format_time(expiry + offset) for part in parts]
 		return self.__class__(parts)
 
 	@property
 	def deadline(self):
-		return int(self.parts[0], 16)
+		return parse_time(self.parts[0])
 
 	@property
 	def state(self):
@@ -76,16 +161,56 @@ class QueueEntry(object):
 	def entryid(self):
 		return self.parts[2]
 
+	def get_tagged(self, tag):
+		"""Optional filename parts following the id are tagged by their
+		first letter.
+
+		@type tag: str
+		@rtype: str or None
+		@returns: the value of the part with the given tag
+		"""
+		for part in self.parts[3:]:
+			if part.startswith(tag):
+				return part[1:]
+		return None
+
+	@property
+	def priority(self):
+		value = self.get_tagged("p")
+		return 0 if value is None else int(value)
+
+	@property
+	def expiry(self):
+		"""
+		@rtype: float or None
+		@returns: the time after which the entry is dropped
+		"""
+		value = self.get_tagged("x")
+		return None if value is None else parse_time(value)
+
+	def has_expired(self, now=None):
+		"""
+		@type now: float or None
+		@rtype: bool
+		"""
+		expiry = self.expiry
+		return expiry is not None and expiry <= (time.time() if now is None else now)
+
 	@property
 	def istemporary(self):
-		return len(self.parts) != 3
+		return self.parts[-1] == "tmp"
 
 	@property
 	def tmpfilename(self):
 		return "%s.tmp" % self.filename
 
-	def sleep_duration(self):
-		return max(0, self.deadline - time.time())
+	def sleep_duration(self, now=None):
+		"""
+		@type now: float or None
+		@param now: current time, defaults to the system clock
+		@rtype: float
+		"""
+		return max(0, self.deadline - (time.time() if now is None else now))
 
 	def __str__(self):
 		return self.filename
@@ -94,24 +219,137 @@ class QueueEntry(object):
 		return "%s(%r)" % (self.__class__.__name__, self.filename)
 
 
-class PersistentQueue(object):
-	def __init__(self, queuedir, retrylogic):
+class QueueBase(object):
+	"""A queue of messages kept in some persistent storage. Subclasses
+	implement the storage by overriding iter_entries, write_batch,
+	get_contents, has_entry, remove_entry, rename_entry and notice.
+
+	The entries are additionally kept in an in-memory index ordered by
+	deadline, so that finding the next entry does not require reading the
+	storage. The index is built lazily on first use and rebuilt from the
+	storage every rescan_interval seconds as a consistency check. Entries
+	added by other processes must be announced using L{notice}.
+
+	Entries can be claimed for delivery using L{claim_next}. Claimed
+	entries are removed from the index until they are passed to
+	L{entry_done}, L{entry_next} or L{release}, so multiple threads can
+	deliver entries concurrently without delivering any entry twice. All
+	index operations are protected by indexlock.
+
+	@type entries: {str: QueueEntry} or None
+	@ivar entries: maps filenames of indexed entries to entries. None if
+		the index has not been built yet.
+	@type heaps: {int: [(int, str)]}
+	@ivar heaps: maps priorities to heaps of (deadline, filename) tuples
+		of entries waiting for their deadline. They may contain filenames
+		no longer present in entries. These are dropped lazily.
+	@type ready: {int: collections.deque([str])}
+	@ivar ready: maps priorities to filenames of entries whose deadline
+		has passed in the order they became ready. Filenames no longer
+		present in entries are dropped lazily.
+	@type claimed: set([str])
+	@ivar claimed: filenames of entries currently being delivered
+
+	If a dedup_window is given, entries with the same recipient and
+	message as an entry still pending or completed within the window are
+	dropped. Each entry is checked once when it enters the index.
+
+	@type pendingkeys: {str: (str, str)}
+	@ivar pendingkeys: maps entry ids of checked entries to their
+		(recipient, message digest)
+	@type lastseen: {(str, str): float or None}
+	@ivar lastseen: maps (recipient, message digest) to the time the last
+		entry was completed or None if it is still pending
+	@type unwritten: set([str])
+	@ivar unwritten: entry ids checked by enqueue_batch, but not yet
+		written to the storage
+	@type duplicates: int
+	@ivar duplicates: number of entries dropped as duplicates
+
+	Entries carrying an expiry time are dropped when they are selected for
+	delivery after it passed.
+
+	@type expired: int
+	@ivar expired: number of entries dropped after expiring
+
+	The durability mode determines whether enqueued entries survive a
+	power loss: "none" leaves flushing to the operating system, "fsync"
+	syncs each enqueue call before returning and "group" shares these
+	syncs between concurrent enqueue calls using a GroupCommitter.
+
+	@type committer: durability.GroupCommitter or None
+	@ivar committer: shares syncs in the "group" mode
+
+	All scheduling decisions use the given clock. Entries created by other
+	processes carry times of the system clock. When the system clock was
+	stepped, they are moved to the timeline of the clock before they enter
+	the index.
+
+	@type compensate_skew: bool
+	@ivar compensate_skew: whether entries are moved to the timeline of
+		the clock. Subclasses disable it when other processes schedule
+		entries of the storage, too.
+	"""
+
+	def __init__(self, queuedir, retrylogic, rescan_interval=3600, dedup_window=0, priority_retry=None, priority_aging=60, backlog_threshold=0, clock=time.time, durability_mode=durability.NONE, group_commit_window=0.005):
+		"""
+		@type queuedir: str
+		@param queuedir: directory holding the storage and the lock
+		@type retrylogic: [str]
+		@type rescan_interval: int
+		@param rescan_interval: rebuild the index from the storage after
+			this many seconds
+		@type dedup_window: int
+		@param dedup_window: drop duplicates of entries completed within
+			this many seconds. 0 disables deduplication.
+		@type priority_retry: {int: [str]} or None
+		@param priority_retry: retry logic replacing retrylogic for
+			entries of the given priorities
+		@type priority_aging: int
+		@param priority_aging: a ready entry gains one priority level for
+			each this many seconds it waits, so lower priorities are not
+			starved
+		@type backlog_threshold: int
+		@param backlog_threshold: while more entries are ready, deliver
+			the most recent ones of a priority first. 0 disables this.
+		@type clock: () -> float
+		@param clock: returns the current time for scheduling
+		@type durability_mode: str
+		@param durability_mode: one of durability.MODES
+		@type group_commit_window: float
+		@param group_commit_window: number of seconds to collect
+			concurrent enqueue calls in the "group" durability mode
+		"""
 		if not os.path.isdir(queuedir):
 			raise errors.PyNotifyDError("queuedir %s does not exist or is not a directory" % queuedir)
 		if not os.access(queuedir, os.R_OK | os.W_OK | os.X_OK):
 			raise errors.PyNotifyDError("queuedir %s lacks required permission" % queuedir)
 		self.queuedir = queuedir
 		self.retrylogic = retrylogic
+		self.priority_retry = priority_retry or {}
+		self.priority_aging = priority_aging
+		self.backlog_threshold = backlog_threshold
+		self.clock = clock
+		self.durability_mode = durability_mode
+		self.committer = None
+		if durability_mode == durability.GROUP:
+			self.committer = durability.GroupCommitter(group_commit_window)
 		self.processlock = None
-
-	def get_path(self, filename):
-		"""
-		@type filename: str or QueueEntry
-		@rtype: str
-		"""
-		if isinstance(filename, QueueEntry):
-			filename = filename.filename
-		return os.path.join(self.queuedir, filename)
+		self.compensate_skew = True
+		self.rescan_interval = rescan_interval
+		self.last_rescan = None
+		self.entries = None
+		self.heaps = {}
+		self.ready = {}
+		self.claimed = set()
+		self.indexlock = threading.RLock()
+		self.dedup_window = dedup_window
+		self.pendingkeys = {}
+		self.lastseen = {}
+		self.unwritten = set()
+		self.last_purge = time.time()
+		self.duplicates = 0
+		self.expired = 0
 
 	def advance_waits(self, entry, fast=False):
 		"""Create a new entry with the sleep states advanced.
@@ -125,78 +363,403 @@ class PersistentQueue(object):
 		@rtype: QueueEntry
 		"""
 		state = self.get_state(entry)
-		while isinstance(state, int):
-			entry = entry.modify(wait=0 if fast else state, state=entry.state + 1)
+		now = self.clock()
+		while isinstance(state, float):
+			entry = entry.modify(wait=0 if fast else state, state=entry.state + 1, now=now)
 			state = self.get_state(entry)
 		return entry
 
-	def enqueue(self, recipient, message):
+	def enqueue(self, recipient, message, priority=0, ttl=None):
 		"""
 		@type recipient: str
 		@type message: str
-		@rtype: QueueEntry
+		@type priority: int
+		@type ttl: int or None
+		@param ttl: drop the message if it is not delivered within this
+			many seconds
+		@rtype: QueueEntry or None
+		@returns: None if the message was dropped as a duplicate
+		@raises PyNotifyDError:
+		"""
+		entries = self.enqueue_many([recipient], message, priority, ttl)
+		return entries[0] if entries else None
+
+	def enqueue_many(self, recipients, message, priority=0, ttl=None):
+		"""Enqueue the same message for multiple recipients.
+
+		@type recipients: [str]
+		@type message: str
+		@type priority: int
+		@type ttl: int or None
+		@rtype: [QueueEntry]
+		@returns: the entries created. Duplicates are left out.
+		@raises PyNotifyDError:
 		"""
-		entry = self.advance_waits(QueueEntry.new())
-		tmpname = self.get_path(entry.tmpfilename)
+		return self.enqueue_batch([(recipients, message, priority, ttl)])[0]
+
+	def enqueue_batch(self, requests):
+		"""Enqueue multiple messages at once. They are stored and made
+		durable together, which is much cheaper than enqueueing them one
+		by one.
+
+		@type requests: [([str], str, int, int or None)]
+		@param requests: (recipients, message, priority, ttl) tuples
+		@rtype: [[QueueEntry]]
+		@returns: the entries created for each request. Duplicates are
+			left out.
+		@raises PyNotifyDError:
+		"""
+		now = self.clock()
+		batch = []
+		checked = []
 		try:
-			with file(tmpname, "w") as tmpfile:
-				tmpfile.write("%s\n%s" % (recipient, message))
-			os.rename(tmpname, self.get_path(entry))
-		except OSError, err:
-			raise errors.PyNotifyDError("failed to create queue file: %s" % str(err))
-		return entry
+			for recipients, message, priority, ttl in requests:
+				entries = [self.advance_waits(QueueEntry.new(priority, ttl, now)) for _ in recipients]
+				if self.dedup_window:
+					with self.indexlock:
+						self.unwritten.update(entry.entryid for entry in entries)
+					checked.extend(entries)
+					digest = hashlib.sha1(message).hexdigest()
+					admitted = [(name, created) for name, created in zip(recipients, entries) if not self.is_duplicate(created, (name, digest))]
+					recipients, entries = [name for name, _ in admitted], [created for _, created in admitted]
+				batch.append((recipients, entries, message))
+			try:
+				self.write_batch([item for item in batch if item[1]])
+			except (IOError, OSError), err:
+				for entry in checked:
+					self.forget_pending(entry, completed=False)
+				raise errors.PyNotifyDError("failed to create queue entry: %s" % str(err))
+		finally:
+			if checked:
+				with self.indexlock:
+					self.unwritten.difference_update(entry.entryid for entry in checked)
+		return [created for _, created, _ in batch]
 
-	def iter_entries(self):
+	def get_key(self, entry):
 		"""
-		@rtype: gen([QueueEntry])
+		@type entry: QueueEntry
+		@rtype: (str, str)
+		@returns: (recipient, message digest)
+		@raises IOError:
 		"""
-		for entry in os.listdir(self.queuedir):
-			logger.debug("Found file named %s in queuedir %s", entry, self.queuedir)
-			if entry.startswith(QUEUE_PREFIX):
-				logger.debug("File %s is a pynotifyd queue entry", entry)
-				entry = QueueEntry(entry)
-				if not entry.istemporary:
-					yield entry
+		recipient, message = self.get_contents(entry)
+		return recipient, hashlib.sha1(message).hexdigest()
 
-	def find_next(self):
+	def is_duplicate(self, entry, key):
+		"""Check whether an entry duplicates a pending or recently
+		completed one. Otherwise record it as pending.
+
+		@type entry: QueueEntry
+		@type key: (str, str)
+		@param key: (recipient, message digest) of entry
+		@rtype: bool
 		"""
+		now = time.time()
+		with self.indexlock:
+			if now - self.last_purge >= self.dedup_window:
+				for oldkey, seen in self.lastseen.items():
+					if seen is not None and now - seen >= self.dedup_window:
+						del self.lastseen[oldkey]
+				self.last_purge = now
+			seen = self.lastseen.get(key, 0)
+			if seen is None or now - seen < self.dedup_window:
+				self.duplicates += 1
+				return True
+			self.lastseen[key] = None
+			self.pendingkeys[entry.entryid] = key
+			return False
+
+	def admit(self, entry):
+		"""Prepare an entry created by another process for the index. Its
+		times are translated to the clock of the queue if the system clock
+		deviates and it is dropped if it is a duplicate.
+
+		@type entry: QueueEntry
 		@rtype: QueueEntry or None
+		@returns: the entry to index or None if it was dropped or vanished
 		"""
+		skew = time.time() - self.clock()
+		if self.compensate_skew and abs(skew) >= MAX_SKEW:
+			shifted = entry.shifted(-skew)
+			logger.info("moving entry %s by %.3f seconds to compensate a clock step", str(entry), -skew)
+			try:
+				if not self.rename_entry(entry, shifted):
+					return None
+			except (IOError, OSError):
+				return None
+			entry = shifted
+		if not self.dedup_window or entry.entryid in self.pendingkeys:
+			return entry
 		try:
-			return min(self.iter_entries(), key=lambda entry: entry.deadline)
-		except ValueError:  # empty sequence
+			key = self.get_key(entry)
+		except IOError:
 			return None
+		if not self.is_duplicate(entry, key):
+			return entry
+		logger.info("dropping entry %s for %s duplicating a recent message", str(entry), key[0])
+		try:
+			self.entry_done(entry)
+		except OSError:
+			pass
+		return None
+
+	def index_add(self, entry):
+		"""Add an entry to the in-memory index. Nothing happens if the
+		index has not been built yet or already contains the entry.
+
+		@type entry: QueueEntry
+		"""
+		with self.indexlock:
+			if self.entries is None or entry.filename in self.entries:
+				return
+			if entry.filename in self.claimed:
+				return
+			self.entries[entry.filename] = entry
+			heapq.heappush(self.heaps.setdefault(entry.priority, []), (entry.deadline, entry.filename))
+
+	def index_remove(self, entry):
+		"""Remove an entry from the in-memory index.
+
+		@type entry: QueueEntry
+		"""
+		with self.indexlock:
+			self.claimed.discard(entry.filename)
+			if self.entries is not None:
+				self.entries.pop(entry.filename, None)
+
+	def rescan(self):
+		"""Rebuild the in-memory index from the contents of the storage."""
+		logger.debug("rescanning queuedir %s", self.queuedir)
+		with self.indexlock:
+			known = self.entries or {}
+			self.entries = {}
+			for entry in self.iter_entries():
+				if entry.filename in self.claimed:
+					continue
+				if entry.filename not in known:
+					entry = self.admit(entry)
+					if entry is None:
+						continue
+				self.entries[entry.filename] = entry
+			self.heaps = {}
+			self.ready = {}
+			for entry in self.entries.values():
+				self.heaps.setdefault(entry.priority, []).append((entry.deadline, entry.filename))
+			for heap in self.heaps.values():
+				heapq.heapify(heap)
+			present = set(entry.entryid for entry in self.entries.values())
+			present.update(QueueEntry(filename).entryid for filename in self.claimed)
+			self.reconcile_pending(present.__contains__)
+			self.last_rescan = time.time()
+
+	def find_next(self):
+		"""Find the entry to deliver next. Among the entries whose
+		deadline has passed, the one with the highest priority wins.
+		Waiting entries gain priority over time as configured by
+		priority_aging. If no entry is ready, the one with the earliest
+		deadline is returned. Expired entries are dropped on the way.
+
+		@rtype: QueueEntry or None
+		"""
+		with self.indexlock:
+			now = self.clock()
+			if self.entries is None or time.time() - self.last_rescan >= self.rescan_interval:
+				self.rescan()
+			self.maintain_claims()
+			self.promote(now)
+			entry = self.select_ready(now)
+			while entry is not None and entry.has_expired(now):
+				self.drop_expired(entry)
+				entry = self.select_ready(now)
+			if entry is not None:
+				return entry
+			earliest = None
+			for priority, heap in self.heaps.items():
+				while heap and heap[0][1] not in self.entries:
+					heapq.heappop(heap)
+				if not heap:
+					del self.heaps[priority]
+				elif earliest is None or heap[0] < earliest:
+					earliest = heap[0]
+			return None if earliest is None else self.entries[earliest[1]]
+
+	def promote(self, now):
+		"""Move entries whose deadline has passed from heaps to ready.
+
+		@type now: float
+		"""
+		for priority, heap in self.heaps.items():
+			while heap and heap[0][0] <= now:
+				filename = heapq.heappop(heap)[1]
+				if filename in self.entries:
+					self.ready.setdefault(priority, collections.deque()).append(filename)
+
+	def select_ready(self, now):
+		"""
+		@type now: float
+		@rtype: QueueEntry or None
+		@returns: the ready entry to deliver next
+		"""
+		for priority, ready in self.ready.items():
+			while ready and ready[0] not in self.entries:
+				ready.popleft()
+			while ready and ready[-1] not in self.entries:
+				ready.pop()
+			if not ready:
+				del self.ready[priority]
+		best = bestrank = None
+		backlog = self.backlog_threshold and sum(map(len, self.ready.values())) > self.backlog_threshold
+		for priority, ready in self.ready.items():
+			# The oldest entry of each priority has waited longest and
+			# determines its rank.
+			oldest = self.entries[ready[0]]
+			rank = (priority + (now - oldest.deadline) / float(self.priority_aging), -oldest.deadline)
+			if best is None or rank > bestrank:
+				best, bestrank = ready, rank
+		if best is None:
+			return None
+		return self.entries[best[-1] if backlog else best[0]]
+
+	def drop_expired(self, entry):
+		"""Remove an unclaimed or claimed entry whose expiry passed.
+
+		@type entry: QueueEntry
+		"""
+		logger.info("dropping expired entry %s", str(entry))
+		self.expired += 1
+		try:
+			self.entry_done(entry)
+		except OSError, err:
+			logger.warn("failed to remove expired entry %s: %s", str(entry), str(err))
+			if err.errno == errno.ENOENT:
+				self.forget_pending(entry)
+			self.index_remove(entry)
+
+	def claim_next(self):
+		"""Claim the next entry if its deadline has passed. The entry
+		must be passed to one of entry_done, entry_next or release
+		afterwards.
+
+		@rtype: QueueEntry or None
+		@returns: None if no entry is ready
+		"""
+		with self.indexlock:
+			while True:
+				entry = self.find_next()
+				if entry is None or self.sleep_duration(entry) > 0:
+					return None
+				del self.entries[entry.filename]
+				if not self.acquire_claim(entry):
+					# Whoever took the entry delivers it.
+					self.forget_pending(entry)
+					continue
+				self.claimed.add(entry.filename)
+				return entry
+
+	def sleep_duration(self, entry):
+		"""
+		@type entry: QueueEntry
+		@rtype: float
+		@returns: number of seconds until the deadline of entry
+		"""
+		return entry.sleep_duration(self.clock())
+
+	def claim_ready(self, limit=None):
+		"""Claim all entries whose deadline has passed in the order
+		chosen by find_next.
+
+		@type limit: int or None
+		@param limit: claim at most this many entries
+		@rtype: [QueueEntry]
+		"""
+		claimed = []
+		with self.indexlock:
+			while limit is None or len(claimed) < limit:
+				entry = self.claim_next()
+				if entry is None:
+					break
+				claimed.append(entry)
+		return claimed
+
+	def release(self, entry):
+		"""Give up a claim on an entry without delivering it. Nothing
+		happens if the entry is not claimed.
+
+		@type entry: QueueEntry
+		"""
+		with self.indexlock:
+			if entry.filename not in self.claimed:
+				return
+			if not self.release_claim(entry):
+				return
+			self.claimed.discard(entry.filename)
+			if self.has_entry(entry):
+				self.index_add(entry)
+			else:
+				self.forget_pending(entry)
 
 	def get_state(self, entry):
 		"""Converts an entry (which has a state) to a provider name or
 		waiting time.
 
 		@type entry: QueueEntry
-		@rtype: int or str
+		@rtype: float or str
 		@returns: number of seconds to wait or the next provider
 		"""
+		retrylogic = self.priority_retry.get(entry.priority, self.retrylogic)
 		state = entry.state
-		if state >= len(self.retrylogic):
+		if state >= len(retrylogic):
 			return "GIVEUP"
-		state = self.retrylogic[state]
-		if state.isdigit():
-			state = int(state)
-		return state
+		state = retrylogic[state]
+		wait = parse_wait(state)
+		return state if wait is None else wait
+
+	def entry_done(self, entry):
+		"""Remove an entry after delivering or giving up on it.
 
-	def get_contents(self, entry):
-		"""
 		@type entry: QueueEntry
-		@rtype: (str, str)
-		@returns: (recipient, message)
 		"""
-		with file(self.get_path(entry)) as queuefile:
-			return queuefile.readline().strip(), queuefile.read()
+		if not self.remove_entry(entry):
+			return
+		self.forget_pending(entry)
+		self.index_remove(entry)
+
+	def forget_pending(self, entry, completed=True):
+		"""Stop treating an entry as pending for deduplication, because it
+		was completed or left the queue otherwise.
 
-	def entry_done(self, entry):
-		"""
 		@type entry: QueueEntry
+		@type completed: bool
+		@param completed: whether duplicates of the entry are still
+			dropped for dedup_window seconds. Otherwise they are admitted
+			right away.
+		"""
+		if not self.dedup_window:
+			return
+		with self.indexlock:
+			key = self.pendingkeys.pop(entry.entryid, None)
+			if key is None:
+				return
+			if completed:
+				self.lastseen[key] = time.time()
+			elif key in self.lastseen and self.lastseen[key] is None:
+				del self.lastseen[key]
+
+	def reconcile_pending(self, is_present):
+		"""Forget pending keys of entries that left the storage without
+		passing entry_done, e.g. because an operator removed them.
+
+		@type is_present: str -> bool
+		@param is_present: tells whether the storage contains the entry
+			with the given id
 		"""
-		os.unlink(self.get_path(entry))
+		if not self.dedup_window:
+			return
+		with self.indexlock:
+			for entryid in self.pendingkeys.keys():
+				if entryid not in self.unwritten and not is_present(entryid):
+					logger.debug("forgetting pending entry %s, it vanished", entryid)
+					self.lastseen[self.pendingkeys.pop(entryid)] = time.time()
 
 	def entry_next(self, entry, fast=False):
 		"""
@@ -206,18 +769,36 @@ class PersistentQueue(object):
 			This is useful if the previous failure is permanent and
 			additional waiting does not improve the situation.
 		"""
-		newentry = self.advance_waits(entry.modify(state=entry.state + 1), fast)
-		os.rename(self.get_path(entry), self.get_path(newentry))
+		newentry = self.advance_waits(entry.modify(state=entry.state + 1, now=self.clock()), fast)
+		# Renaming under the lock keeps notice from mistaking the new
+		# entry for one of another process.
+		with self.indexlock:
+			if not self.rename_entry(entry, newentry):
+				return
+			self.index_remove(entry)
+			self.index_add(newentry)
 
-	def lock(self):
+	def stats(self):
+		"""
+		@rtype: {str: int or float}
+		"""
+		stats = dict(duplicates=self.duplicates, expired=self.expired, clock_skew=round(time.time() - self.clock(), 3))
+		if self.committer is not None:
+			stats.update(commit_requests=self.committer.requests, commit_batches=self.committer.batches)
+		return stats
+
+	def lock(self, wait=False):
 		"""Lock the queuedir.
 
+		@type wait: bool
+		@param wait: block until the current owner releases the lock or
+			dies
 		@raises PyNotifyDError:
 		"""
 		if self.processlock:
 			raise errors.PyNotifyDError("already locked")
 		self.processlock = processlock.ProcessLock(os.path.join(self.queuedir, ".lock"))
-		if not self.processlock.tryacquire():
+		if not (self.processlock.acquire() if wait else self.processlock.tryacquire()):
 			self.processlock = None
 			raise errors.PyNotifyDError("failed to lock queuedir")
 
@@ -242,6 +823,685 @@ class PersistentQueue(object):
 			logger.debug("queue.clear processing entry %s", entry)
 			self.entry_done(entry)
 
+	def iter_entries(self):
+		"""
+		@rtype: gen([QueueEntry])
+		@returns: all entries of the storage
+		"""
+		raise NotImplementedError
+
+	def write_batch(self, batch):
+		"""Store new entries and add them to the index.
+
+		@type batch: [([str], [QueueEntry], str)]
+		@param batch: (recipients, entries, message) tuples with one entry
+			per recipient
+		@raises OSError:
+		@raises IOError:
+		"""
+		raise NotImplementedError
+
+	def get_contents(self, entry):
+		"""
+		@type entry: QueueEntry
+		@rtype: (str, str)
+		@returns: (recipient, message)
+		@raises IOError:
+		"""
+		raise NotImplementedError
+
+	def has_entry(self, entry):
+		"""
+		@type entry: QueueEntry
+		@rtype: bool
+		"""
+		raise NotImplementedError
+
+	def remove_entry(self, entry):
+		"""Remove an entry from the storage.
+
+		@type entry: QueueEntry
+		@rtype: bool
+		@returns: False if the entry was taken over by another process
+		"""
+		raise NotImplementedError
+
+	def rename_entry(self, entry, newentry):
+		"""Replace an entry by one with the same id, but a different
+		deadline, state or expiry.
+
+		@type entry: QueueEntry
+		@type newentry: QueueEntry
+		@rtype: bool
+		@returns: False if the entry was taken over by another process
+		"""
+		raise NotImplementedError
+
+	def notice(self, filename=None):
+		"""Tell the queue about a file that appeared in the queuedir.
+
+		@type filename: str or None
+		@param filename: the name of the new file or None if unknown
+			changes happened. In the latter case the index is rebuilt.
+		"""
+		raise NotImplementedError
+
+	def maintain_claims(self):
+		"""Called whenever the next entry is searched."""
+		pass
+
+	def acquire_claim(self, entry):
+		"""Claim an entry against other processes.
+
+		@type entry: QueueEntry
+		@rtype: bool
+		@returns: False if another process claimed or removed the entry
+		"""
+		return True
+
+	def release_claim(self, entry):
+		"""Give up a claim acquired using acquire_claim.
+
+		@type entry: QueueEntry
+		@rtype: bool
+		@returns: False if the entry was taken over by another process
+		"""
+		return True
+
+
+class PersistentQueue(QueueBase):
+	"""A queue of messages stored as one file per entry in queuedir. Files
+	appearing in the queuedir, e.g. created by pynotifyd_client, are new
+	entries.
+
+	If a lease_timeout is given, multiple processes may deliver from the
+	same queuedir. A process claims an entry by renaming it into
+	CLAIM_DIR as "<worker id>.<lease expiry>.<filename>", which fails if
+	another process claimed it first. Leases are renewed by a background
+	thread while the entries are claimed, so deliveries may take longer
+	than lease_timeout. Entries whose lease expired, because their
+	worker crashed, are moved back into the queuedir by any process.
+	Entries in the queuedir may have been scheduled by any of the
+	processes, so they are never moved to compensate a clock step.
+
+	@type workerid: str
+	@ivar workerid: identifies the claims of this process
+	@type leases: {str: str}
+	@ivar leases: maps filenames of claimed entries to their names in
+		CLAIM_DIR
+	@type recovered: int
+	@ivar recovered: number of entries recovered from expired leases
+	"""
+
+	def __init__(self, queuedir, retrylogic, rescan_interval=3600, dedup_window=0, priority_retry=None, priority_aging=60, backlog_threshold=0, clock=time.time, durability_mode=durability.NONE, group_commit_window=0.005, lease_timeout=0):
+		"""See QueueBase.__init__.
+
+		@type lease_timeout: int
+		@param lease_timeout: number of seconds a claim stays valid
+			without renewal. 0 keeps claims in memory only, which
+			requires exclusive use of the queuedir.
+		"""
+		QueueBase.__init__(self, queuedir, retrylogic, rescan_interval, dedup_window, priority_retry, priority_aging, backlog_threshold, clock, durability_mode, group_commit_window)
+		self.lease_timeout = lease_timeout
+		self.workerid = generate_unique_id()
+		self.leases = {}
+		self.last_recovery = None
+		self.recovered = 0
+		self.renewer = None
+		if lease_timeout:
+			self.compensate_skew = False
+			try:
+				os.mkdir(os.path.join(queuedir, CLAIM_DIR))
+			except OSError, err:
+				if err.errno != errno.EEXIST:
+					raise errors.PyNotifyDError("failed to create %s in queuedir: %s" % (CLAIM_DIR, str(err)))
+
+	def get_path(self, filename):
+		"""
+		@type filename: str or QueueEntry
+		@rtype: str
+		"""
+		if isinstance(filename, QueueEntry):
+			filename = filename.filename
+			if filename in self.leases:
+				return os.path.join(self.queuedir, CLAIM_DIR, self.leases[filename])
+		return os.path.join(self.queuedir, filename)
+
+	def iter_entries(self):
+		"""
+		@rtype: gen([QueueEntry])
+		"""
+		for entry in os.listdir(self.queuedir):
+			logger.debug("Found file named %s in queuedir %s", entry, self.queuedir)
+			if entry.startswith(QUEUE_PREFIX):
+				logger.debug("File %s is a pynotifyd queue entry", entry)
+				entry = QueueEntry(entry)
+				if not entry.istemporary:
+					yield entry
+
+	def write_batch(self, batch):
+		"""Store new entries and add them to the index. A message for
+		multiple recipients is stored once in the bodies subdirectory
+		and each entry only references it. All entries of the batch are
+		published together.
+
+		@type batch: [([str], [QueueEntry], str)]
+		@raises OSError:
+		@raises IOError:
+		"""
+		published = []
+		directories = set()
+		for recipients, entries, message in batch:
+			if len(entries) == 1:
+				with file(self.get_path(entries[0].tmpfilename), "w") as tmpfile:
+					tmpfile.write("%s\n%s" % (recipients[0], message))
+			else:
+				digest = self.store_body(message, entries)
+				for recipient, entry in zip(recipients, entries):
+					with file(self.get_path(entry.tmpfilename), "w") as tmpfile:
+						tmpfile.write("%s\n%s%s" % (recipient, BODY_MARKER, digest))
+				directories.add(os.path.join(self.queuedir, BODY_DIR))
+			published.extend(entries)
+		self.publish(published, directories)
+
+	def publish(self, entries, directories=()):
+		"""Rename the temporary files of new entries to their final names
+		and add them to the index, making them durable as required by the
+		durability mode.
+
+		@type entries: [QueueEntry]
+		@type directories: [str]
+		@param directories: further directories modified for the
+			entries, which need to be synced
+		@raises OSError:
+		@raises IOError:
+		"""
+		def rename():
+			# Renaming under the lock keeps a concurrent delivery from
+			# completing an entry before it is indexed.
+			with self.indexlock:
+				for entry in entries:
+					os.rename(self.get_path(entry.tmpfilename), self.get_path(entry))
+					self.index_add(entry)
+		if self.durability_mode == durability.NONE:
+			rename()
+			return
+		paths = [self.get_path(entry.tmpfilename) for entry in entries]
+		directories = [self.queuedir] + list(directories)
+		if self.committer is None:
+			durability.commit(paths, rename, directories)
+		else:
+			self.committer.commit(paths, rename, directories)
+
+	def get_body_path(self, digest, entry=None):
+		"""
+		@type digest: str
+		@type entry: QueueEntry or None
+		@rtype: str
+		@returns: the path of the shared body or of the link held by entry
+		"""
+		if entry is None:
+			return os.path.join(self.queuedir, BODY_DIR, digest)
+		return os.path.join(self.queuedir, BODY_DIR, "%s.%s" % (digest, entry.entryid))
+
+	def store_body(self, message, entries):
+		"""Store a message body and reference it from the given entries.
+		Bodies are named by their SHA-1 digest and reference counted
+		using hard links: each entry holds a link of its own, so the body
+		stays readable for it even when the shared name is removed.
+
+		@type message: str
+		@type entries: [QueueEntry]
+		@rtype: str
+		@returns: the digest
+		@raises OSError:
+		@raises IOError:
+		"""
+		digest = hashlib.sha1(message).hexdigest()
+		try:
+			os.mkdir(os.path.join(self.queuedir, BODY_DIR))
+		except OSError, err:
+			if err.errno != errno.EEXIST:
+				raise
+		shared = self.get_body_path(digest)
+		for entry in entries:
+			while True:
+				try:
+					os.link(shared, self.get_body_path(digest, entry))
+					break
+				except OSError, err:
+					if err.errno != errno.ENOENT:
+						raise
+				# The body does not exist yet or was just released by the
+				# last entry referencing it.
+				tmpname = self.get_body_path("tmp.%s" % generate_unique_id())
+				with file(tmpname, "w") as tmpfile:
+					tmpfile.write(message)
+				if self.durability_mode != durability.NONE:
+					durability.fsync_path(tmpname)
+				os.rename(tmpname, shared)
+		return digest
+
+	def get_reference(self, entry):
+		"""
+		@type entry: QueueEntry
+		@rtype: str or None
+		@returns: the digest of the body referenced by entry or None if
+			the entry contains its message
+		"""
+		try:
+			with file(self.get_path(entry)) as queuefile:
+				queuefile.readline()
+				return self.parse_reference(queuefile.read(42))
+		except IOError:
+			return None
+
+	def release_body(self, digest, entry):
+		"""Drop the reference of entry to a shared body. The body is
+		removed once no entry references it.
+
+		@type digest: str
+		@type entry: QueueEntry
+		"""
+		try:
+			os.unlink(self.get_body_path(digest, entry))
+			shared = self.get_body_path(digest)
+			if os.stat(shared).st_nlink == 1:
+				os.unlink(shared)
+		except OSError, err:
+			if err.errno != errno.ENOENT:
+				raise
+
+	@staticmethod
+	def parse_reference(content):
+		"""
+		@type content: str
+		@param content: entry contents after the recipient line
+		@rtype: str or None
+		@returns: the digest of the referenced body or None if the
+			content is the message itself
+		"""
+		if len(content) != 41 or not content.startswith(BODY_MARKER):
+			return None
+		return content[1:]
+
+	def get_key(self, entry):
+		"""
+		@type entry: QueueEntry
+		@rtype: (str, str)
+		@returns: (recipient, message digest)
+		@raises IOError:
+		"""
+		with file(self.get_path(entry)) as queuefile:
+			recipient, message = queuefile.readline().strip(), queuefile.read()
+		digest = self.parse_reference(message)
+		if digest is None:
+			digest = hashlib.sha1(message).hexdigest()
+		return recipient, digest
+
+	def get_contents(self, entry):
+		"""
+		@type entry: QueueEntry
+		@rtype: (str, str)
+		@returns: (recipient, message)
+		"""
+		# The lock keeps the lease from being renewed while opening.
+		with self.indexlock:
+			queuefile = file(self.get_path(entry))
+		with queuefile:
+			recipient, message = queuefile.readline().strip(), queuefile.read()
+		digest = self.parse_reference(message)
+		if digest is not None:
+			with file(self.get_body_path(digest, entry)) as bodyfile:
+				message = bodyfile.read()
+		return recipient, message
+
+	def has_entry(self, entry):
+		"""
+		@type entry: QueueEntry
+		@rtype: bool
+		"""
+		return os.path.exists(self.get_path(entry))
+
+	def remove_entry(self, entry):
+		"""
+		@type entry: QueueEntry
+		@rtype: bool
+		@returns: False if the entry was lost with its lease
+		"""
+		with self.indexlock:
+			digest = self.get_reference(entry)
+			try:
+				os.unlink(self.get_path(entry))
+			except OSError, err:
+				if not self.lost_lease(entry, err):
+					raise
+				return False
+		if digest is not None:
+			self.release_body(digest, entry)
+		return True
+
+	def rename_entry(self, entry, newentry):
+		"""
+		@type entry: QueueEntry
+		@type newentry: QueueEntry
+		@param newentry: the same entry with a different deadline, state
+			or expiry
+		@rtype: bool
+		@returns: False if the entry was lost with its lease
+		"""
+		try:
+			os.rename(self.get_path(entry), self.get_path(newentry))
+		except OSError, err:
+			if not self.lost_lease(entry, err):
+				raise
+			return False
+		return True
+
+	def index_remove(self, entry):
+		"""Remove an entry from the in-memory index and forget its
+		lease.
+
+		@type entry: QueueEntry
+		"""
+		with self.indexlock:
+			self.leases.pop(entry.filename, None)
+			QueueBase.index_remove(self, entry)
+
+	def rescan(self):
+		"""Rebuild the in-memory index from the contents of the queuedir
+		after recovering entries from expired leases."""
+		with self.indexlock:
+			self.recover_leases()
+			QueueBase.rescan(self)
+
+	def notice(self, filename=None):
+		"""Tell the queue about a file that appeared in the queuedir.
+
+		@type filename: str or None
+		@param filename: the name of the new file or None if unknown
+			changes happened. In the latter case the index is rebuilt.
+		"""
+		if filename is None:
+			self.rescan()
+			return
+		if not filename.startswith(QUEUE_PREFIX):
+			return
+		entry = QueueEntry(filename)
+		if entry.istemporary:
+			return
+		with self.indexlock:
+			if self.entries is None or entry.filename in self.entries:
+				return
+			# The file may be gone already, e.g. when we are notified
+			# about our own rename in entry_next after delivering the
+			# entry.
+			if os.path.exists(self.get_path(entry)):
+				entry = self.admit(entry)
+				if entry is not None:
+					self.index_add(entry)
+
+	def maintain_claims(self):
+		if self.lease_timeout:
+			self.maintain_leases()
+
+	def acquire_claim(self, entry):
+		return not self.lease_timeout or self.acquire_lease(entry)
+
+	def release_claim(self, entry):
+		if entry.filename not in self.leases:
+			return True
+		try:
+			os.rename(self.get_path(entry), self.get_path(entry.filename))
+		except OSError, err:
+			if not self.lost_lease(entry, err):
+				raise
+			return False
+		del self.leases[entry.filename]
+		return True
+
+	def get_lease_name(self, entry):
+		"""
+		@type entry: QueueEntry
+		@rtype: str
+		@returns: the name of a fresh lease of entry in CLAIM_DIR
+		"""
+		return "%s.%s.%s" % (self.workerid, format_time(time.time() + self.lease_timeout), entry.filename)
+
+	@staticmethod
+	def parse_lease_name(name):
+		"""
+		@type name: str
+		@rtype: (str, float, str) or None
+		@returns: (worker id, lease expiry, filename of the entry) or None
+			if name is no lease
+		"""
+		parts = name.split(".", 2)
+		if len(parts) != 3 or not parts[2].startswith(QUEUE_PREFIX):
+			return None
+		try:
+			return parts[0], parse_time(parts[1]), parts[2]
+		except ValueError:
+			return None
+
+	def acquire_lease(self, entry):
+		"""Claim an entry against other processes.
+
+		@type entry: QueueEntry
+		@rtype: bool
+		@returns: False if another process claimed or removed the entry
+		"""
+		name = self.get_lease_name(entry)
+		try:
+			os.rename(self.get_path(entry.filename), os.path.join(self.queuedir, CLAIM_DIR, name))
+		except OSError, err:
+			if err.errno != errno.ENOENT:
+				raise
+			logger.debug("entry %s was claimed by another worker", str(entry))
+			return False
+		self.leases[entry.filename] = name
+		if self.renewer is None:
+			self.renewer = threading.Thread(target=self.renew_leases, name="lease-renewer")
+			self.renewer.daemon = True
+			self.renewer.start()
+		return True
+
+	def renew_leases(self):
+		"""Run maintain_leases periodically, so leases stay valid while
+		a delivery blocks the thread that claimed the entry. Runs in the
+		renewer thread."""
+		while True:
+			time.sleep(self.lease_timeout / 4.)
+			try:
+				self.maintain_leases()
+			except Exception:
+				for line in traceback.format_exc(sys.exc_info()[2]).splitlines():
+					logger.error(line)
+
+	def maintain_leases(self):
+		"""Renew leases of claimed entries before they expire and recover
+		entries from expired leases of other workers. The latter happens
+		at most every lease_timeout / 2 seconds.
+		"""
+		now = time.time()
+		with self.indexlock:
+			for filename, name in self.leases.items():
+				if self.parse_lease_name(name)[1] - now > self.lease_timeout / 2.:
+					continue
+				newname = self.get_lease_name(QueueEntry(filename))
+				try:
+					os.rename(os.path.join(self.queuedir, CLAIM_DIR, name), os.path.join(self.queuedir, CLAIM_DIR, newname))
+				except OSError, err:
+					# Keeping the stale name prevents operating on a
+					# recovered copy of the entry.
+					logger.warn("failed to renew lease of entry %s: %s", filename, str(err))
+					continue
+				self.leases[filename] = newname
+			if self.last_recovery is None or now - self.last_recovery >= self.lease_timeout / 2.:
+				self.last_recovery = now
+				self.recover_leases(now)
+
+	def recover_leases(self, now=None):
+		"""Move entries whose lease expired back into the queuedir.
+
+		@type now: float or None
+		@param now: current time, defaults to the system clock
+		"""
+		if now is None:
+			now = time.time()
+		try:
+			names = os.listdir(os.path.join(self.queuedir, CLAIM_DIR))
+		except OSError, err:
+			if err.errno != errno.ENOENT:
+				raise
+			return
+		for name in names:
+			lease = self.parse_lease_name(name)
+			if lease is None:
+				continue
+			workerid, expiry, filename = lease
+			if workerid == self.workerid or expiry > now:
+				continue
+			try:
+				os.rename(os.path.join(self.queuedir, CLAIM_DIR, name), self.get_path(filename))
+			except OSError, err:
+				if err.errno != errno.ENOENT:
+					raise
+				continue  # recovered by another worker
+			logger.warn("recovered entry %s from expired lease of worker %s", filename, workerid)
+			self.recovered += 1
+			self.notice(filename)
+
+	def lost_lease(self, entry, err):
+		"""Check whether an operation on a claimed entry failed, because
+		its lease expired and another worker recovered the entry. In that
+		case the entry is forgotten. It may be delivered twice.
+
+		@type entry: QueueEntry
+		@type err: OSError
+		@rtype: bool
+		"""
+		if err.errno != errno.ENOENT or entry.filename not in self.leases:
+			return False
+		logger.warn("lost lease of entry %s, it may be delivered again", str(entry))
+		self.forget_pending(entry)
+		self.index_remove(entry)
+		return True
+
+	def stats(self):
+		stats = QueueBase.stats(self)
+		if self.lease_timeout:
+			stats.update(leases=len(self.leases), recovered=self.recovered)
+		return stats
+
+
+class IngestingQueue(QueueBase):
+	"""A queue keeping its entries in a storage only the daemon writes
+	to. Other processes such as pynotifyd_client keep creating one file
+	per entry in the queuedir. These files are moved into the storage
+	when noticed or during a rescan.
+
+	Subclasses implement store_ingested in addition to the hooks of
+	QueueBase.
+
+	@type spool: PersistentQueue
+	@ivar spool: accesses the entry files of the queuedir
+	"""
+	def __init__(self, queuedir, retrylogic, *args, **kwargs):
+		"""See QueueBase.__init__."""
+		QueueBase.__init__(self, queuedir, retrylogic, *args, **kwargs)
+		self.spool = PersistentQueue(queuedir, retrylogic)
+
+	def ingest(self, entry):
+		"""Move an entry file of the queuedir into the storage.
+
+		@type entry: QueueEntry
+		@rtype: QueueEntry or None
+		@returns: None if the file vanished
+		@raises OSError:
+		@raises IOError:
+		"""
+		try:
+			recipient, message = self.spool.get_contents(entry)
+		except IOError:
+			return None
+		# A crash may have happened after the last ingestion of entry.
+		self.store_ingested(entry, recipient, message)
+		try:
+			self.spool.remove_entry(entry)
+		except OSError, err:
+			logger.warn("failed to remove ingested entry %s: %s", str(entry), str(err))
+		return entry
+
+	def ingest_spool(self):
+		"""Move all entry files of the queuedir into the storage."""
+		with self.indexlock:
+			for entry in list(self.spool.iter_entries()):
+				self.ingest(entry)
+
+	def rescan(self):
+		"""Move all entry files of the queuedir into the storage and
+		rebuild the in-memory index from it."""
+		with self.indexlock:
+			self.ingest_spool()
+			QueueBase.rescan(self)
+
+	def notice(self, filename=None):
+		if filename is None:
+			self.rescan()
+			return
+		if not filename.startswith(QUEUE_PREFIX):
+			return
+		entry = QueueEntry(filename)
+		if entry.istemporary:
+			return
+		with self.indexlock:
+			if self.last_rescan is None:
+				return
+			entry = self.ingest(entry)
+			if entry is not None:
+				entry = self.admit(entry)
+			if entry is not None:
+				self.index_add(entry)
+
+	def clear(self):
+		self.spool.clear()
+		QueueBase.clear(self)
+
+	def store_ingested(self, entry, recipient, message):
+		"""Store an entry taken from the queuedir unless the storage
+		contains it already.
+
+		@type entry: QueueEntry
+		@type recipient: str
+		@type message: str
+		@raises OSError:
+		@raises IOError:
+		"""
+		raise NotImplementedError
+
+
+BACKENDS = ("files", "log", "sqlite")
+
+
+def get_backend(name):
+	"""
+	@type name: str
+	@param name: one of BACKENDS
+	@rtype: type
+	@returns: the queue class storing entries as configured
+	@raises PyNotifyDConfigurationError:
+	"""
+	if name == "files":
+		return PersistentQueue
+	if name == "log":
+		import logqueue
+		return logqueue.SegmentLogQueue
+	if name == "sqlite":
+		import sqlitequeue
+		return sqlitequeue.SQLiteQueue
+	raise errors.PyNotifyDConfigurationError("unknown queue backend %s" % name)
+
 
 def process_queue_step(config, queue, providers):
 	"""
@@ -252,38 +1512,204 @@ def process_queue_step(config, queue, providers):
 	@returns: None if the queue is empty, number of seconds to sleep
 			before calling this function again otherwise
 	"""
-	entry = queue.find_next()
+	entry = queue.claim_next()
 	if entry is None:
-		return
-	sleep_time = entry.sleep_duration()
-	if sleep_time > 0:
-		return sleep_time
-	providername = queue.get_state(entry)
+		entry = queue.find_next()
+		if entry is None:
+			return
+		return queue.sleep_duration(entry)
+	try:
+		deliver_entry(config, queue, providers, entry)
+	finally:
+		queue.release(entry)
+	return 0
+
+
+def process_queue_batch(config, queue, providers, limit=None):
+	"""Like process_queue_step, but deliver all ready entries grouped
+	by provider in one pass.
+
+	@type config: configobj.ConfigObj
+	@type queue: PersistentQueue
+	@type providers: {str: ProviderBase}
+	@type limit: int or None
+	@param limit: process at most this many entries
+	@rtype: int or None
+	@returns: None if the queue is empty, number of seconds to sleep
+			before calling this function again otherwise
+	"""
+	entries = queue.claim_ready(limit)
+	if not entries:
+		entry = queue.find_next()
+		if entry is None:
+			return
+		return queue.sleep_duration(entry)
+	logger.debug("processing batch of %d entries", len(entries))
+	try:
+		for providername, group in group_by_provider(queue, entries):
+			deliver_group(config, queue, providers, providername, group)
+	finally:
+		for entry in entries:
+			queue.release(entry)
+	return 0
+
+
+def group_by_provider(queue, entries):
+	"""Group entries by the provider selected by their state. The order
+	of entries is retained within each group and groups are ordered by
+	their first entry.
+
+	@type queue: PersistentQueue
+	@type entries: [QueueEntry]
+	@rtype: [(str, [QueueEntry])]
+	@returns: list of (providername, entries)
+	"""
+	groups = {}
+	order = []
+	for entry in entries:
+		providername = queue.get_state(entry)
+		if providername not in groups:
+			groups[providername] = []
+			order.append(providername)
+		groups[providername].append(entry)
+	return [(name, groups[name]) for name in order]
 
+
+def deliver_group(config, queue, providers, providername, entries):
+	"""Deliver entries which all selected the same provider using a
+	single call of its send_messages method and update the queue for
+	each entry according to its outcome. If the circuit breaker of the
+	provider is open, the entries skip it as after a permanent error.
+
+	@type config: configobj.ConfigObj
+	@type queue: PersistentQueue
+	@type providers: {str: ProviderBase}
+	@type providername: str
+	@type entries: [QueueEntry]
+	"""
 	if providername == "GIVEUP":
-		logger.debug("giving up on entry %s", str(entry))
-		queue.entry_done(entry)
-		return 0
+		for entry in entries:
+			logger.debug("giving up on entry %s", str(entry))
+			queue.entry_done(entry)
+		return
+
+	# Entries may expire while waiting for a worker.
+	now = queue.clock()
+	for entry in [candidate for candidate in entries if candidate.has_expired(now)]:
+		queue.drop_expired(entry)
+		entries.remove(entry)
+	if not entries:
+		return
+
+	provider = providers[providername]
+	batch = []
+	for entry in entries:
+		contactname, message = queue.get_contents(entry)
+		recipient = dict(name=contactname)
+		recipient.update(config["contacts"][contactname])
+		logger.debug("delivering entry %s to %s using %s", str(entry), contactname, providername)
+		batch.append((recipient, message))
+
+	if config["providers"][providername]["aggregate"]:
+		batch, members = aggregate(batch, provider.get_length_limit())
+		if len(batch) < len(entries):
+			logger.debug("aggregated %d entries into %d messages for %s", len(entries), len(batch), providername)
+	else:
+		members = [[position] for position in range(len(batch))]
 
-	contactname, message = queue.get_contents(entry)
-	recipient = dict(name=contactname)
-	recipient.update(config["contacts"][contactname])
+	# A failure between allow and record would leave a half-open
+	# circuit probing forever, so the batch is built before.
+	limit = provider.health.allow()
+	if limit == 0:
+		for entry in entries:
+			logger.info("skipping %s for entry %s, circuit is open", providername, str(entry))
+			queue.entry_next(entry, fast=True)
+		return
+	if limit is not None and len(batch) > limit:
+		# Only one message risks the probe. The others return to the
+		# queue.
+		for indices in members[limit:]:
+			for index in indices:
+				queue.release(entries[index])
+		batch, members = batch[:limit], members[:limit]
 
-	logger.debug("delivering entry %s to %s using %s", str(entry), contactname, providername)
+	start = time.time()
 	try:
-		providers[providername].send_message(recipient, message)
-	except errors.PyNotifyDPermanentError, err:
-		logger.error("delivery of %s to %s using %s failed with permanent error: %s", str(entry), contactname, providername, str(err))
-		queue.entry_next(entry, fast=True)
-	except errors.PyNotifyDTemporaryError, err:
-		logger.warn("delivery of %s to %s using %s failed with temporary error: %s", str(entry), contactname, providername, str(err))
-		queue.entry_next(entry)
+		results = provider.send_messages(batch)
 	except Exception, exc:
 		for line in traceback.format_exc(sys.exc_info()[2]).splitlines():
 			logger.warn(line)
-		logger.error("delivery of %s to %s using %s failed with an unknown exception: %s  %s", str(entry), contactname, providername, exc.__class__.__name__, str(exc))
-		queue.entry_next(entry)
-	else:
+		results = [exc] * len(batch)
+	provider.health.record(results, time.time() - start)
+	for indices, (recipient, _), result in zip(members, batch, results):
+		for index in indices:
+			handle_result(queue, entries[index], recipient["name"], providername, result)
+
+
+def aggregate(batch, limit=None, separator="\n"):
+	"""Merge the messages for each recipient into digests. Messages are
+	packed in order as long as a digest stays within limit, so a
+	recipient only receives multiple digests if its messages do not fit
+	into one.
+
+	@type batch: [({str: str}, str)]
+	@param batch: list of (recipient, message)
+	@type limit: int or None
+	@param limit: maximum length of a digest or None if unlimited
+	@type separator: str
+	@rtype: ([({str: str}, str)], [[int]])
+	@returns: the digests as (recipient, message) and for each digest the
+		indices of the messages in batch it contains
+	"""
+	digests = []
+	members = []
+	current = {}  # recipient name -> index of the digest being filled
+	for index, (recipient, message) in enumerate(batch):
+		position = current.get(recipient["name"])
+		if position is not None:
+			merged = digests[position][1] + separator + message
+			if limit is None or len(merged) <= limit:
+				digests[position] = (recipient, merged)
+				members[position].append(index)
+				continue
+		current[recipient["name"]] = len(digests)
+		digests.append((recipient, message))
+		members.append([index])
+	return digests, members
+
+
+def deliver_entry(config, queue, providers, entry):
+	"""Try to deliver the given entry using the provider selected by its
+	state and update the queue according to the outcome.
+
+	@type config: configobj.ConfigObj
+	@type queue: PersistentQueue
+	@type providers: {str: ProviderBase}
+	@type entry: QueueEntry
+	"""
+	deliver_group(config, queue, providers, queue.get_state(entry), [entry])
+
+
+def handle_result(queue, entry, contactname, providername, result):
+	"""Complete or advance an entry depending on the result of its
+	delivery.
+
+	@type queue: PersistentQueue
+	@type entry: QueueEntry
+	@type contactname: str
+	@type providername: str
+	@type result: None or Exception
+	@param result: as returned by ProviderBase.send_messages
+	"""
+	if result is None:
 		logger.debug("delivery of %s to %s using %s succeeded", str(entry), contactname, providername)
 		queue.entry_done(entry)
-	return 0
+	elif isinstance(result, errors.PyNotifyDPermanentError):
+		logger.error("delivery of %s to %s using %s failed with permanent error: %s", str(entry), contactname, providername, str(result))
+		queue.entry_next(entry, fast=True)
+	elif isinstance(result, errors.PyNotifyDTemporaryError):
+		logger.warn("delivery of %s to %s using %s failed with temporary error: %s", str(entry), contactname, providername, str(result))
+		queue.entry_next(entry)
+	else:
+		logger.error("delivery of %s to %s using %s failed with an unknown exception: %s  %s", str(entry), contactname, providername, result.__class__.__name__, str(result))
+		queue.entry_next(entry)
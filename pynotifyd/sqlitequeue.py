@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides SQLiteQueue, a queue storing its entries in an
+SQLite database in the queuedir. While the daemon runs, the database can
+be inspected using the sqlite3 shell, e.g.
+
+	sqlite3 queue.sqlite "SELECT name, recipient FROM entries ORDER BY deadline"
+"""
+
+from __future__ import with_statement
+import errno
+import logging
+import os
+import sqlite3
+import time
+
+import durability
+import queue
+
+logger = logging.getLogger("pynotifyd.sqlitequeue")
+
+DATABASE = "queue.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+	id TEXT PRIMARY KEY,
+	name TEXT NOT NULL,
+	deadline REAL NOT NULL,
+	priority INTEGER NOT NULL,
+	recipient TEXT NOT NULL,
+	message BLOB NOT NULL,
+	claimed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_deadline ON entries (claimed, deadline, priority);
+CREATE INDEX IF NOT EXISTS entries_priority ON entries (claimed, priority, deadline);
+"""
+
+
+class SQLiteQueue(queue.IngestingQueue):
+	"""A queue storing entries in an SQLite database in WAL mode. The
+	entries table replaces the in-memory index of QueueBase: the next
+	entry is found by indexed queries on deadline and priority, so neither
+	memory nor startup time grow with the number of entries. Only with a
+	dedup_window the keys of all entries are loaded at startup, because
+	duplicates are detected in memory. Claimed entries are flagged in the
+	claimed column, which the queries skip using the same indexes. Claims
+	do not survive a restart and are written using a second connection
+	that never syncs.
+
+	Each enqueue call inserts all of its entries in one transaction and
+	entry_next and entry_done update a single row each. In the "none" and
+	"group" durability modes transactions are committed to the write
+	ahead log without syncing it. The "group" mode syncs the log once per
+	batch instead.
+
+	The database is opened on first use, because the queuedir must be
+	locked before. All access is serialized by indexlock.
+
+	@type db: sqlite3.Connection or None
+	@type claimdb: sqlite3.Connection or None
+	@ivar claimdb: connection updating the claimed column
+	@type priorities: set([int])
+	@ivar priorities: priorities of unclaimed entries. May contain
+		priorities without entries, which are pruned lazily.
+	"""
+	def __init__(self, queuedir, retrylogic, rescan_interval=3600, dedup_window=0, priority_retry=None, priority_aging=60, backlog_threshold=0, clock=time.time, durability_mode=durability.NONE, group_commit_window=0.005):
+		"""See QueueBase.__init__."""
+		queue.IngestingQueue.__init__(self, queuedir, retrylogic, rescan_interval, dedup_window, priority_retry, priority_aging, backlog_threshold, clock, durability_mode, group_commit_window)
+		self.path = os.path.join(queuedir, DATABASE)
+		self.db = None
+		self.claimdb = None
+		self.priorities = set()
+
+	def get_db(self):
+		"""
+		@rtype: sqlite3.Connection
+		@raises IOError:
+		"""
+		with self.indexlock:
+			if self.db is None:
+				try:
+					db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+					db.text_factory = str
+					db.execute("PRAGMA journal_mode = WAL")
+					db.execute("PRAGMA synchronous = %s" % ("FULL" if self.durability_mode == durability.FSYNC else "NORMAL"))
+					db.executescript(SCHEMA)
+					db.execute("UPDATE entries SET claimed = 0 WHERE claimed = 1")
+					self.priorities = set(priority for priority, in db.execute("SELECT DISTINCT priority FROM entries"))
+					claimdb = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+					claimdb.execute("PRAGMA synchronous = NORMAL")
+				except sqlite3.Error, err:
+					raise IOError(errno.EIO, "failed to open %s: %s" % (self.path, str(err)))
+				self.db = db
+				self.claimdb = claimdb
+			return self.db
+
+	def query(self, sql, args=()):
+		"""
+		@type sql: str
+		@type args: tuple
+		@rtype: sqlite3.Cursor
+		@raises IOError:
+		"""
+		with self.indexlock:
+			try:
+				return self.get_db().execute(sql, args)
+			except sqlite3.Error, err:
+				raise IOError(errno.EIO, str(err))
+
+	def insert(self, rows, ignore=False):
+		"""Insert rows in one transaction and make them durable as
+		required by the durability mode.
+
+		@type rows: [(QueueEntry, str, str)]
+		@param rows: (entry, recipient, message) tuples
+		@type ignore: bool
+		@param ignore: whether to keep existing entries instead of
+			failing
+		@raises IOError:
+		"""
+		sql = "INSERT %sINTO entries (id, name, deadline, priority, recipient, message) VALUES (?, ?, ?, ?, ?, ?)" % ("OR IGNORE " if ignore else "")
+		values = [(entry.entryid, entry.filename, entry.deadline, entry.priority, recipient, message) for entry, recipient, message in rows]
+
+		def publish():
+			with self.indexlock:
+				db = self.get_db()
+				try:
+					db.execute("BEGIN IMMEDIATE")
+					try:
+						db.executemany(sql, values)
+					except sqlite3.Error:
+						db.execute("ROLLBACK")
+						raise
+					db.execute("COMMIT")
+				except sqlite3.Error, err:
+					raise IOError(errno.EIO, str(err))
+				self.priorities.update(entry.priority for entry, _, _ in rows)
+			return [self.path + "-wal"]
+		if self.committer is None:
+			publish()
+		else:
+			self.committer.commit([], publish, [])
+
+	def iter_entries(self):
+		return (queue.QueueEntry(name) for name, in self.query("SELECT name FROM entries").fetchall())
+
+	def write_batch(self, batch):
+		self.insert([(entry, recipient, message) for recipients, entries, message in batch for recipient, entry in zip(recipients, entries)])
+
+	def store_ingested(self, entry, recipient, message):
+		self.insert([(entry, recipient, message)], ignore=True)
+
+	def get_contents(self, entry):
+		row = self.query("SELECT recipient, message FROM entries WHERE id = ? AND name = ?", (entry.entryid, entry.filename)).fetchone()
+		if row is None:
+			raise IOError(errno.ENOENT, "no such entry", entry.filename)
+		return row
+
+	def has_entry(self, entry):
+		try:
+			return self.query("SELECT 1 FROM entries WHERE id = ? AND name = ?", (entry.entryid, entry.filename)).fetchone() is not None
+		except IOError:
+			return False
+
+	def remove_entry(self, entry):
+		try:
+			cursor = self.query("DELETE FROM entries WHERE id = ? AND name = ?", (entry.entryid, entry.filename))
+		except IOError, err:
+			raise OSError(err.errno, err.strerror)
+		if cursor.rowcount == 0:
+			raise OSError(errno.ENOENT, "no such entry", entry.filename)
+		return True
+
+	def rename_entry(self, entry, newentry):
+		try:
+			cursor = self.query("UPDATE entries SET name = ?, deadline = ?, claimed = 0 WHERE id = ? AND name = ?", (newentry.filename, newentry.deadline, entry.entryid, entry.filename))
+		except IOError, err:
+			raise OSError(err.errno, err.strerror)
+		if cursor.rowcount == 0:
+			raise OSError(errno.ENOENT, "no such entry", entry.filename)
+		return True
+
+	def set_claimed(self, entry, claimed):
+		"""Flag an entry as claimed or unclaimed. Claims need not be
+		durable, so the update is never synced.
+
+		@type entry: QueueEntry
+		@type claimed: bool
+		@raises IOError:
+		"""
+		with self.indexlock:
+			self.get_db()
+			try:
+				self.claimdb.execute("UPDATE entries SET claimed = ? WHERE id = ? AND name = ?", (int(claimed), entry.entryid, entry.filename))
+			except sqlite3.Error, err:
+				raise IOError(errno.EIO, str(err))
+
+	def release_claim(self, entry):
+		try:
+			self.set_claimed(entry, False)
+		except IOError, err:
+			raise OSError(err.errno, err.strerror)
+		return True
+
+	def index_add(self, entry):
+		"""The entries table is the index. Only the priority of entry is
+		recorded."""
+		with self.indexlock:
+			self.priorities.add(entry.priority)
+
+	def index_remove(self, entry):
+		with self.indexlock:
+			self.claimed.discard(entry.filename)
+
+	def rescan(self):
+		"""Move all entry files of the queuedir into the database. Entries
+		of the database are checked for clock skew and duplicates once,
+		but only if a dedup_window is set or the clocks deviate."""
+		logger.debug("rescanning queuedir %s", self.queuedir)
+		with self.indexlock:
+			# Opening the database loads the priorities.
+			self.get_db()
+			self.ingest_spool()
+			skewed = self.compensate_skew and abs(time.time() - self.clock()) >= queue.MAX_SKEW
+			if self.last_rescan is None and (self.dedup_window or skewed):
+				for entry in list(self.iter_entries()):
+					self.admit(entry)
+			self.reconcile_pending(lambda entryid: self.query("SELECT 1 FROM entries WHERE id = ?", (entryid,)).fetchone() is not None)
+			self.last_rescan = time.time()
+
+	def select_first(self, sql, args=()):
+		"""
+		@type sql: str
+		@param sql: query selecting the name of at most one entry
+		@type args: tuple
+		@rtype: QueueEntry or None
+		"""
+		row = self.query(sql, args).fetchone()
+		return None if row is None else queue.QueueEntry(row[0])
+
+	def select_ready(self, now):
+		best = bestrank = None
+		for priority in sorted(self.priorities):
+			oldest = self.select_first("SELECT name FROM entries WHERE claimed = 0 AND priority = ? AND deadline <= ? ORDER BY deadline LIMIT 1", (priority, now))
+			if oldest is None:
+				if self.select_first("SELECT name FROM entries WHERE claimed = 0 AND priority = ? LIMIT 1", (priority,)) is None:
+					self.priorities.discard(priority)
+				continue
+			rank = (priority + (now - oldest.deadline) / float(self.priority_aging), -oldest.deadline)
+			if best is None or rank > bestrank:
+				best, bestrank = oldest, rank
+		if best is None or not self.backlog_threshold:
+			return best
+		ready, = self.query("SELECT COUNT(*) FROM (SELECT 1 FROM entries WHERE claimed = 0 AND deadline <= ? LIMIT ?)", (now, self.backlog_threshold + 1)).fetchone()
+		if ready <= self.backlog_threshold:
+			return best
+		return self.select_first("SELECT name FROM entries WHERE claimed = 0 AND priority = ? AND deadline <= ? ORDER BY deadline DESC LIMIT 1", (best.priority, now))
+
+	def find_next(self):
+		with self.indexlock:
+			now = self.clock()
+			if self.last_rescan is None or time.time() - self.last_rescan >= self.rescan_interval:
+				self.rescan()
+			entry = self.select_ready(now)
+			while entry is not None and entry.has_expired(now):
+				self.drop_expired(entry)
+				entry = self.select_ready(now)
+			if entry is not None:
+				return entry
+			return self.select_first("SELECT name FROM entries WHERE claimed = 0 ORDER BY deadline LIMIT 1")
+
+	def claim_next(self):
+		with self.indexlock:
+			entry = self.find_next()
+			if entry is None or self.sleep_duration(entry) > 0:
+				return None
+			self.set_claimed(entry, True)
+			self.claimed.add(entry.filename)
+			return entry
+
+	def stats(self):
+		stats = queue.IngestingQueue.stats(self)
+		if self.db is not None:
+			stats.update(pending=self.query("SELECT COUNT(*) FROM entries").fetchone()[0])
+		return stats
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides a SubmissionServer accepting notifications on a
+Unix domain socket and a SubmissionClient talking to it.
+
+Each request consists of a line
+"<recipients> <length> [priority=<n>] [ttl=<seconds>]" followed by length
+bytes of message. Recipients are separated by commas
+and may name contact groups. The server answers each request with a line "OK <entries>" listing
+the space separated queue entries after the notification has been written
+to the queue or "ERROR <reason>". A connection may carry any number of
+requests.
+
+A line "BATCH <count>" followed by count requests submits them at once.
+They are enqueued together and the daemon wakes up only once. Either all
+of them are accepted and answered by one "OK" line each or the batch is
+answered by a single "ERROR" line.
+"""
+
+import errno
+import logging
+import os
+import socket
+import sys
+import threading
+import traceback
+
+import clientindex
+import errors
+
+logger = logging.getLogger("pynotifyd.submission")
+
+
+class SubmissionServer(object):
+	"""Accept notifications on a Unix domain socket and enqueue them.
+	Every connection is served by its own thread.
+	"""
+	def __init__(self, path, config, persistentqueue, wakeup, mode=0660, gid=None):  # pylint:disable=R0913
+		"""
+		@type path: str
+		@param path: filename of the socket. A stale socket is replaced.
+		@type config: configobj.ConfigObj
+		@type persistentqueue: queue.QueueBase
+		@type wakeup: () -> None
+		@param wakeup: called after enqueueing to interrupt the sleep of
+			the main thread
+		@type mode: int
+		@param mode: permissions of the socket. Clients need write
+			permission to connect.
+		@type gid: int or None
+		@param gid: group of the socket. None keeps the group of the
+			daemon.
+		@raises PyNotifyDError:
+		"""
+		self.path = path
+		self.settings = clientindex.make_index(config, False)
+		self.queue = persistentqueue
+		self.wakeup = wakeup
+		self.running = True
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			try:
+				os.unlink(path)
+			except OSError, err:
+				if err.errno != errno.ENOENT:
+					raise
+			self.sock.bind(path)
+			# The umask applies to bind, so the mode is set afterwards.
+			os.chmod(path, mode)
+			if gid is not None:
+				os.chown(path, -1, gid)
+			self.sock.listen(16)
+		except (OSError, socket.error), err:
+			self.sock.close()
+			raise errors.PyNotifyDError("failed to listen on %s: %s" % (path, str(err)))
+		self.thread = threading.Thread(target=self.accept, name="submission")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def accept(self):
+		"""Main function of the accepting thread."""
+		while self.running:
+			try:
+				conn, _ = self.sock.accept()
+			except socket.error, err:
+				if err.errno == errno.EINTR:
+					continue
+				logger.error("accepting submissions failed: %s", str(err))
+				return
+			if not self.running:
+				conn.close()
+				return
+			thread = threading.Thread(target=self.serve, args=(conn,), name="submission-client")
+			thread.daemon = True
+			thread.start()
+
+	def read_request(self, reader, line):
+		"""
+		@type reader: file
+		@type line: str
+		@param line: the request line already read from reader
+		@rtype: (str, str, int, int) or None
+		@returns: (recipients, message, priority, ttl) or None if the
+			connection was closed within the message
+		@raises ValueError: if the request is malformed
+		"""
+		fields = line.split()
+		if len(fields) < 2:
+			raise ValueError
+		recipients, length = fields[0], int(fields[1])
+		if length < 0:
+			raise ValueError
+		options = dict(field.split("=", 1) for field in fields[2:])
+		priority = int(options.pop("priority", 0))
+		ttl = int(options.pop("ttl", self.settings["ttl"]))
+		if options or ttl < 0:
+			raise ValueError
+		message = reader.read(length)
+		if len(message) != length:
+			return None
+		return recipients, message, priority, ttl
+
+	def serve(self, conn):
+		"""Process the requests of one connection.
+
+		@type conn: socket.socket
+		"""
+		try:
+			reader = conn.makefile("r")
+			for line in reader:
+				requests = []
+				try:
+					fields = line.split()
+					if fields and fields[0] == "BATCH":
+						count = int(fields[1])
+						if count < 1:
+							raise ValueError
+						headers = (reader.readline() for _ in range(count))
+					else:
+						headers = [line]
+					for header in headers:
+						request = self.read_request(reader, header)
+						if request is None:
+							return
+						requests.append(request)
+				except (ValueError, IndexError):
+					conn.sendall("ERROR malformed request\n")
+					return
+				conn.sendall(self.process(requests) + "\n")
+		except socket.error, err:
+			logger.debug("submission connection failed: %s", str(err))
+		finally:
+			conn.close()
+
+	def process(self, requests):
+		"""
+		@type requests: [(str, str, int, int or None)]
+		@param requests: (recipients, message, priority, ttl) tuples. The
+			recipients are comma separated contact or group names.
+		@rtype: str
+		@returns: the reply without final line terminator
+		"""
+		try:
+			requests = [(clientindex.expand_recipients(self.settings, recipients.split(",")), message, priority, ttl) for recipients, message, priority, ttl in requests]
+			batch = self.queue.enqueue_batch(requests)
+		except errors.PyNotifyDError, err:
+			return "ERROR %s" % str(err)
+		except Exception:
+			for line in traceback.format_exc(sys.exc_info()[2]).splitlines():
+				logger.warn(line)
+			return "ERROR internal error"
+		logger.debug("accepted %d entries of %d messages via socket", sum(map(len, batch)), len(batch))
+		self.wakeup()
+		return "\n".join("OK %s" % " ".join(map(str, entries)) for entries in batch)
+
+	def shutdown(self):
+		"""Stop accepting connections and remove the socket."""
+		self.running = False
+		# Unblock the accepting thread by connecting once.
+		waker = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			waker.connect(self.path)
+		except socket.error:
+			pass
+		waker.close()
+		self.thread.join()
+		self.sock.close()
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+
+
+class SubmissionClient(object):
+	"""Submit notifications to a SubmissionServer over a single
+	connection."""
+	def __init__(self, path):
+		"""
+		@type path: str
+		@raises PyNotifyDTemporaryError: if the daemon cannot be reached
+		"""
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			self.sock.connect(path)
+		except socket.error, err:
+			self.sock.close()
+			raise errors.PyNotifyDTemporaryError("failed to connect to %s: %s" % (path, str(err)))
+		self.reader = self.sock.makefile("r")
+
+	def format_request(self, recipients, message, priority=0, ttl=None):
+		"""
+		@type recipients: str
+		@type message: str
+		@type priority: int
+		@type ttl: int or None
+		@rtype: str
+		"""
+		header = "%s %d priority=%d" % (recipients, len(message), priority)
+		if ttl is not None:
+			header += " ttl=%d" % ttl
+		return "%s\n%s" % (header, message)
+
+	def read_reply(self):
+		"""
+		@rtype: [str]
+		@returns: the names of the queue entries
+		@raises PyNotifyDTemporaryError:
+		@raises PyNotifyDPermanentError:
+		"""
+		try:
+			reply = self.reader.readline()
+		except socket.error, err:
+			raise errors.PyNotifyDTemporaryError("submission failed: %s" % str(err))
+		if not reply.endswith("\n"):
+			raise errors.PyNotifyDTemporaryError("connection closed by daemon")
+		status, _, detail = reply.rstrip("\n").partition(" ")
+		if status != "OK":
+			raise errors.PyNotifyDPermanentError(detail)
+		return detail.split()
+
+	def submit(self, recipients, message, priority=0, ttl=None):
+		"""
+		@type recipients: str
+		@param recipients: comma separated contact or group names
+		@type message: str
+		@type priority: int
+		@type ttl: int or None
+		@param ttl: None selects the default of the daemon, 0 disables
+			expiry
+		@rtype: [str]
+		@returns: the names of the queue entries
+		@raises PyNotifyDTemporaryError: if the connection broke. The
+			notification may or may not have been enqueued.
+		@raises PyNotifyDPermanentError: if the daemon refused the
+			notification
+		"""
+		try:
+			self.sock.sendall(self.format_request(recipients, message, priority, ttl))
+		except socket.error, err:
+			raise errors.PyNotifyDTemporaryError("submission failed: %s" % str(err))
+		return self.read_reply()
+
+	def submit_batch(self, requests):
+		"""Submit multiple notifications, which the daemon accepts or
+		refuses as a whole.
+
+		@type requests: [(str, str, int, int or None)]
+		@param requests: (recipients, message, priority, ttl) tuples as
+			taken by submit
+		@rtype: [[str]]
+		@returns: the names of the queue entries for each request
+		@raises PyNotifyDTemporaryError:
+		@raises PyNotifyDPermanentError:
+		"""
+		try:
+			self.sock.sendall("BATCH %d\n%s" % (len(requests), "".join(self.format_request(*request) for request in requests)))
+		except socket.error, err:
+			raise errors.PyNotifyDTemporaryError("submission failed: %s" % str(err))
+		return [self.read_reply() for _ in requests]
+
+	def close(self):
+		self.reader.close()
+		self.sock.close()
@@ -23,5 +23,5 @@ setup(name='pynotifyd',
 		"License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
 		],  # see: https://pypi.python.org/pypi?%3Aaction=list_classifiers
 	platforms='any',
-	install_requires=["configobj", "pyinotify", "setproctitle", "pyxmpp", "gsmsapi", "phonenumbers"],
+	install_requires=["configobj", "setproctitle", "pyxmpp", "gsmsapi", "phonenumbers"],
 	)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Helpers shared by the queue tests. Test modules combine a mixin based
+on QueueBehaviour with unittest.TestCase once for each backend."""
+
+import shutil
+import tempfile
+import time
+
+from pynotifyd import queue
+
+RETRY = ["mock", "10", "mock2"]
+
+
+class FakeClock(object):
+	"""A clock advancing only when told to. It starts at a whole second,
+	because entries store their times in milliseconds."""
+	def __init__(self):
+		self.now = float(int(time.time()))
+
+	def __call__(self):
+		return self.now
+
+	def advance(self, seconds):
+		"""
+		@type seconds: float
+		"""
+		self.now += seconds
+
+
+class QueueBehaviour(object):
+	"""Tests run against the backend named by the backend attribute.
+
+	@type backend: str
+	"""
+	backend = None
+
+	def setUp(self):
+		self.queuedir = tempfile.mkdtemp()
+		self.clock = FakeClock()
+		self.queues = []
+
+	def tearDown(self):
+		for q in self.queues:
+			q.unlock()
+		shutil.rmtree(self.queuedir)
+
+	def open_queue(self, **kwargs):
+		"""Open and lock a queue of the backend on the queuedir.
+
+		@rtype: queue.QueueBase
+		"""
+		q = queue.get_backend(self.backend)(self.queuedir, RETRY, clock=self.clock, **kwargs)
+		# The fake clock deviates from the system clock on purpose.
+		q.compensate_skew = False
+		q.lock()
+		self.queues.append(q)
+		return q
+
+	def reopen_queue(self, q, **kwargs):
+		"""Replace q by a fresh instance reading the same storage.
+
+		@type q: queue.QueueBase
+		@rtype: queue.QueueBase
+		"""
+		q.unlock()
+		self.queues.remove(q)
+		return self.open_queue(**kwargs)
+
+	def claim_all(self, q):
+		"""
+		@type q: queue.QueueBase
+		@rtype: [str]
+		@returns: messages of all ready entries in claiming order
+		"""
+		return [q.get_contents(entry)[1] for entry in q.claim_ready()]
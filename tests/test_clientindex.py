@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks that pynotifyd_client only trusts a current index."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pynotifyd import clientindex
+from pynotifyd import config
+
+CONFIG = """
+[general]
+queuedir = "%s"  # the queue
+retry = mock, GIVEUP
+[contacts]
+[[alice]]
+email = alice@example.com
+[[team]]
+members = alice,
+[providers]
+[[mock]]
+driver = mock
+"""
+
+
+class ClientIndexTest(unittest.TestCase):
+	def setUp(self):
+		self.queuedir = tempfile.mkdtemp()
+		self.configfile = os.path.join(self.queuedir, "pynotifyd.conf")
+		self.write_config(CONFIG % self.queuedir)
+
+	def tearDown(self):
+		shutil.rmtree(self.queuedir)
+
+	def write_config(self, text):
+		"""
+		@type text: str
+		"""
+		with open(self.configfile, "w") as configstream:
+			configstream.write(text)
+
+	def write_index(self):
+		clientindex.write_index(self.configfile, config.read_config(self.configfile), False)
+
+	def test_scan_queuedir(self):
+		self.assertEqual(clientindex.scan_queuedir(self.configfile), self.queuedir)
+		self.write_config("[general]\nqueuedir = ${HOME}/queue\n")
+		self.assertEqual(clientindex.scan_queuedir(self.configfile), None)
+		self.write_config("[other]\nqueuedir = /tmp\n")
+		self.assertEqual(clientindex.scan_queuedir(self.configfile), None)
+
+	def test_round_trip(self):
+		self.write_index()
+		settings = clientindex.read_index(self.configfile)
+		self.assertEqual(settings["queuedir"], self.queuedir)
+		self.assertEqual(settings["retry"], ["mock", "GIVEUP"])
+		self.assertEqual(clientindex.expand_recipients(settings, ["team"]), ["alice"])
+
+	def test_changed_config_is_stale(self):
+		self.write_index()
+		self.write_config(CONFIG % self.queuedir + "[[other]]\ndriver = mock\n")
+		self.assertEqual(clientindex.read_index(self.configfile), None)
+
+	def test_missing_or_corrupt_index(self):
+		self.assertEqual(clientindex.read_index(self.configfile), None)
+		with open(os.path.join(self.queuedir, clientindex.INDEX_NAME), "w") as indexfile:
+			indexfile.write("{")
+		self.assertEqual(clientindex.read_index(self.configfile), None)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks that deliveries overrunning their timeout are abandoned one by
+one."""
+
+import threading
+import time
+import unittest
+
+from pynotifyd.providers import base
+
+
+class StuckProvider(base.ProviderBase):
+	"""Hangs on messages starting with "stuck" until released."""
+	def __init__(self):
+		base.ProviderBase.__init__(self, dict(timeout=0.1))
+		self.released = threading.Event()
+		self.sent = []
+
+	def send_message(self, recipient, message):
+		if message.startswith("stuck"):
+			self.released.wait()
+		self.sent.append(message)
+
+
+class DeadlineTest(unittest.TestCase):
+	def setUp(self):
+		self.grace = base.DEADLINE_GRACE
+		base.DEADLINE_GRACE = 0
+		self.provider = StuckProvider()
+
+	def tearDown(self):
+		base.DEADLINE_GRACE = self.grace
+		self.provider.released.set()
+
+	def test_each_message_is_bounded(self):
+		batch = [(dict(name="alice"), message) for message in ("stuck", "first", "stuck again", "second")]
+		started = time.time()
+		results = self.provider.send_messages(batch)
+		self.assertTrue(time.time() - started < 1)
+		self.assertTrue(isinstance(results[0], base.DeadlineExceeded))
+		self.assertTrue(isinstance(results[2], base.DeadlineExceeded))
+		self.assertEqual([results[1], results[3]], [None, None])
+		self.assertEqual(self.provider.sent, ["first", "second"])
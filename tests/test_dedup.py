@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks that duplicate alerts are dropped within the dedup window on
+all queue backends."""
+
+import errno
+import time
+import unittest
+
+from pynotifyd import errors
+
+from fixtures import QueueBehaviour
+
+
+class DedupTests(QueueBehaviour):
+	def test_dedup(self):
+		q = self.open_queue(dedup_window=60)
+		self.assertNotEqual(q.enqueue("alice", "hello"), None)
+		self.assertEqual(q.enqueue("alice", "hello"), None)
+		self.assertNotEqual(q.enqueue("bob", "hello"), None)
+		for entry in q.claim_ready():
+			q.entry_done(entry)
+		self.assertEqual(q.enqueue("alice", "hello"), None)
+		self.assertEqual(q.stats()["duplicates"], 2)
+
+	def test_dedup_failed_write(self):
+		q = self.open_queue(dedup_window=60)
+
+		def fail(batch):
+			raise IOError(errno.ENOSPC, "no space left")
+		q.write_batch = fail
+		self.assertRaises(errors.PyNotifyDError, q.enqueue, "alice", "hello")
+		del q.write_batch
+		self.assertNotEqual(q.enqueue("alice", "hello"), None)
+
+	def test_dedup_vanished_entry(self):
+		q = self.open_queue(dedup_window=60)
+		entry = q.enqueue("alice", "hello")
+		q.remove_entry(entry)
+		q.rescan()
+		self.assertEqual(q.pendingkeys, {})
+		q.lastseen = dict.fromkeys(q.lastseen, time.time() - 60)
+		self.assertNotEqual(q.enqueue("alice", "hello"), None)
+
+
+class FilesDedupTest(DedupTests, unittest.TestCase):
+	backend = "files"
+
+
+class LogDedupTest(DedupTests, unittest.TestCase):
+	backend = "log"
+
+
+class SQLiteDedupTest(DedupTests, unittest.TestCase):
+	backend = "sqlite"
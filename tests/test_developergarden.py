@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks the handling of Developergarden responses without contacting
+the servers. The HTTPS tests use a local stand-in for both servers."""
+
+import BaseHTTPServer
+import json
+import mimetools
+import os
+import ssl
+import StringIO
+import threading
+import unittest
+
+from pynotifyd import errors
+from pynotifyd.providers import developergarden
+
+SUCCESS = "status.statusCode=0\nstatus.statusMessage=ok"
+CERTIFICATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "localhost.crt")
+KEY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "localhost.key")
+
+
+class FakeResponse(object):
+	"""The parts of httplib.HTTPResponse used by make_rest_request."""
+	def __init__(self, status, ctype):
+		"""
+		@type status: int
+		@type ctype: str or None
+		"""
+		self.status = status
+		self.msg = mimetools.Message(StringIO.StringIO("" if ctype is None else "Content-Type: %s\r\n\r\n" % ctype))
+
+
+class TokenTest(unittest.TestCase):
+	def setUp(self):
+		self.provider = developergarden.ProviderDevelopergarden(dict(username="user", password="secret"))
+		self.tokens = []
+		self.replies = []
+		self.provider.get_token = self.get_token
+		self.provider.perform_request = self.perform_request
+
+	def get_token(self):
+		self.tokens.append("token%d" % len(self.tokens))
+		return self.tokens[-1]
+
+	def perform_request(self, server, method, path, headers, body):  # pylint:disable=R0913
+		return self.replies.pop(0)
+
+	def test_rejection_without_content_type(self):
+		self.replies.append((FakeResponse(401, None), ""))
+		self.assertRaises(developergarden.TokenRejected, self.provider.make_authorized_rest_request, "/sms", "token", {})
+
+	def test_rejection_of_unknown_content_type(self):
+		self.replies.append((FakeResponse(401, "text/html"), "<html>Unauthorized</html>"))
+		self.assertRaises(developergarden.TokenRejected, self.provider.make_authorized_rest_request, "/sms", "token", {})
+
+	def test_unknown_content_type(self):
+		self.replies.append((FakeResponse(200, "text/html"), "<html>OK</html>"))
+		try:
+			self.provider.make_authorized_rest_request("/sms", "token", {})
+		except developergarden.TokenRejected:
+			self.fail("TokenRejected raised for status 200")
+		except errors.PyNotifyDTemporaryError:
+			pass
+		else:
+			self.fail("unknown Content-Type accepted")
+
+	def test_rejected_token_is_renewed(self):
+		self.replies.append((FakeResponse(401, "text/html"), "<html>Unauthorized</html>"))
+		self.replies.append((FakeResponse(200, "text/plain"), SUCCESS))
+		used = []
+
+		def send(token):
+			used.append(token)
+			return self.provider.make_authorized_rest_request("/sms", token, {})
+		status, answer = self.provider.with_token(send)
+		self.assertEqual(status, 200)
+		self.assertEqual(answer["status.statusMessage"], "ok")
+		self.assertEqual(used, ["token0", "token1"])
+
+
+class StandInServer(BaseHTTPServer.HTTPServer):
+	"""Counts connections and requests and may close each connection
+	after one request."""
+	def __init__(self):
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+		self.socket = ssl.wrap_socket(self.socket, keyfile=KEY, certfile=CERTIFICATE, server_side=True)
+		self.connections = self.tokens = self.messages = 0
+		self.close_connections = False
+
+	def handle_error(self, request, client_address):
+		pass  # clients closing connections or rejecting the certificate
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Hands out tokens on GET and accepts sms on POST."""
+	protocol_version = "HTTP/1.1"
+
+	def setup(self):
+		self.server.connections += 1
+		BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+	def reply(self, ctype, body):
+		self.send_response(200)
+		self.send_header("Content-Type", ctype)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		self.close_connection = int(self.server.close_connections)
+
+	def do_GET(self):
+		self.server.tokens += 1
+		self.reply("application/json", json.dumps(dict(tokenFormat="CompactToken", tokenEncoding="text/base64", token="token")))
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers["Content-Length"]))
+		self.server.messages += 1
+		self.reply("text/plain", SUCCESS)
+
+	def log_message(self, *args):
+		pass
+
+
+class HTTPSTest(unittest.TestCase):
+	def setUp(self):
+		if not hasattr(ssl, "create_default_context"):
+			self.skipTest("requires Python 2.7.9")
+		self.server = StandInServer()
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.address = "localhost:%d" % self.server.server_address[1]
+		self.providers = []
+
+	def tearDown(self):
+		# The stand-in serves one connection at a time.
+		for provider in self.providers:
+			provider.terminate()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def make_provider(self, **config):
+		config.update(username="user", password="secret", tokenserver=self.address, smsserver=self.address)
+		provider = developergarden.ProviderDevelopergarden(config)
+		self.providers.append(provider)
+		return provider
+
+	def send(self, provider, count):
+		"""
+		@rtype: [None or Exception]
+		"""
+		return provider.send_messages([(dict(phone="+4930%d" % index), "hello") for index in range(count)])
+
+	def test_connection_is_reused(self):
+		provider = self.make_provider(cafile=CERTIFICATE)
+		self.assertEqual(self.send(provider, 3), [None] * 3)
+		self.assertEqual(self.send(provider, 2), [None] * 2)
+		self.assertEqual((self.server.connections, self.server.tokens, self.server.messages), (1, 1, 5))
+
+	def test_closed_connection_is_replaced(self):
+		self.server.close_connections = True
+		provider = self.make_provider(cafile=CERTIFICATE)
+		self.assertEqual(self.send(provider, 3), [None] * 3)
+		self.assertEqual((self.server.connections, self.server.tokens, self.server.messages), (4, 1, 3))
+
+	def test_unknown_certificate(self):
+		provider = self.make_provider()
+		results = self.send(provider, 1)
+		self.assertTrue(isinstance(results[0], errors.PyNotifyDTemporaryError))
+		self.assertEqual(self.server.messages, 0)
+
+	def test_cafile_requires_ssl_context(self):
+		create_default_context = ssl.create_default_context
+		del ssl.create_default_context
+		try:
+			self.assertRaises(errors.PyNotifyDConfigurationError, self.make_provider, cafile=CERTIFICATE)
+		finally:
+			ssl.create_default_context = create_default_context
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks that the GroupCommitter shares syncs between concurrent
+writers."""
+
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pynotifyd import durability
+
+
+class GroupCommitterTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.synced = []
+		self.fsync_path = durability.fsync_path
+		durability.fsync_path = self.record_sync
+		self.published = []
+		self.errors = []
+
+	def tearDown(self):
+		durability.fsync_path = self.fsync_path
+		shutil.rmtree(self.tmpdir)
+
+	def record_sync(self, path):
+		self.synced.append(path)
+		self.fsync_path(path)
+
+	def writer(self, committer, name):
+		"""Commit a file as a concurrent writer would.
+
+		@type committer: durability.GroupCommitter
+		@type name: str
+		"""
+		path = os.path.join(self.tmpdir, name)
+		open(path + ".tmp", "w").close()
+
+		def publish():
+			if name == "broken":
+				raise OSError(errno.EIO, "publishing failed")
+			os.rename(path + ".tmp", path)
+			self.published.append(name)
+		try:
+			committer.commit([path + ".tmp"], publish, [self.tmpdir])
+		except OSError, err:
+			self.errors.append((name, err.errno))
+
+	def run_writers(self, committer, names):
+		"""
+		@type committer: durability.GroupCommitter
+		@type names: [str]
+		"""
+		threads = [threading.Thread(target=self.writer, args=(committer, name)) for name in names]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+	def test_concurrent_writers_share_syncs(self):
+		committer = durability.GroupCommitter(window=0.2)
+		names = ["w%d" % index for index in range(5)]
+		self.run_writers(committer, names)
+		self.assertEqual(sorted(self.published), names)
+		self.assertEqual(committer.requests, 5)
+		self.assertTrue(committer.batches < 5)
+		# Each file once, the directory once per batch.
+		self.assertEqual(len(self.synced), 5 + committer.batches)
+		self.assertEqual(self.synced.count(self.tmpdir), committer.batches)
+
+	def test_error_reaches_its_writer_only(self):
+		committer = durability.GroupCommitter(window=0.2)
+		self.run_writers(committer, ["w0", "broken", "w1"])
+		self.assertEqual(sorted(self.published), ["w0", "w1"])
+		self.assertEqual(self.errors, [("broken", errno.EIO)])
+
+	def test_sequential_writers(self):
+		committer = durability.GroupCommitter(window=0)
+		self.writer(committer, "w0")
+		self.writer(committer, "w1")
+		self.assertEqual((committer.batches, committer.requests), (2, 2))
+		self.assertEqual(self.synced.count(self.tmpdir), 2)
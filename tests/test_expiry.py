@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks message expiry and the shedding order under backlog on all
+queue backends."""
+
+import unittest
+
+from fixtures import QueueBehaviour
+
+
+class ExpiryTests(QueueBehaviour):
+	def test_expiry(self):
+		q = self.open_queue()
+		q.enqueue("alice", "short", ttl=5)
+		q.enqueue("alice", "long", ttl=60)
+		self.clock.advance(10)
+		self.assertEqual(self.claim_all(q), ["long"])
+		self.assertEqual(q.stats()["expired"], 1)
+
+	def test_backlog_order(self):
+		q = self.open_queue(backlog_threshold=2)
+		for index in range(5):
+			q.enqueue("alice", "m%d" % index)
+			self.clock.advance(1)
+		self.assertEqual(self.claim_all(q), ["m4", "m3", "m2", "m0", "m1"])
+
+
+class FilesExpiryTest(ExpiryTests, unittest.TestCase):
+	backend = "files"
+
+
+class LogExpiryTest(ExpiryTests, unittest.TestCase):
+	backend = "log"
+
+
+class SQLiteExpiryTest(ExpiryTests, unittest.TestCase):
+	backend = "sqlite"
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks the CircuitBreaker and how deliver_group obeys it."""
+
+import unittest
+
+from pynotifyd import errors
+from pynotifyd import health
+from pynotifyd import queue
+from pynotifyd.providers import base
+
+from fixtures import QueueBehaviour
+
+FAILURE = errors.PyNotifyDTemporaryError("failed")
+
+
+class CircuitBreakerTest(unittest.TestCase):
+	def setUp(self):
+		self.breaker = health.CircuitBreaker("mock", threshold=0.5, min_calls=4, cooldown=0)
+
+	def open_circuit(self):
+		self.breaker.record([None, FAILURE, FAILURE, None], 1.)
+		self.assertEqual(self.breaker.state, health.OPEN)
+
+	def test_closed(self):
+		self.assertEqual(self.breaker.allow(), None)
+		self.breaker.record([FAILURE, FAILURE, FAILURE], 1.)
+		self.assertEqual(self.breaker.state, health.CLOSED)
+
+	def test_permanent_errors_do_not_count(self):
+		failure = errors.PyNotifyDPermanentError("no such recipient")
+		self.breaker.record([failure] * 4, 1.)
+		self.assertEqual(self.breaker.state, health.CLOSED)
+
+	def test_open_refuses(self):
+		self.breaker.cooldown = 60
+		self.open_circuit()
+		self.assertEqual(self.breaker.allow(), 0)
+
+	def test_probe_closes(self):
+		self.open_circuit()
+		self.assertEqual(self.breaker.allow(), 1)
+		self.assertEqual(self.breaker.state, health.HALF_OPEN)
+		self.assertEqual(self.breaker.allow(), 0)
+		self.breaker.record([None], 1.)
+		self.assertEqual(self.breaker.state, health.CLOSED)
+		self.assertEqual(self.breaker.allow(), None)
+
+	def test_failed_probe_opens(self):
+		self.open_circuit()
+		self.assertEqual(self.breaker.allow(), 1)
+		self.breaker.record([FAILURE], 1.)
+		self.assertEqual(self.breaker.state, health.OPEN)
+		self.assertEqual(self.breaker.stats()["opened"], 2)
+
+
+class RecordingProvider(base.ProviderBase):
+	def __init__(self):
+		base.ProviderBase.__init__(self, {})
+		self.sent = []
+
+	def send_message(self, recipient, message):
+		self.sent.append(message)
+
+
+class ProbeTest(QueueBehaviour, unittest.TestCase):
+	backend = "files"
+
+	def test_probe_delivers_one_message(self):
+		q = self.open_queue()
+		for index in range(3):
+			q.enqueue("alice", "m%d" % index)
+		provider = RecordingProvider()
+		provider.health = health.CircuitBreaker("mock", threshold=0.5, min_calls=1, cooldown=0)
+		provider.health.record([FAILURE], 1.)
+		config = dict(providers=dict(mock=dict(aggregate=False)), contacts=dict(alice={}))
+		queue.deliver_group(config, q, dict(mock=provider), "mock", q.claim_ready())
+		self.assertEqual(len(provider.sent), 1)
+		self.assertEqual(provider.health.state, health.CLOSED)
+		self.assertEqual(q.claimed, set())
+		self.assertEqual(sorted(self.claim_all(q) + provider.sent), ["m0", "m1", "m2"])
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks daemons sharing one queuedir using per-entry leases."""
+
+import shutil
+import tempfile
+import time
+import unittest
+
+from pynotifyd import queue
+
+from fixtures import FakeClock, RETRY
+
+
+class LeaseTest(unittest.TestCase):
+	"""Two daemons sharing a queuedir using leases."""
+	def setUp(self):
+		self.queuedir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.queuedir)
+
+	def test_lost_claim_is_not_pending(self):
+		clock = FakeClock()
+		first, second = [queue.PersistentQueue(self.queuedir, RETRY, dedup_window=60, clock=clock, lease_timeout=300) for _ in range(2)]
+		entry = first.enqueue("alice", "hello")
+		first.find_next()
+		second.find_next()
+		claimed = first.claim_next()
+		self.assertEqual(claimed.filename, entry.filename)
+		self.assertEqual(second.claim_next(), None)
+		self.assertEqual(second.pendingkeys, {})
+		first.entry_done(claimed)
+		second.lastseen = dict.fromkeys(second.lastseen, time.time() - 60)
+		resubmitted = queue.PersistentQueue(self.queuedir, RETRY, clock=clock).enqueue("alice", "hello")
+		second.notice(resubmitted.filename)
+		self.assertEqual(second.claim_next().filename, resubmitted.filename)
+
+	def test_expired_lease_is_recovered(self):
+		clock = FakeClock()
+		first, second = [queue.PersistentQueue(self.queuedir, RETRY, clock=clock, lease_timeout=300) for _ in range(2)]
+		entry = first.enqueue("alice", "hello")
+		first.find_next()
+		second.find_next()
+		self.assertEqual(first.claim_next().filename, entry.filename)
+		second.recover_leases(time.time() + 60)
+		self.assertEqual(second.claim_next(), None)
+		# The first daemon died without renewing its lease.
+		second.recover_leases(time.time() + 301)
+		claimed = second.claim_next()
+		self.assertEqual(claimed.filename, entry.filename)
+		self.assertEqual(second.get_contents(claimed), ("alice", "hello"))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks the parts of SegmentLogQueue not shared with the other
+backends."""
+
+import os
+import unittest
+
+from pynotifyd import durability
+
+from fixtures import QueueBehaviour
+
+
+class LogQueueTest(QueueBehaviour, unittest.TestCase):
+	backend = "log"
+
+	def setUp(self):
+		QueueBehaviour.setUp(self)
+		self.fsyncs = 0
+		self.fsync = os.fsync
+		os.fsync = self.count_fsync
+
+	def tearDown(self):
+		os.fsync = self.fsync
+		QueueBehaviour.tearDown(self)
+
+	def count_fsync(self, fd):
+		self.fsyncs += 1
+		self.fsync(fd)
+
+	def fill_segments(self, q):
+		"""Deliver enough entries to seal and compact segments. Entries
+		enqueued before are left pending.
+
+		@type q: logqueue.SegmentLogQueue
+		"""
+		for index in range(20):
+			done = q.enqueue("alice", "m%d" % index)
+			for entry in q.claim_ready():
+				if entry.entryid == done.entryid:
+					q.entry_done(entry)
+				else:
+					q.release(entry)
+		if q.compactor is not None:
+			q.compactor.join()
+
+	def test_compaction(self):
+		q = self.open_queue(segment_size=256)
+		q.enqueue("bob", "kept")
+		self.fill_segments(q)
+		self.assertTrue(q.compactions > 0)
+		q = self.reopen_queue(q)
+		self.assertEqual(self.claim_all(q), ["kept"])
+
+	def test_none_never_syncs(self):
+		self.fill_segments(self.open_queue(segment_size=256))
+		self.assertEqual(self.fsyncs, 0)
+
+	def test_fsync_syncs(self):
+		self.fill_segments(self.open_queue(segment_size=256, durability_mode=durability.FSYNC))
+		self.assertTrue(self.fsyncs > 0)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks how ProviderMail groups messages into SMTP transactions using a
+local smtpd stand-in."""
+
+import asyncore
+import smtpd
+import threading
+import time
+import unittest
+
+from pynotifyd.providers import mail
+
+
+class StandInServer(smtpd.SMTPServer):
+	"""Records the recipients of each transaction."""
+	def __init__(self):
+		smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+		self.transactions = []
+
+	def process_message(self, peer, mailfrom, rcpttos, data):
+		self.transactions.append(sorted(rcpttos))
+
+
+class MailTest(unittest.TestCase):
+	def setUp(self):
+		# The server and its channels live in asyncore.socket_map.
+		self.server = StandInServer()
+		self.running = True
+		self.thread = threading.Thread(target=self.serve)
+		self.thread.daemon = True
+		self.thread.start()
+		self.providers = []
+
+	def tearDown(self):
+		for provider in self.providers:
+			provider.terminate()
+		self.running = False
+		self.thread.join()
+		asyncore.close_all()
+
+	def serve(self):
+		while self.running:
+			asyncore.loop(timeout=0.05, count=1)
+
+	def make_provider(self, **config):
+		config.update({"from": "pynotifyd@example.com", "host": "127.0.0.1", "port": str(self.server.socket.getsockname()[1]), "timeout": "5"})
+		provider = mail.ProviderMail(config)
+		self.providers.append(provider)
+		return provider
+
+	def transactions(self, count):
+		"""Wait for the stand-in to process count transactions.
+
+		@rtype: [[str]]
+		"""
+		deadline = time.time() + 5
+		while len(self.server.transactions) < count and time.time() < deadline:
+			time.sleep(0.01)
+		return self.server.transactions
+
+	def test_identical_bodies_share_a_transaction(self):
+		provider = self.make_provider()
+		batch = [(dict(email="a@example.com"), "down"), (dict(email="b@example.com"), "up"), (dict(email="c@example.com"), "down")]
+		self.assertEqual(provider.send_messages(batch), [None] * 3)
+		self.assertEqual(sorted(self.transactions(2)), [["a@example.com", "c@example.com"], ["b@example.com"]])
+
+	def test_forceto_sends_each_message(self):
+		provider = self.make_provider(forceto="root@example.com")
+		batch = [(dict(name="alice"), "down"), (dict(name="bob"), "down")]
+		self.assertEqual(provider.send_messages(batch), [None] * 2)
+		self.assertEqual(self.transactions(2), [["root@example.com"]] * 2)
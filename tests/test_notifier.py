@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks that the InotifyDirectoryWatcher reports files moved into the
+queue directory."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pynotifyd import notifier
+
+
+@unittest.skipUnless(notifier.HAS_INOTIFY, "inotify is not available")
+class InotifyDirectoryWatcherTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.directory = os.path.join(self.tmpdir, "queue")
+		os.mkdir(self.directory)
+		self.notices = []
+		self.watcher = notifier.InotifyDirectoryWatcher(self.directory, self.notices.append)
+
+	def tearDown(self):
+		self.watcher.epoll.close()
+		for fd in (self.watcher.fd, self.watcher.wakeuppipe.readfd, self.watcher.wakeuppipe.writefd):
+			os.close(fd)
+		shutil.rmtree(self.tmpdir)
+
+	def move_in(self, name):
+		"""Publish a file the way the queue does.
+
+		@type name: str
+		"""
+		path = os.path.join(self.tmpdir, name)
+		open(path, "w").close()
+		os.rename(path, os.path.join(self.directory, name))
+
+	def test_moved_files(self):
+		self.move_in("first")
+		self.move_in("second")
+		# Files created in place are not published yet.
+		open(os.path.join(self.directory, "temporary"), "w").close()
+		self.watcher(5)
+		self.assertEqual(self.notices, ["first", "second"])
+
+	def test_each_name_is_noticed_once(self):
+		self.move_in("entry")
+		os.rename(os.path.join(self.directory, "entry"), os.path.join(self.directory, "renamed"))
+		os.rename(os.path.join(self.directory, "renamed"), os.path.join(self.directory, "entry"))
+		self.watcher(5)
+		self.assertEqual(self.notices, ["entry", "renamed"])
+
+	def test_overflow(self):
+		self.watcher.read_events = lambda: [(notifier.IN_MOVED_TO, "entry"), (notifier.IN_Q_OVERFLOW, "")]
+		self.watcher.process_events()
+		self.assertEqual(self.notices, [None])
+
+	def test_timeout(self):
+		started = time.time()
+		self.watcher(0.1)
+		self.assertTrue(time.time() - started >= 0.09)
+		self.assertEqual(self.notices, [])
+
+	def test_wakeup(self):
+		timer = threading.Timer(0.1, self.watcher.wakeup)
+		timer.start()
+		started = time.time()
+		self.watcher()
+		self.assertTrue(time.time() - started < 5)
+		self.assertEqual(self.notices, [])
+		timer.join()
+
+
+class ParseEventsTest(unittest.TestCase):
+	def test_names_are_unpadded(self):
+		data = notifier.EVENT_HEADER.pack(1, notifier.IN_MOVED_TO, 0, 8) + "entry\0\0\0" + notifier.EVENT_HEADER.pack(1, notifier.IN_Q_OVERFLOW, 0, 0)
+		self.assertEqual(list(notifier.parse_events(data)), [(notifier.IN_MOVED_TO, "entry"), (notifier.IN_Q_OVERFLOW, "")])
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks the DeliveryPool and its bulkheads using the files backend and
+a provider whose deliveries can be held back."""
+
+import threading
+import time
+import unittest
+
+from pynotifyd import pool
+from pynotifyd.providers import base
+
+from fixtures import QueueBehaviour
+
+
+class GatedProvider(base.ProviderBase):
+	"""Records the messages it delivers. Deliveries wait until the gate
+	is opened."""
+	def __init__(self):
+		base.ProviderBase.__init__(self, {})
+		self.gate = threading.Event()
+		self.gate.set()
+		self.lock = threading.Lock()
+		self.running = 0
+		self.sent = []
+
+	def send_message(self, recipient, message):
+		with self.lock:
+			self.running += 1
+		self.gate.wait()
+		with self.lock:
+			self.running -= 1
+			self.sent.append(message)
+
+
+class ReleaseTests(QueueBehaviour):
+	def test_release(self):
+		q = self.open_queue()
+		q.enqueue("alice", "first")
+		q.enqueue("alice", "second", priority=-1)
+		claimed = q.claim_next()
+		q.release(claimed)
+		self.assertEqual(self.claim_all(q), ["first", "second"])
+
+
+class FilesReleaseTest(ReleaseTests, unittest.TestCase):
+	backend = "files"
+
+
+class LogReleaseTest(ReleaseTests, unittest.TestCase):
+	backend = "log"
+
+
+class SQLiteReleaseTest(ReleaseTests, unittest.TestCase):
+	backend = "sqlite"
+
+
+class BulkheadTest(unittest.TestCase):
+	def test_room(self):
+		bulkhead = pool.Bulkhead("mock", 2)
+		self.assertEqual(bulkhead.room(idle=4, batchsize=3), 6)
+		self.assertEqual(bulkhead.room(idle=1, batchsize=3), 3)
+		bulkhead.start()
+		self.assertEqual(bulkhead.room(idle=4, batchsize=3), 3)
+		bulkhead.start()
+		self.assertEqual(bulkhead.room(idle=4, batchsize=3), 0)
+		bulkhead.finish()
+		self.assertEqual(bulkhead.room(idle=4, batchsize=3), 3)
+
+	def test_unlimited_room(self):
+		bulkhead = pool.Bulkhead("mock")
+		self.assertEqual(bulkhead.room(idle=2, batchsize=1), 2)
+		for _ in range(10):
+			bulkhead.start()
+		self.assertEqual(bulkhead.room(idle=2, batchsize=1), 2)
+
+	def test_pending_order(self):
+		bulkhead = pool.Bulkhead("mock")
+		entries = [FakeEntry(priority) for priority in (0, 1, 0)]
+		for entry in entries:
+			bulkhead.put(entry)
+		self.assertEqual(bulkhead.room(idle=1, batchsize=4), 1)
+		self.assertEqual(bulkhead.start(2), [entries[1], entries[0]])
+		self.assertEqual(bulkhead.start(2), [entries[2]])
+
+
+class FakeEntry(object):
+	"""The part of QueueEntry used by Bulkhead."""
+	def __init__(self, priority):
+		self.priority = priority
+
+
+class PoolTest(QueueBehaviour, unittest.TestCase):
+	backend = "files"
+
+	def setUp(self):
+		QueueBehaviour.setUp(self)
+		self.queue = self.open_queue()
+		self.provider = GatedProvider()
+		self.config = dict(
+			providers=dict(mock=dict(concurrency=1, aggregate=False), mock2=dict(concurrency=None, aggregate=False)),
+			contacts=dict(alice={}))
+		self.woken = threading.Event()
+		self.pool = pool.DeliveryPool(self.config, self.queue, dict(mock=self.provider, mock2=self.provider), 2, self.woken.set)
+
+	def tearDown(self):
+		self.provider.gate.set()
+		self.pool.shutdown()
+		QueueBehaviour.tearDown(self)
+
+	def wait_for_workers(self):
+		"""Wait until all workers are idle."""
+		deadline = time.time() + 5
+		while self.pool.idle < len(self.pool.threads):
+			self.assertTrue(time.time() < deadline, "workers did not finish")
+			self.woken.wait(0.1)
+			self.woken.clear()
+
+	def test_delivery(self):
+		self.queue.enqueue("alice", "first")
+		self.queue.enqueue("alice", "second")
+		# The bulkhead of mock admits one delivery at a time.
+		for _ in range(2):
+			self.pool.dispatch()
+			self.wait_for_workers()
+		self.assertEqual(self.pool.dispatch(), None)
+		self.assertEqual(self.provider.sent, ["first", "second"])
+		self.assertEqual(self.queue.find_next(), None)
+
+	def test_overflow_stays_in_queue(self):
+		self.provider.gate.clear()
+		for index in range(3):
+			self.queue.enqueue("alice", "m%d" % index)
+		self.pool.dispatch()
+		# The bulkhead of mock admits one delivery. The other entries
+		# are neither claimed nor waiting in the bulkhead.
+		self.assertEqual(self.pool.dispatch(), None)
+		self.assertEqual(self.pool.stats()["mock"]["pending"], 0)
+		self.assertEqual(len(self.queue.claimed), 1)
+		self.provider.gate.set()
+		for _ in range(3):
+			self.wait_for_workers()
+			self.pool.dispatch()
+		self.wait_for_workers()
+		self.assertEqual(sorted(self.provider.sent), ["m0", "m1", "m2"])
+
+	def test_failure_postpones_entries(self):
+		del self.config["contacts"]["alice"]
+		self.queue.enqueue("alice", "lost")
+		self.pool.dispatch()
+		self.wait_for_workers()
+		# The entry is not retried right away, but after its retry delay.
+		self.assertAlmostEqual(self.pool.dispatch(), 10, 2)
+		self.assertEqual(self.queue.get_state(self.queue.find_next()), "mock2")
+		self.assertEqual(self.provider.sent, [])
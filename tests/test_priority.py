@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks the priority-aware scheduling of all queue backends."""
+
+import unittest
+
+from fixtures import QueueBehaviour
+
+
+class PriorityTests(QueueBehaviour):
+	def test_priority(self):
+		q = self.open_queue()
+		q.enqueue("alice", "low")
+		q.enqueue("alice", "high", priority=5)
+		self.assertEqual(self.claim_all(q), ["high", "low"])
+
+	def test_priority_aging(self):
+		q = self.open_queue(priority_aging=1)
+		q.enqueue("alice", "old")
+		self.clock.advance(10)
+		q.enqueue("alice", "high", priority=5)
+		self.assertEqual(self.claim_all(q), ["old", "high"])
+
+	def test_priority_retry(self):
+		q = self.open_queue(priority_retry={5: ["mock2"]})
+		q.enqueue("alice", "low")
+		q.enqueue("alice", "high", priority=5)
+		claimed = q.claim_ready()
+		self.assertEqual([q.get_state(item) for item in claimed], ["mock2", "mock"])
+		for entry in claimed:
+			q.entry_next(entry)
+		# Only the low priority entry waits before its next attempt.
+		self.assertEqual([q.get_state(item) for item in q.claim_ready()], ["GIVEUP"])
+		self.assertEqual(q.get_state(q.find_next()), "mock2")
+
+
+class FilesPriorityTest(PriorityTests, unittest.TestCase):
+	backend = "files"
+
+
+class LogPriorityTest(PriorityTests, unittest.TestCase):
+	backend = "log"
+
+
+class SQLitePriorityTest(PriorityTests, unittest.TestCase):
+	backend = "sqlite"
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks that ProcessLock is exclusive and taken over once released or
+once its owner died."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from pynotifyd import processlock
+
+# Holds the lock named by its first argument until killed.
+OWNER = r"""
+import sys, time
+from pynotifyd import processlock
+lock = processlock.ProcessLock(sys.argv[1])
+assert lock.tryacquire()
+sys.stdout.write("locked\n")
+sys.stdout.flush()
+time.sleep(60)
+"""
+
+
+class ProcessLockTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.tmpdir, "lock")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_exclusive(self):
+		first = processlock.ProcessLock(self.filename)
+		second = processlock.ProcessLock(self.filename)
+		self.assertTrue(first.tryacquire())
+		self.assertFalse(second.tryacquire())
+		self.assertFalse(second.acquire(maxwait=0.2, interval=0.05))
+		self.assertTrue(first.release())
+		self.assertTrue(second.tryacquire())
+		self.assertEqual(second.getowner(), os.getpid())
+
+	def test_blocking_acquire_wakes_up(self):
+		first = processlock.ProcessLock(self.filename)
+		second = processlock.ProcessLock(self.filename)
+		self.assertTrue(first.tryacquire())
+		waiter = threading.Thread(target=second.acquire)
+		waiter.start()
+		waiter.join(0.2)
+		self.assertTrue(waiter.is_alive())
+		first.release()
+		waiter.join(5)
+		self.assertFalse(waiter.is_alive())
+		self.assertTrue(second.flockfd is not None)
+
+	def test_dead_owner_is_taken_over(self):
+		env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(processlock.__file__))))
+		owner = subprocess.Popen([sys.executable, "-c", OWNER, self.filename], stdout=subprocess.PIPE, env=env)
+		try:
+			self.assertEqual(owner.stdout.readline(), "locked\n")
+			lock = processlock.ProcessLock(self.filename)
+			self.assertEqual(lock.getowner(), owner.pid)
+			self.assertFalse(lock.tryacquire())
+		finally:
+			owner.kill()
+			owner.wait()
+		# The kernel released the flock, the stale link does not matter.
+		self.assertTrue(lock.tryacquire())
+		self.assertEqual(lock.getowner(), os.getpid())
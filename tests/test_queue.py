@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks the behaviour shared by all queue backends. Each backend is
+tested by one TestCase combining QueueTests with its name."""
+
+import unittest
+
+from pynotifyd import queue
+
+from fixtures import QueueBehaviour, RETRY
+
+
+class QueueTests(QueueBehaviour):
+	def test_enqueue_claim_done(self):
+		q = self.open_queue()
+		entry = q.enqueue("alice", "hello")
+		claimed = q.claim_next()
+		self.assertEqual(claimed.filename, entry.filename)
+		self.assertEqual(q.get_contents(claimed), ("alice", "hello"))
+		self.assertEqual(q.get_state(claimed), "mock")
+		self.assertEqual(q.claim_next(), None)
+		q.entry_done(claimed)
+		self.assertEqual(q.find_next(), None)
+		self.assertFalse(q.has_entry(claimed))
+
+	def test_entry_next_waits(self):
+		q = self.open_queue()
+		q.enqueue("alice", "hello")
+		q.entry_next(q.claim_next())
+		self.assertEqual(q.claim_next(), None)
+		waiting = q.find_next()
+		self.assertEqual(q.get_state(waiting), "mock2")
+		self.assertAlmostEqual(q.sleep_duration(waiting), 10, 2)
+		self.clock.advance(10)
+		claimed = q.claim_next()
+		self.assertEqual(claimed.filename, waiting.filename)
+		self.assertEqual(q.get_contents(claimed), ("alice", "hello"))
+		q.entry_next(claimed)
+		self.assertEqual(q.get_state(q.claim_next()), "GIVEUP")
+
+	def test_reopen(self):
+		q = self.open_queue()
+		q.enqueue("alice", "done")
+		q.enqueue("bob", "retried", priority=-1)
+		q.enqueue("carol", "pending", priority=-2)
+		q.entry_done(q.claim_next())
+		q.entry_next(q.claim_next())
+		q.claim_next()  # claims are not persistent
+		q = self.reopen_queue(q)
+		self.clock.advance(10)
+		claimed = q.claim_ready()
+		self.assertEqual([q.get_contents(entry) for entry in claimed], [("bob", "retried"), ("carol", "pending")])
+		self.assertEqual([q.get_state(entry) for entry in claimed], ["mock2", "mock"])
+
+	def test_reopen_enqueued_by_client(self):
+		q = self.open_queue()
+		client = queue.PersistentQueue(self.queuedir, RETRY, clock=self.clock)
+		client.enqueue("alice", "from client")
+		q = self.reopen_queue(q)
+		self.assertEqual(self.claim_all(q), ["from client"])
+
+
+class FilesQueueTest(QueueTests, unittest.TestCase):
+	backend = "files"
+
+
+class LogQueueTest(QueueTests, unittest.TestCase):
+	backend = "log"
+
+
+class SQLiteQueueTest(QueueTests, unittest.TestCase):
+	backend = "sqlite"
+
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks the coprocess protocol of the shell provider against a small
+python coprocess."""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from pynotifyd import errors
+from pynotifyd.providers import shell
+
+# Records every request in the file named by its first argument. A
+# request "sleep N" is answered after N seconds.
+COPROCESS = r"""
+import sys, time
+log = open(sys.argv[1], "a", 0)
+while True:
+	line = sys.stdin.readline()
+	if not line:
+		break
+	log.write(line)
+	if line.startswith("sleep "):
+		time.sleep(float(line.split()[1]))
+	sys.stdout.write(line.startswith("fail") and "PERM failed\n" or "OK\n")
+	sys.stdout.flush()
+"""
+
+
+class CoprocessTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		script = os.path.join(self.tmpdir, "coprocess.py")
+		with open(script, "w") as scriptfile:
+			scriptfile.write(COPROCESS)
+		self.logname = os.path.join(self.tmpdir, "requests")
+		self.coprocess = shell.Coprocess([sys.executable, script, self.logname], timeout=0.5)
+
+	def tearDown(self):
+		self.coprocess.stop()
+		shutil.rmtree(self.tmpdir)
+
+	def requests(self):
+		"""
+		@rtype: [str]
+		@returns: the requests received by the coprocess so far
+		"""
+		with open(self.logname) as logfile:
+			return logfile.read().splitlines()
+
+	def test_replies(self):
+		self.coprocess.request("hello")
+		self.assertRaises(errors.PyNotifyDPermanentError, self.coprocess.request, "fail")
+		self.assertEqual(self.requests(), ["hello", "fail"])
+
+	def test_busy_request_is_never_written(self):
+		self.coprocess.request("warmup")
+		slow = threading.Thread(target=self.coprocess.request, args=("sleep 1", time.time() + 5))
+		slow.start()
+		while self.requests()[-1] != "sleep 1":
+			time.sleep(0.01)
+		started = time.time()
+		self.assertRaises(errors.PyNotifyDTemporaryError, self.coprocess.request, "late", time.time() + 0.2)
+		self.assertTrue(time.time() - started < 0.5)
+		slow.join()
+		self.assertEqual(self.requests(), ["warmup", "sleep 1"])
+
+	def test_timeout_restarts(self):
+		self.coprocess.request("warmup")
+		pid = self.coprocess.proc.pid
+		started = time.time()
+		self.assertRaises(errors.PyNotifyDTemporaryError, self.coprocess.request, "sleep 2")
+		self.assertTrue(time.time() - started < 1)
+		# The late reply of the killed coprocess must not answer this.
+		self.assertRaises(errors.PyNotifyDPermanentError, self.coprocess.request, "fail")
+		self.assertNotEqual(self.coprocess.proc.pid, pid)
+		self.assertEqual(self.requests(), ["warmup", "sleep 2", "fail"])
+
+	def test_dead_coprocess_restarts(self):
+		self.coprocess.request("warmup")
+		self.coprocess.proc.kill()
+		self.coprocess.proc.wait()
+		self.coprocess.request("hello")
+		self.assertEqual(self.requests(), ["warmup", "hello"])
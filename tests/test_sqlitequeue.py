@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks the parts of SQLiteQueue not shared with the other backends."""
+
+import unittest
+
+from pynotifyd import durability
+
+from fixtures import QueueBehaviour
+
+
+class SQLiteQueueTest(QueueBehaviour, unittest.TestCase):
+	backend = "sqlite"
+
+	def test_startup_does_not_read_entries(self):
+		q = self.open_queue()
+		for index in range(3):
+			q.enqueue("alice", "m%d" % index)
+		q = self.reopen_queue(q)
+
+		def fail():
+			self.fail("entries read at startup")
+		q.iter_entries = fail
+		self.assertEqual(len(self.claim_all(q)), 3)
+
+	def test_startup_with_dedup_window(self):
+		q = self.open_queue(dedup_window=60)
+		q.enqueue("alice", "hello")
+		q = self.reopen_queue(q, dedup_window=60)
+		q.find_next()
+		self.assertEqual(q.enqueue("alice", "hello"), None)
+
+	def test_claims_keep_durability(self):
+		q = self.open_queue(durability_mode=durability.FSYNC)
+		q.enqueue("alice", "hello")
+		claimed = q.claim_next()
+		self.assertEqual(q.query("SELECT claimed FROM entries").fetchall(), [(1,)])
+		# 2 is FULL
+		self.assertEqual(q.query("PRAGMA synchronous").fetchone(), (2,))
+		q.release(claimed)
+		self.assertEqual(q.query("SELECT claimed FROM entries").fetchall(), [(0,)])
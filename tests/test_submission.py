@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checks the submission protocol between SubmissionClient and
+SubmissionServer."""
+
+import os
+import socket
+import stat
+import unittest
+
+from pynotifyd import config
+from pynotifyd import errors
+from pynotifyd import submission
+
+from fixtures import QueueBehaviour
+
+CONFIG = """
+[general]
+queuedir = %s
+retry = mock, GIVEUP
+[contacts]
+[[alice]]
+email = alice@example.com
+[[bob]]
+email = bob@example.com
+[[team]]
+members = alice, bob
+[providers]
+[[mock]]
+driver = mock
+"""
+
+
+class SubmissionTest(QueueBehaviour, unittest.TestCase):
+	backend = "files"
+
+	def setUp(self):
+		QueueBehaviour.setUp(self)
+		configfile = os.path.join(self.queuedir, "pynotifyd.conf")
+		with open(configfile, "w") as configstream:
+			configstream.write(CONFIG % self.queuedir)
+		self.config = config.read_config(configfile)
+		self.path = os.path.join(self.queuedir, "socket")
+		self.queue = self.open_queue()
+		self.wakeups = 0
+		self.servers = []
+		self.clients = []
+
+	def tearDown(self):
+		for client in self.clients:
+			client.close()
+		for server in self.servers:
+			server.shutdown()
+		QueueBehaviour.tearDown(self)
+
+	def wakeup(self):
+		self.wakeups += 1
+
+	def start_server(self, **kwargs):
+		"""
+		@rtype: submission.SubmissionServer
+		"""
+		server = submission.SubmissionServer(self.path, self.config, self.queue, self.wakeup, **kwargs)
+		self.servers.append(server)
+		return server
+
+	def connect(self):
+		"""
+		@rtype: submission.SubmissionClient
+		"""
+		client = submission.SubmissionClient(self.path)
+		self.clients.append(client)
+		return client
+
+	def test_submit(self):
+		self.start_server()
+		client = self.connect()
+		self.assertEqual(len(client.submit("alice", "hello")), 1)
+		self.assertEqual(len(client.submit("team,alice", "again", priority=1, ttl=60)), 2)
+		self.assertEqual(self.wakeups, 2)
+		self.assertEqual(sorted(self.queue.get_contents(entry) for entry in self.queue.claim_ready()), [("alice", "again"), ("alice", "hello"), ("bob", "again")])
+
+	def test_unknown_recipient(self):
+		self.start_server()
+		client = self.connect()
+		self.assertRaises(errors.PyNotifyDPermanentError, client.submit, "alice,carol", "hello")
+		# The connection remains usable after a refusal.
+		self.assertEqual(len(client.submit("bob", "hello")), 1)
+		self.assertEqual(self.claim_all(self.queue), ["hello"])
+
+	def test_malformed_request(self):
+		self.start_server()
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.connect(self.path)
+		sock.sendall("alice many\n")
+		self.assertEqual(sock.makefile("r").readline(), "ERROR malformed request\n")
+		sock.close()
+		self.assertEqual(self.claim_all(self.queue), [])
+
+	def test_socket_mode(self):
+		# A stale socket left behind by a crash is replaced.
+		open(self.path, "w").close()
+		self.start_server(mode=0600)
+		self.assertTrue(stat.S_ISSOCK(os.stat(self.path).st_mode))
+		self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+		self.connect().submit("alice", "hello")
+
+	def test_shutdown(self):
+		self.start_server().shutdown()
+		self.servers = []
+		self.assertFalse(os.path.exists(self.path))
+		self.assertRaises(errors.PyNotifyDTemporaryError, submission.SubmissionClient, self.path)
+
+	def test_batch(self):
+		self.start_server()
+		client = self.connect()
+		replies = client.submit_batch([("alice", "first", 0, None), ("team", "second", 5, 60)])
+		self.assertEqual(map(len, replies), [1, 2])
+		self.assertEqual(self.wakeups, 1)
+		self.assertEqual(sorted(self.queue.get_contents(entry) for entry in self.queue.claim_ready()), [("alice", "first"), ("alice", "second"), ("bob", "second")])
+
+	def test_batch_is_refused_as_a_whole(self):
+		self.start_server()
+		client = self.connect()
+		self.assertRaises(errors.PyNotifyDPermanentError, client.submit_batch, [("alice", "first", 0, None), ("carol", "second", 0, None)])
+		self.assertEqual(self.wakeups, 0)
+		self.assertEqual(self.claim_all(self.queue), [])